@@ -0,0 +1,122 @@
+import atexit
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+from collections import defaultdict
+
+log = logging.getLogger(__name__)
+
+
+def format_artifact(content):
+    """Turns a node output into the markdown text stored for it.
+
+    Args:
+        content: A string, a dict (one "key: value" line per item) or a list (one line per item).
+    """
+    if type(content) == dict:
+        content = '\n'.join(f"{key}: {value}" for key, value in content.items())
+    if type(content) == list:
+        content = '\n'.join(content)
+    return str(content)
+
+
+class NullArtifactSink:
+    """Drops every artifact."""
+
+    def write(self, run_id, name, content):
+        pass
+
+    def flush(self):
+        pass
+
+
+class MemoryArtifactSink:
+    """Keeps artifacts in a dict of run id -> {name: markdown}, for tests."""
+
+    def __init__(self):
+        self.artifacts = defaultdict(dict)
+        self._lock = threading.Lock()
+
+    def write(self, run_id, name, content):
+        with self._lock:
+            self.artifacts[run_id][name] = format_artifact(content)
+
+    def flush(self):
+        pass
+
+
+class LocalArtifactSink:
+    """Writes artifacts to <root>/<run_id>/<name>.md from a background thread.
+
+    write() only queues the artifact, so nodes never wait on the disk and
+    concurrent runs never overwrite each other's files. The directories of
+    runs not written to for ttl seconds are deleted by the same thread when
+    it starts and then between writes, at most every expire_every seconds.
+    """
+
+    def __init__(self, root="artifacts", ttl=7 * 24 * 3600, expire_every=600):
+        self.root = root
+        self.ttl = ttl
+        self.expire_every = expire_every
+        self._next_expiry = 0.0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="artifact-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def write(self, run_id, name, content):
+        self._queue.put((run_id, name, content))
+
+    def flush(self):
+        """Blocks until every queued artifact is on disk."""
+        self._queue.join()
+
+    def _expire(self, now):
+        if not self.ttl or now < self._next_expiry:
+            return
+        self._next_expiry = now + self.expire_every
+        expired = 0
+        try:
+            with os.scandir(self.root) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False) and entry.stat().st_mtime < now - self.ttl:
+                        shutil.rmtree(entry.path, ignore_errors=True)
+                        expired += 1
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            log.warning("---ARTIFACT EXPIRY FAILED--- %r", e)
+        if expired:
+            log.info("---EXPIRED ARTIFACTS OF %d RUNS---", expired)
+
+    def _run(self):
+        while True:
+            self._expire(time.time())
+            run_id, name, content = self._queue.get()
+            try:
+                run_dir = os.path.join(self.root, run_id)
+                os.makedirs(run_dir, exist_ok=True)
+                with open(os.path.join(run_dir, f"{name}.md"), "w") as f:
+                    f.write(format_artifact(content))
+                # rewriting a file leaves the directory's mtime, which dates the run for expiry
+                os.utime(run_dir)
+            except Exception as e:
+                log.warning("---ARTIFACT WRITE FAILED--- %s/%s: %r", run_id, name, e)
+            finally:
+                self._queue.task_done()
+
+
+def sink_from_env():
+    """Builds the artifact sink selected by the ARTIFACT_SINK environment variable."""
+    sink_name = os.getenv("ARTIFACT_SINK", "local")
+    if sink_name == "disabled":
+        return NullArtifactSink()
+    if sink_name == "memory":
+        return MemoryArtifactSink()
+    if sink_name == "local":
+        return LocalArtifactSink(os.getenv("ARTIFACT_DIR", "artifacts"),
+                                 ttl=float(os.getenv("ARTIFACT_TTL", "604800")) or None)
+    raise ValueError(f"Unknown ARTIFACT_SINK: {sink_name!r}")
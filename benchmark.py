@@ -0,0 +1,298 @@
+"""Offline load test of the email assistant.
+
+Runs emails through graph_app, or through the HTTP app of main.py in
+process, at a fixed concurrency with the fakes of fakes.py standing in for
+Groq and OpenAI, and reports end-to-end and per-node latency percentiles,
+emails per second and peak memory. No API is called and nothing is spent.
+
+    python benchmark.py run --emails 200 --concurrency 16 --llm-latency 0.3 --jitter 0.1
+    python benchmark.py run --target http --error-rate 0.01 -o benchmarks/http.json
+    python benchmark.py compare benchmarks/<old commit>.json benchmarks/<new commit>.json
+
+Results are written to benchmarks/<commit>-<target>-c<concurrency>.json by
+default, so a run on two checkouts with the same arguments can be compared.
+The LLM and embedding caches, the local category classifier and the
+artifact sink are off unless their variables are set, so every run does
+the same work.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import re
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+RESULTS_DIR = "benchmarks"
+# variables describing the setup, saved with the results and checked by compare
+SETTINGS = ["FAKE_LLM_LATENCY", "FAKE_LLM_JITTER", "FAKE_LLM_ERROR_RATE", "FAKE_LLM_SEED", "FAKE_EMBEDDING_LATENCY",
+            "FAKE_EMBEDDING_JITTER", "FAKE_EMBEDDING_ERROR_RATE", "LLM_CACHE", "EMBEDDING_CACHE",
+            "CATEGORY_CLASSIFIER", "RESEARCH_MODE", "RETRIEVAL_MODE", "VECTOR_INDEX", "SPECULATIVE_ANALYSIS",
+            "RAG_MAX_CONCURRENCY", "MODEL_REGISTRY", "MODEL_TIERING", "FAKE_LLM_MODELS",
+            "DEDUP", "DEDUP_THRESHOLD", "RERANK", "RERANK_MODEL", "RERANK_FETCH_K", "RERANK_THRESHOLD",
+            "RERANK_TOKEN_BUDGET"]
+
+SUBJECTS = [
+    "what experiences you offer at Westworld",
+    "ticket prices for a family of {n}",
+    "the opening hours during the holidays",
+    "a refund for my booking #{n}",
+    "the hotels close to the park",
+    "the android hosts in Sweetwater",
+]
+OPENINGS = ["Hi there,", "Hello,", "Dear team,", "Good morning,"]
+CLOSINGS = ["I am looking for new experiences.", "We are planning a trip next month.",
+            "I was not happy with my last visit.", "Thanks for the lovely day last week!"]
+
+
+def synthetic_emails(count, seed=0):
+    """Returns count varied customer emails, the same for the same seed."""
+    rng = random.Random(seed)
+    emails = []
+    for i in range(count):
+        subject = rng.choice(SUBJECTS).format(n=rng.randint(2, 9999))
+        emails.append({"id": i, "initial_email": f"{rng.choice(OPENINGS)}\n\nI am emailing to find out about "
+                                                 f"{subject}.\n\n{rng.choice(CLOSINGS)}\n\nThanks,\nPaul"})
+    return emails
+
+
+def read_emails(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentiles(values):
+    if not len(values):
+        return {"count": 0}
+    values = np.asarray(values) * 1000
+    return {
+        "count": len(values),
+        "mean_ms": round(float(values.mean()), 2),
+        "p50_ms": round(float(np.percentile(values, 50)), 2),
+        "p95_ms": round(float(np.percentile(values, 95)), 2),
+        "p99_ms": round(float(np.percentile(values, 99)), 2),
+        "max_ms": round(float(values.max()), 2),
+    }
+
+
+def peak_rss_mb():
+    """Returns the highest resident memory of this process so far, in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def git_commit():
+    """Returns the short hash of the checked out commit and whether tracked files were changed since."""
+    repo = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=repo, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=repo,
+                                    capture_output=True, text=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown", False
+
+
+def _inputs(email):
+    return {"initial_email": email["initial_email"], "num_steps": 0}
+
+
+def graph_runner(target):
+    """Returns an async function running one email against target and returning its output."""
+    import graph
+
+    if target == "graph":
+        return lambda email: graph.graph_app.ainvoke(_inputs(email))
+
+    if target == "graph-sync":
+        executor = ThreadPoolExecutor(max_workers=64)
+
+        async def run_sync(email):
+            return await asyncio.get_running_loop().run_in_executor(executor, graph.graph_app.invoke, _inputs(email))
+        return run_sync
+
+    import httpx
+    from main import app
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://benchmark", timeout=None)
+
+    async def run_http(email):
+        # /stream_email takes the email alone, the langserve /invoke schema wants every GraphState field
+        response = await client.post("/stream_email", json={"initial_email": email["initial_email"]})
+        response.raise_for_status()
+        event = json.loads(response.text.splitlines()[-1])
+        if event["event"] != "end":
+            raise RuntimeError(event.get("error"))
+        return event["output"]
+    return run_http
+
+
+async def _drive(run, emails, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = {}
+
+    async def one(email):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await run(email)
+            except Exception as e:
+                errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+            else:
+                latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(email) for email in emails))
+    return time.perf_counter() - start, latencies, errors
+
+
+def run_benchmark(emails, target="graph", concurrency=8, warm_up_emails=2):
+    """Runs emails against target and returns the report.
+
+    Args:
+        emails: Dicts with an "initial_email".
+        target: "graph" (graph_app.ainvoke), "graph-sync" (graph_app.invoke on
+            threads) or "http" (POST /stream_email of main.py, served in process).
+        concurrency: The maximum number of emails in flight.
+        warm_up_emails: Emails run before measuring, so lazy resources are built.
+    """
+    import graph
+    from metrics import metrics
+
+    graph.warm_up()
+    run = graph_runner(target)
+
+    async def main():
+        try:
+            await _drive(run, emails[:warm_up_emails], concurrency)
+            metrics.reset()
+            metrics.keep_samples()
+            return await _drive(run, emails, concurrency)
+        finally:
+            # the http target checkpoints its runs; the open connection would keep the process from exiting
+            await graph.aclose_checkpointer()
+
+    seconds, latencies, errors = asyncio.run(main())
+    snapshot = metrics.snapshot()
+    counters = snapshot["counters"]
+    calls = sum(value["count"] for key, value in snapshot["histograms"].items() if key.startswith("llm_latency_seconds"))
+    calls_by_model = {}
+    for key, value in snapshot["histograms"].items():
+        model = re.search(r'model="([^"]*)"', key) if key.startswith("llm_latency_seconds") else None
+        if model:
+            calls_by_model[model.group(1)] = calls_by_model.get(model.group(1), 0) + value["count"]
+    commit, dirty = git_commit()
+    return {
+        "commit": commit,
+        "dirty": dirty,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "target": target,
+        "concurrency": concurrency,
+        "settings": {name: os.getenv(name) for name in SETTINGS},
+        "emails": len(emails),
+        "errors": errors,
+        "error_rate": round(sum(errors.values()) / len(emails), 4) if emails else 0.0,
+        "seconds": round(seconds, 3),
+        "emails_per_second": round(len(latencies) / seconds, 3) if seconds else 0.0,
+        "latency": percentiles(latencies),
+        "nodes": {node: percentiles(values)
+                  for node, values in sorted(metrics.samples_of("node_latency_seconds", "node").items())},
+        "llm_calls_per_email": round(calls / len(emails), 2) if emails else 0.0,
+        "llm_calls_by_model": dict(sorted(calls_by_model.items())),
+        "llm_escalations": sum(value for key, value in counters.items() if key.startswith("llm_escalations_total")),
+        "dedup_hits": sum(value for key, value in counters.items() if key.startswith('dedup_lookups_total{result="hit"')),
+        "prompt_tokens": sum(value for key, value in counters.items() if key.startswith("llm_prompt_tokens_total")),
+        "completion_tokens": sum(value for key, value in counters.items()
+                                 if key.startswith("llm_completion_tokens_total")),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def compare(old, new):
+    """Returns rows of (metric, old value, new value, change in percent) for two reports."""
+    def flatten(report):
+        values = {"emails_per_second": report["emails_per_second"], "error_rate": report["error_rate"],
+                  "peak_rss_mb": report["peak_rss_mb"], "llm_calls_per_email": report["llm_calls_per_email"]}
+        for name in ("p50_ms", "p95_ms", "p99_ms"):
+            values[f"latency.{name}"] = report["latency"].get(name)
+        for node, stats in report["nodes"].items():
+            for name in ("p50_ms", "p95_ms"):
+                values[f"{node}.{name}"] = stats.get(name)
+        return values
+
+    old_values, new_values = flatten(old), flatten(new)
+    rows = []
+    for metric in list(old_values) + [metric for metric in new_values if metric not in old_values]:
+        before, after = old_values.get(metric), new_values.get(metric)
+        change = round((after - before) / before * 100, 1) if before and after is not None else None
+        rows.append((metric, before, after, change))
+    return rows
+
+
+def _print_comparison(old, new):
+    for field in ("target", "concurrency", "emails", "settings"):
+        if old.get(field) != new.get(field):
+            print(f"warning: the runs differ in {field}: {old.get(field)} vs {new.get(field)}", file=sys.stderr)
+    print(f"{'metric':<40} {old['commit']:>12} {new['commit']:>12} {'change':>9}")
+    for metric, before, after, change in compare(old, new):
+        print(f"{metric:<40} {str(before):>12} {str(after):>12} {'' if change is None else f'{change:+.1f}%':>9}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the email assistant offline with fake LLM and embeddings.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="run emails through the graph and save the report")
+    run_parser.add_argument("--target", choices=["graph", "graph-sync", "http"], default="graph")
+    run_parser.add_argument("--emails", type=int, default=100, help="number of synthetic emails")
+    run_parser.add_argument("--input", help="JSONL file of emails to use instead of synthetic ones")
+    run_parser.add_argument("--concurrency", type=int, default=8, help="maximum emails in flight")
+    run_parser.add_argument("--llm-latency", type=float, default=0.2, help="seconds per fake LLM call")
+    run_parser.add_argument("--embedding-latency", type=float, default=0.05, help="seconds per fake embeddings call")
+    run_parser.add_argument("--jitter", type=float, default=0.0,
+                            help="seconds the fake latencies vary by either way")
+    run_parser.add_argument("--error-rate", type=float, default=0.0, help="share of fake LLM calls that fail")
+    run_parser.add_argument("--seed", type=int, default=0, help="seed of the emails and the fake delays and errors")
+    run_parser.add_argument("-o", "--output", help="file to save the report to")
+    compare_parser = commands.add_parser("compare", help="compare two saved reports")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        with open(args.old) as f_old, open(args.new) as f_new:
+            _print_comparison(json.load(f_old), json.load(f_new))
+        sys.exit(0)
+
+    from metrics import configure_logging
+    configure_logging()
+    # the fakes and settings are read when graph.py is imported
+    os.environ["FAKE_LLM"] = "1"
+    os.environ["FAKE_LLM_LATENCY"] = str(args.llm_latency)
+    os.environ["FAKE_LLM_JITTER"] = str(args.jitter)
+    os.environ["FAKE_LLM_ERROR_RATE"] = str(args.error_rate)
+    os.environ["FAKE_LLM_SEED"] = str(args.seed)
+    os.environ["FAKE_EMBEDDING_LATENCY"] = str(args.embedding_latency)
+    os.environ["FAKE_EMBEDDING_JITTER"] = str(args.jitter)
+    for name, value in (("LLM_CACHE", "off"), ("EMBEDDING_CACHE", "0"), ("CATEGORY_CLASSIFIER", "0"),
+                        ("ARTIFACT_SINK", "disabled"), ("DEDUP", "0"), ("DEDUP_DB", ":memory:"),
+                        ("RERANK", "0")):
+        os.environ.setdefault(name, value)
+
+    emails = read_emails(args.input) if args.input else synthetic_emails(args.emails, args.seed)
+    report = run_benchmark(emails, target=args.target, concurrency=args.concurrency)
+    output = args.output or os.path.join(RESULTS_DIR, f"{report['commit']}-{args.target}-c{args.concurrency}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=1)
+    print(json.dumps({key: report[key] for key in ("emails_per_second", "error_rate", "latency", "peak_rss_mb")}))
+    print(f"saved to {output}", file=sys.stderr)
@@ -0,0 +1,270 @@
+"""Bulk processing of email backlogs through graph_app.
+
+Runs are scheduled with a token-bucket limiter sized to the Groq requests
+and tokens per minute limits, and results are streamed back as they finish.
+
+    python bulk.py emails.jsonl -o results.jsonl --rpm 30 --tpm 6000
+
+Every input line is a JSON object with an "initial_email" and an optional "id".
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import sys
+import time
+from functools import lru_cache
+
+from tokens import count_tokens
+
+# LLM calls one graph run makes, as (prompt attribute in graph.py, number of
+# calls, estimated tokens of the variables other than initial_email,
+# estimated completion tokens)
+RUN_PLAN = [
+    ("prompt", 1, 0, 5),
+    ("search_rag_prompt", 1, 5, 60),
+    ("rag_prompt", 3, 700, 80),
+    ("draft_writer_prompt", 1, 300, 250),
+    ("rewrite_router_prompt", 1, 250, 10),
+    ("draft_analysis_prompt", 1, 550, 150),
+    ("rewrite_email_prompt", 1, 700, 250),
+]
+# rag_prompt calls see a generated question instead of the email
+EMAIL_FREE_PROMPTS = {"rag_prompt"}
+
+
+@lru_cache(maxsize=None)
+def _template_tokens(prompt_name):
+    import graph
+    return count_tokens(getattr(graph, prompt_name).template)
+
+
+def estimate_run_cost(initial_email):
+    """Returns the (requests, tokens) one graph run is expected to use for initial_email."""
+    email_tokens = count_tokens(initial_email)
+    requests = 0
+    tokens = 0
+    for prompt_name, calls, variable_tokens, completion_tokens in RUN_PLAN:
+        prompt_tokens = _template_tokens(prompt_name) + variable_tokens
+        if prompt_name not in EMAIL_FREE_PROMPTS:
+            prompt_tokens += email_tokens
+        requests += calls
+        tokens += calls * (prompt_tokens + completion_tokens)
+    return requests, tokens
+
+
+class TokenBucket:
+    """Bucket holding up to capacity units, refilled evenly over period seconds."""
+
+    def __init__(self, capacity, period=60.0):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Seconds until amount units are available (amounts above capacity wait for a full bucket)."""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount):
+        self._refill()
+        self.level -= min(amount, self.capacity)
+
+
+class RateLimiter:
+    """Requests and tokens per minute limiter; a limit of None is unlimited.
+
+    Waiters are served in arrival order, so a large run is not starved by
+    a stream of small ones.
+    """
+
+    def __init__(self, rpm=None, tpm=None, period=60.0):
+        self.buckets = []
+        if rpm:
+            self.buckets.append(("requests", TokenBucket(rpm, period)))
+        if tpm:
+            self.buckets.append(("tokens", TokenBucket(tpm, period)))
+        self._lock = None
+
+    @classmethod
+    def from_env(cls):
+        return cls(rpm=int(os.getenv("GROQ_RPM", "30")) or None,
+                   tpm=int(os.getenv("GROQ_TPM", "6000")) or None)
+
+    async def acquire(self, requests, tokens):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        amounts = {"requests": requests, "tokens": tokens}
+        async with self._lock:
+            while True:
+                wait = max([bucket.wait_time(amounts[name]) for name, bucket in self.buckets] + [0.0])
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            for name, bucket in self.buckets:
+                bucket.take(amounts[name])
+
+
+class BulkStats:
+    """Throughput of a bulk run."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.emails = 0
+        self.errors = 0
+        self.requests = 0
+        self.tokens = 0
+
+    def add(self, result):
+        self.emails += 1
+        self.errors += result["error"] is not None
+        self.requests += result["estimated_requests"]
+        self.tokens += result["estimated_tokens"]
+
+    def report(self):
+        elapsed = time.perf_counter() - self.started
+        minutes = elapsed / 60 if elapsed else math.inf
+        return {
+            "emails": self.emails,
+            "errors": self.errors,
+            "elapsed_seconds": round(elapsed, 3),
+            "emails_per_min": round(self.emails / minutes, 2),
+            "requests_per_min": round(self.requests / minutes, 2),
+            "tokens_per_min": round(self.tokens / minutes, 2),
+        }
+
+
+async def _aiter(emails):
+    if hasattr(emails, "__aiter__"):
+        async for email in emails:
+            yield email
+    else:
+        for email in emails:
+            yield email
+
+
+async def process_emails(emails, app=None, limiter=None, concurrency=8, stats=None):
+    """Runs every email through the graph and yields one result dict per email as it finishes.
+
+    Args:
+        emails: A sync or async iterable of {"initial_email": ..., "id": ...} dicts.
+        app: The runnable to call, graph_app by default.
+        limiter: The RateLimiter to schedule runs with; unlimited when None.
+        concurrency: The maximum number of graph runs in flight.
+        stats: An optional BulkStats updated with every result.
+
+    Closing the generator early (e.g. when a /bulk client disconnects)
+    cancels the runs still in flight.
+    """
+    if concurrency < 1:
+        raise ValueError(f"concurrency must be at least 1, got {concurrency}")
+    if app is None:
+        from graph import graph_app as app
+    limiter = limiter or RateLimiter()
+
+    async def run(index, email):
+        email_id = email.get("id", index) if isinstance(email, dict) else index
+        result = {"id": email_id, "trace_id": None, "email_category": None, "final_email": None, "error": None,
+                  "estimated_requests": 0, "estimated_tokens": 0}
+        start = time.perf_counter()
+        try:
+            # a malformed line gets an error row instead of ending the whole run
+            if not isinstance(email, dict) or not isinstance(email.get("initial_email"), str):
+                raise ValueError("each email needs an initial_email string")
+            requests, tokens = estimate_run_cost(email["initial_email"])
+            result["estimated_requests"], result["estimated_tokens"] = requests, tokens
+            await limiter.acquire(requests, tokens)
+            start = time.perf_counter()
+            state = await app.ainvoke({"initial_email": email["initial_email"], "num_steps": 0})
+            result["trace_id"] = state.get("trace_id")
+            result["email_category"] = state.get("email_category")
+            result["final_email"] = state.get("final_email")
+        except Exception as e:
+            result["error"] = repr(e)
+        result["latency"] = round(time.perf_counter() - start, 3)
+        if stats is not None:
+            stats.add(result)
+        return result
+
+    pending = set()
+    index = 0
+    try:
+        async for email in _aiter(emails):
+            if len(pending) >= concurrency:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+            pending.add(asyncio.ensure_future(run(index, email)))
+            index += 1
+
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        # nobody reads the results anymore; stop spending LLM quota on them
+        for task in pending:
+            task.cancel()
+
+
+def _positive_int(text):
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return value
+
+
+def read_jsonl(f):
+    for line in f:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+async def _main(args):
+    limiter = RateLimiter(rpm=args.rpm or None, tpm=args.tpm or None, period=args.window)
+    stats = BulkStats()
+    source = sys.stdin if args.input == "-" else open(args.input)
+    output = sys.stdout if args.output == "-" else open(args.output, "w")
+    try:
+        async for result in process_emails(read_jsonl(source), limiter=limiter,
+                                           concurrency=args.concurrency, stats=stats):
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if output is not sys.stdout:
+            output.close()
+    print(json.dumps(stats.report()), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a JSONL file of emails through the email assistant graph.")
+    parser.add_argument("input", help="JSONL file of emails, or - for stdin")
+    parser.add_argument("-o", "--output", default="-", help="JSONL file to stream results to, - for stdout")
+    parser.add_argument("--rpm", type=int, default=int(os.getenv("GROQ_RPM", "30")),
+                        help="requests per minute allowed by the LLM provider, 0 for no limit")
+    parser.add_argument("--tpm", type=int, default=int(os.getenv("GROQ_TPM", "6000")),
+                        help="tokens per minute allowed by the LLM provider, 0 for no limit")
+    parser.add_argument("--window", type=float, default=60.0,
+                        help="seconds the --rpm/--tpm limits apply to, shorten together with FAKE_LLM_WINDOW")
+    parser.add_argument("--concurrency", type=_positive_int, default=8, help="maximum graph runs in flight")
+    parser.add_argument("--fake", action="store_true",
+                        help="use the offline fake LLM and embeddings (see FAKE_LLM_* variables)")
+    args = parser.parse_args()
+    from metrics import configure_logging
+    configure_logging()
+    if args.fake:
+        os.environ["FAKE_LLM"] = "1"
+    asyncio.run(_main(args))
@@ -0,0 +1,224 @@
+import difflib
+import logging
+import os
+import threading
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+CATEGORIES = ["price_enquiry", "customer_complaint", "product_enquiry", "customer_feedback", "off_topic"]
+# misspellings the categorizer prompt used to teach the LLM
+CATEGORY_ALIASES = {"price_equiry": "price_enquiry"}
+
+# hand-written exemplars the index starts from, grown with LLM labels over time
+SEED_EXEMPLARS = [
+    ("How much does a ticket to the park cost?", "price_enquiry"),
+    ("What are your prices for a family of four for a weekend stay?", "price_enquiry"),
+    ("Do you offer discounts on group bookings or season passes?", "price_enquiry"),
+    ("I am very disappointed, the host in my room malfunctioned and nobody helped me.", "customer_complaint"),
+    ("My booking was cancelled without notice and I want a refund.", "customer_complaint"),
+    ("The staff were rude and the rides were closed all day, this is unacceptable.", "customer_complaint"),
+    ("What experiences can I have at Westworld?", "product_enquiry"),
+    ("Can you tell me more about the Sweetwater storylines and which hosts I can meet?", "product_enquiry"),
+    ("Is the park suitable for children and are there accessible rides?", "product_enquiry"),
+    ("I had a wonderful time at the park last week, thank you to all the staff!", "customer_feedback"),
+    ("Just wanted to say the new narrative was amazing, but the food could be better.", "customer_feedback"),
+    ("Thanks for a great stay, the hosts were incredibly lifelike.", "customer_feedback"),
+    ("Can you recommend a good plumber in my area?", "off_topic"),
+    ("Please unsubscribe me from this mailing list.", "off_topic"),
+    ("What is the weather going to be like in London tomorrow?", "off_topic"),
+]
+
+
+def match_category(text):
+    """Returns the one of CATEGORIES the free-text categorizer output names, or None when it names none."""
+    text = str(text).strip().strip("'\"` .").lower()
+    text = CATEGORY_ALIASES.get(text, text)
+    if text in CATEGORIES:
+        return text
+    for label in CATEGORIES + list(CATEGORY_ALIASES):
+        if label in text:
+            return CATEGORY_ALIASES.get(label, label)
+    close = difflib.get_close_matches(text, CATEGORIES, n=1, cutoff=0.6)
+    return close[0] if close else None
+
+
+def normalize_category(text):
+    """Maps the free-text categorizer output onto one of CATEGORIES."""
+    return match_category(text) or "off_topic"
+
+
+def load_encoder(model_name):
+    """Returns a function embedding a list of texts on the CPU, or None when no backend is installed."""
+    try:
+        from fastembed import TextEmbedding
+        model = TextEmbedding(model_name=model_name)
+        return lambda texts: np.array(list(model.embed(texts)), dtype=np.float32)
+    except ImportError:
+        pass
+    try:
+        from sentence_transformers import SentenceTransformer
+        model = SentenceTransformer(model_name, device="cpu")
+        return lambda texts: np.asarray(model.encode(texts), dtype=np.float32)
+    except ImportError:
+        return None
+
+
+class ExemplarClassifier:
+    """kNN vote over labeled exemplar emails embedded with a local CPU model.
+
+    classify() returns a label only when the similarity-weighted vote of the
+    k nearest exemplars is at least threshold; callers fall back to the LLM
+    otherwise and add its label with learn().
+
+    Learned exemplars are merged into the matrix save_every at a time, and
+    the file is rewritten from a background thread. start_loading() loads
+    the model in the background; until it is ready embed() returns None and
+    emails go to the LLM.
+    """
+
+    def __init__(self, path="category_exemplars.npz", model_name="BAAI/bge-small-en-v1.5",
+                 k=5, threshold=0.8, min_similarity=0.5, max_exemplars=5000, save_every=32):
+        self.path = path
+        self.model_name = model_name
+        self.k = k
+        self.threshold = threshold
+        self.min_similarity = min_similarity
+        self.max_exemplars = max_exemplars
+        self.save_every = save_every
+        self._encode = None
+        # (vectors, labels), replaced as a whole so readers never mix two versions
+        self._exemplars = None
+        # learned (vector, label) pairs not merged into _exemplars yet
+        self._pending = []
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._loaded = False
+        self._loader = None
+
+    def start_loading(self):
+        """Loads the model and the exemplars in a background thread, once."""
+        with self._lock:
+            if self._loaded or self._loader is not None:
+                return
+            self._loader = threading.Thread(target=self.load, name="category-classifier-load", daemon=True)
+        self._loader.start()
+
+    def load(self):
+        """Loads the embedding model and the exemplars, seeding them on first use."""
+        with self._lock:
+            if self._loaded:
+                return
+        try:
+            encode = load_encoder(self.model_name)
+        except Exception as e:  # e.g. the model cannot be downloaded
+            log.warning("---CATEGORY CLASSIFIER DISABLED--- %r", e)
+            encode = None
+        else:
+            if encode is None:
+                log.warning("---CATEGORY CLASSIFIER DISABLED: install fastembed or sentence_transformers---")
+        exemplars = None
+        if encode is not None:
+            if os.path.exists(self.path):
+                data = np.load(self.path)
+                # exemplars embedded by another model are not comparable, start over from the seeds
+                if str(data["model"]) == self.model_name:
+                    exemplars = (data["vectors"], data["labels"])
+            if exemplars is None:
+                texts, labels = zip(*SEED_EXEMPLARS)
+                exemplars = (self._normalize(encode(list(texts))),
+                             np.array([CATEGORIES.index(label) for label in labels], dtype=np.int8))
+        with self._lock:
+            if not self._loaded:
+                self._encode, self._exemplars = encode, exemplars
+                self._loaded = True
+
+    @staticmethod
+    def _normalize(vectors):
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def embed(self, text):
+        """Returns the normalized embedding of text, or None when the classifier is disabled or still loading."""
+        if not self._loaded:
+            self.start_loading()
+            return None
+        if self._encode is None:
+            return None
+        return self._normalize(self._encode([text]))[0]
+
+    def classify(self, vector):
+        """Returns (label, confidence) for an embedded email; label is None below the threshold."""
+        exemplars = self._exemplars
+        if vector is None or exemplars is None or not len(exemplars[0]):
+            return None, 0.0
+        vectors, labels = exemplars
+        similarities = vectors @ vector
+        k = min(self.k, len(similarities))
+        nearest = np.argpartition(-similarities, k - 1)[:k]
+        weights = np.clip(similarities[nearest], 0.0, None)
+        if weights.max() < self.min_similarity:
+            return None, 0.0
+        votes = np.bincount(labels[nearest], weights=weights, minlength=len(CATEGORIES))
+        best = int(votes.argmax())
+        confidence = float(votes[best] / votes.sum()) if votes.sum() else 0.0
+        if confidence < self.threshold:
+            return None, confidence
+        return CATEGORIES[best], confidence
+
+    def learn(self, vector, label):
+        """Adds an embedded email and its label to the exemplar set, saved every save_every labels."""
+        if vector is None or label not in CATEGORIES:
+            return
+        with self._lock:
+            if self._exemplars is None:
+                return
+            vectors = self._exemplars[0]
+            if len(vectors) and float((vectors @ vector).max()) > 0.98:
+                return  # a near copy of this email is already an exemplar
+            if any(float(pending @ vector) > 0.98 for pending, _ in self._pending):
+                return
+            self._pending.append((vector, CATEGORIES.index(label)))
+            if len(self._pending) < self.save_every:
+                return
+            exemplars = self._merge()
+        threading.Thread(target=self._save, args=exemplars, name="category-exemplars-save", daemon=True).start()
+
+    def _merge(self):
+        """Merges the pending exemplars into the matrix; call with _lock held."""
+        vectors, labels = self._exemplars
+        new_vectors, new_labels = zip(*self._pending)
+        self._pending = []
+        self._exemplars = (np.vstack([vectors, np.array(new_vectors, dtype=vectors.dtype)])[-self.max_exemplars:],
+                           np.append(labels, np.array(new_labels, dtype=np.int8))[-self.max_exemplars:])
+        return self._exemplars
+
+    def flush(self):
+        """Merges and saves the exemplars learned since the last save, e.g. on shutdown."""
+        with self._lock:
+            if not self._pending:
+                return
+            exemplars = self._merge()
+        self._save(*exemplars)
+
+    def _save(self, vectors, labels):
+        with self._save_lock:
+            # newer exemplars were merged since; their own save writes them
+            if self._exemplars[0] is not vectors:
+                return
+            tmp_path = self.path + ".tmp.npz"
+            np.savez(tmp_path, vectors=vectors, labels=labels, model=np.array(self.model_name))
+            os.replace(tmp_path, self.path)
+
+
+def classifier_from_env():
+    """Builds the classifier configured by the CATEGORY_* environment variables, or None when switched off."""
+    if os.getenv("CATEGORY_CLASSIFIER", "1") != "1":
+        return None
+    return ExemplarClassifier(
+        path=os.getenv("CATEGORY_EXEMPLARS", "category_exemplars.npz"),
+        model_name=os.getenv("CATEGORY_EMBEDDING_MODEL", "BAAI/bge-small-en-v1.5"),
+        k=int(os.getenv("CATEGORY_KNN_K", "5")),
+        threshold=float(os.getenv("CATEGORY_KNN_THRESHOLD", "0.8")),
+    )
@@ -0,0 +1,152 @@
+"""SQLite checkpoints of graph runs, so a failed run resumes where it stopped.
+
+The checkpointed graph saves GraphState after every node under the
+thread id of the run, through langgraph-checkpoint-sqlite's
+AsyncSqliteSaver. When a request fails (e.g. Groq errors during
+rewrite_email) and is retried with the same thread id, the graph continues
+from the last completed node instead of categorizing, researching and
+drafting again.
+
+Every checkpoint of the upstream saver holds the whole state, so
+acompact_thread() drops everything but the latest checkpoint of a finished
+run, and expire() deletes threads idle for longer than the retention period.
+
+    python checkpoints.py stats
+    python checkpoints.py expire --ttl 86400
+"""
+import argparse
+import json
+import os
+import sqlite3
+import time
+from datetime import datetime
+
+import aiosqlite
+from langgraph.checkpoint.sqlite import SqliteSaver
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+
+def thread_config(thread_id):
+    return {"configurable": {"thread_id": thread_id}}
+
+
+def open_checkpointer(path=".checkpoints/checkpoints.sqlite3"):
+    """Returns an AsyncSqliteSaver on path; it must be built on the event loop that runs the graph."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    return AsyncSqliteSaver(aiosqlite.connect(path, timeout=30))
+
+
+def open_sync_checkpointer(path=".checkpoints/checkpoints.sqlite3"):
+    """Returns a SqliteSaver on path, with its tables created, for expire() and stats()."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    saver = SqliteSaver(sqlite3.connect(path, timeout=30, check_same_thread=False))
+    saver.setup()
+    return saver
+
+
+async def acompact_thread(saver, thread_id):
+    """Keeps only the latest checkpoint of every namespace of thread_id.
+
+    The kept checkpoint inherits the names of the nodes every dropped one
+    recorded, so arun_status() still lists all the completed nodes.
+    """
+    await saver.setup()
+    async with saver.lock:
+        rows = await saver.conn.execute_fetchall(
+            "SELECT checkpoint_ns, checkpoint_id, metadata FROM checkpoints WHERE thread_id = ? "
+            "ORDER BY checkpoint_id", (thread_id,))
+        latest, nodes = {}, {}
+        for checkpoint_ns, checkpoint_id, metadata in rows:
+            metadata = saver.jsonplus_serde.loads(metadata)
+            nodes.setdefault(checkpoint_ns, {}).update(dict.fromkeys(metadata.get("writes") or {}))
+            latest[checkpoint_ns] = (checkpoint_id, metadata)
+        for checkpoint_ns, (checkpoint_id, metadata) in latest.items():
+            # the node outputs are in the kept state, only keep which nodes wrote
+            metadata["writes"] = nodes[checkpoint_ns]
+            await saver.conn.execute(
+                "UPDATE checkpoints SET parent_checkpoint_id = NULL, metadata = ? WHERE thread_id = ? "
+                "AND checkpoint_ns = ? AND checkpoint_id = ?",
+                (saver.jsonplus_serde.dumps(metadata), thread_id, checkpoint_ns, checkpoint_id))
+            for table in ("checkpoints", "writes"):
+                await saver.conn.execute(f"DELETE FROM {table} WHERE thread_id = ? AND checkpoint_ns = ? "
+                                         "AND checkpoint_id != ?", (thread_id, checkpoint_ns, checkpoint_id))
+        await saver.conn.commit()
+
+
+def expire(saver, ttl):
+    """Deletes the threads whose latest checkpoint is older than ttl seconds and returns how many.
+
+    Args:
+        saver: A SqliteSaver, see open_sync_checkpointer().
+        ttl: Seconds a thread is kept after its last checkpoint.
+    """
+    with saver.cursor() as cursor:
+        latest = cursor.execute(
+            "SELECT thread_id, type, checkpoint FROM checkpoints WHERE (thread_id, checkpoint_ns, checkpoint_id) IN "
+            "(SELECT thread_id, checkpoint_ns, MAX(checkpoint_id) FROM checkpoints GROUP BY thread_id)").fetchall()
+        cutoff = time.time() - ttl
+        threads = [thread_id for thread_id, type_, checkpoint in latest
+                   if datetime.fromisoformat(saver.serde.loads_typed((type_, checkpoint))["ts"]).timestamp() < cutoff]
+        for table in ("checkpoints", "writes"):
+            cursor.executemany(f"DELETE FROM {table} WHERE thread_id = ?", [(thread_id,) for thread_id in threads])
+    return len(threads)
+
+
+def stats(saver):
+    with saver.cursor(transaction=False) as cursor:
+        counts = {table: cursor.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                  for table in ("checkpoints", "writes")}
+        counts["threads"] = cursor.execute("SELECT COUNT(DISTINCT thread_id) FROM checkpoints").fetchone()[0]
+        counts["bytes"] = (cursor.execute("PRAGMA page_count").fetchone()[0]
+                           * cursor.execute("PRAGMA page_size").fetchone()[0])
+    return counts
+
+
+async def aplan_run(app, inputs, thread_id):
+    """Decides how a request for thread_id runs app and returns (run inputs, status).
+
+    status is "new" when the thread has no checkpoint yet (run inputs), "resumed"
+    when an earlier run stopped before the end (None, so the graph continues
+    from the last completed node) and "completed" when it already finished
+    (nothing left to run; its output is in the saved state).
+    """
+    if getattr(app, "checkpointer", None) is None:
+        return inputs, "new"
+    snapshot = await app.aget_state(thread_config(thread_id))
+    if not snapshot.values:
+        return inputs, "new"
+    if snapshot.next:
+        return None, "resumed"
+    return None, "completed"
+
+
+async def arun_status(app, thread_id):
+    """Returns what is known about the run of thread_id: its status, completed and next nodes and state."""
+    config = thread_config(thread_id)
+    snapshot = await app.aget_state(config)
+    if not snapshot.values:
+        return {"thread_id": thread_id, "status": "unknown", "completed_nodes": [], "next_nodes": [], "values": {}}
+    completed = []
+    async for item in app.checkpointer.alist(config):
+        completed = [node for node in (item.metadata.get("writes") or {}) if not node.startswith("__")] + completed
+    return {
+        "thread_id": thread_id,
+        "status": "interrupted" if snapshot.next else "completed",
+        "completed_nodes": completed,
+        "next_nodes": list(snapshot.next),
+        "values": snapshot.values,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect and clean up the graph run checkpoints.")
+    parser.add_argument("command", choices=["stats", "expire"])
+    parser.add_argument("--path", default=os.getenv("CHECKPOINT_DB", ".checkpoints/checkpoints.sqlite3"))
+    parser.add_argument("--ttl", type=float, default=float(os.getenv("CHECKPOINT_TTL", "604800")),
+                        help="seconds a thread is kept after its last checkpoint")
+    args = parser.parse_args()
+
+    checkpointer = open_sync_checkpointer(args.path)
+    if args.command == "expire":
+        print(json.dumps({"expired_threads": expire(checkpointer, args.ttl)}))
+    print(json.dumps(stats(checkpointer)))
@@ -0,0 +1,89 @@
+import re
+
+from bs4 import BeautifulSoup
+
+from tokens import count_tokens, get_encoding
+
+# a line that starts the quoted message in a reply, e.g.
+# "On Mon, 3 Jun 2024 at 10:00, Paul <paul@example.com> wrote:"
+QUOTE_HEADER = re.compile(
+    r"^\s*(On\s.+wrote:|-{2,}\s*Original Message\s*-{2,}|-{2,}\s*Forwarded message\s*-{2,}|From:\s.+)\s*$",
+    re.IGNORECASE,
+)
+# a line that starts the signature block
+SIGNATURE_DELIMITER = re.compile(
+    r"^\s*(--|__+|Sent from my \w+.*|Get Outlook for \w+.*)\s*$",
+    re.IGNORECASE,
+)
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+# tags that mark an email body as HTML; a bare "<name@example.com>" does not
+HTML_TAG = re.compile(r"</?(html|head|body|div|p|br|span|table|tr|td|blockquote|a|b|i|u|strong|em|font|img|ul|ol|li)\b[^>]*>",
+                      re.IGNORECASE)
+
+
+def clean_email(text):
+    """Strips HTML markup, quoted reply chains and signatures from an email body."""
+    if HTML_TAG.search(text):
+        soup = BeautifulSoup(text, "html.parser")
+        for tag in soup(["script", "style", "head"]):
+            tag.decompose()
+        for quote in soup.find_all("blockquote"):
+            quote.decompose()
+        text = soup.get_text("\n")
+
+    lines = []
+    for line in text.splitlines():
+        if (QUOTE_HEADER.match(line) or SIGNATURE_DELIMITER.match(line)) and any(lines):
+            break
+        if line.lstrip().startswith(">"):
+            continue
+        lines.append(line.rstrip())
+
+    text = "\n".join(lines)
+    text = re.sub(r"\n{3,}", "\n\n", text)
+    return text.strip()
+
+
+def truncate_tokens(text, budget):
+    """Cuts text down to at most budget tokens."""
+    if count_tokens(text) <= budget:
+        return text
+    encoding = get_encoding()
+    if encoding is None:
+        return text[:budget * 4]
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:budget])
+
+
+def _sentence_key(sentence):
+    return " ".join(re.sub(r"[^\w\s]", "", sentence.lower()).split())
+
+
+def compact_research(research_info, budget):
+    """Removes repeated sentences from the research answers and trims them to a token budget.
+
+    research_info is the list of "question\\n\\nanswer\\n\\n\\n" blobs built by
+    research_info_search. A sentence already given in an earlier answer is
+    dropped, and once the budget is spent the remaining sentences are left
+    out. Questions are always kept so the chain still sees what was asked.
+    """
+    seen = set()
+    used = 0
+    compacted = []
+    for blob in research_info or []:
+        question, _, answer = blob.strip().partition("\n\n")
+        used += count_tokens(question)
+
+        kept = []
+        for sentence in SENTENCE_END.split(answer.strip()):
+            key = _sentence_key(sentence)
+            if not key or key in seen:
+                continue
+            tokens = count_tokens(sentence)
+            if used + tokens > budget:
+                continue
+            seen.add(key)
+            kept.append(sentence)
+            used += tokens
+
+        compacted.append(question + "\n\n" + " ".join(kept) + "\n\n\n")
+    return compacted
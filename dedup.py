@@ -0,0 +1,273 @@
+"""Near-duplicate detection for incoming emails.
+
+During incidents and campaigns many customers send practically the same
+email. DuplicateIndex fingerprints every answered email with a MinHash
+signature of its word shingles, after dropping the greeting and the
+sender's name, and finds earlier emails whose estimated Jaccard similarity
+is at least threshold through locality-sensitive hashing: the signature is
+cut into bands and only emails sharing a band with the new one are compared.
+
+Signatures and answers are kept in memory and in a local SQLite file, so
+they survive restarts; entries expire after ttl seconds, since the
+knowledge base behind an answer changes.
+
+Emails mentioning different numbers (party sizes, booking references,
+dates) are never duplicates of each other, however similar the rest is.
+personalize() readdresses a reused answer to the new sender.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+
+import numpy as np
+
+from metrics import metrics
+
+log = logging.getLogger(__name__)
+
+# bounds of the dedup_similarity histogram
+SIMILARITY_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.95, 0.98, 1.0)
+# a Mersenne prime above the 31-bit shingle hashes, so a * hash + b fits in 64 bits
+_PRIME = (1 << 31) - 1
+
+GREETING = re.compile(r"^\s*(dear|hi|hello|hey|greetings|good (?:morning|afternoon|evening))\b([^,\n!:]*)([,!:]?)",
+                      re.IGNORECASE)
+SIGN_OFF_WORDS = {"thanks", "thank", "regards", "best", "cheers", "sincerely", "yours", "kind", "warm", "many"}
+_NAME = r"(?P<name>[A-Z][a-z]+(?:[ \t]+[A-Z][a-z]+)?)"
+NAME_PATTERNS = [
+    re.compile(r"\bmy name is " + _NAME),
+    # "Thanks,\nPaul" or "Kind regards, Paul Smith" at the end
+    re.compile(r"\b(?:thanks|thank you|regards|best|cheers|sincerely|yours)\b[^\n]{0,12}?[,.!]?\s*\n?[ \t]*" + _NAME
+               + r"\s*$", re.IGNORECASE),
+    # "... for 3 people.\nPaul", the name on a line of its own
+    re.compile(r"[.!?]\s*\n[ \t]*" + _NAME + r"\s*$"),
+]
+NUMBER = re.compile(r"\d+(?:[.,:/-]\d+)*")
+WORD = re.compile(r"[a-z0-9']+")
+
+
+def sender_name(text):
+    """Returns the name the email is signed with, or None when there is none."""
+    for pattern in NAME_PATTERNS:
+        match = pattern.search(text.strip())
+        if match and match.group("name").split()[0].lower() not in SIGN_OFF_WORDS:
+            return match.group("name")
+    return None
+
+
+def numbers_of(text):
+    """Returns the numbers in text; emails differing in them are never duplicates."""
+    return sorted(set(NUMBER.findall(text)))
+
+
+def shingles(text, size=3):
+    """Returns the word size-grams of text without its greeting and sender name."""
+    lines = text.strip().split("\n")
+    lines[0] = GREETING.sub("", lines[0])
+    text = "\n".join(lines)
+    name = sender_name(text)
+    if name:
+        text = re.sub(rf"\b{re.escape(name)}\b", " ", text)
+    words = WORD.findall(text.lower())
+    if len(words) <= size:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+class MinHasher:
+    """MinHash signatures of num_perm hash functions, the same for the same seed."""
+
+    def __init__(self, num_perm=128, seed=1):
+        rng = np.random.RandomState(seed)
+        self.num_perm = num_perm
+        self.a = rng.randint(1, _PRIME, size=num_perm).astype(np.uint64)
+        self.b = rng.randint(0, _PRIME, size=num_perm).astype(np.uint64)
+
+    def signature(self, items):
+        if not items:
+            return np.full(self.num_perm, _PRIME, dtype=np.uint64)
+        hashes = np.array([int.from_bytes(hashlib.blake2b(item.encode(), digest_size=8).digest(), "little") % _PRIME
+                           for item in items], dtype=np.uint64)
+        return ((np.outer(self.a, hashes) + self.b[:, None]) % _PRIME).min(axis=1)
+
+
+class DuplicateIndex:
+    """MinHash LSH index of answered emails, persisted in SQLite.
+
+    Args:
+        path: The SQLite file; ":memory:" keeps the index in this process only.
+        threshold: The estimated Jaccard similarity of word shingles from
+            which an email counts as a duplicate.
+        num_perm: Hash functions per signature.
+        bands: LSH bands the signature is cut into; emails sharing no band are
+            never compared. With r = num_perm / bands rows per band, pairs
+            are compared from a similarity of about (1 / bands) ** (1 / r).
+        max_entries: The most emails kept; the oldest are dropped first.
+        ttl: Seconds an answer may be reused for; None keeps them forever.
+    """
+
+    def __init__(self, path=".dedup/dedup.sqlite3", threshold=0.9, num_perm=128, bands=32,
+                 max_entries=10000, ttl=7 * 24 * 3600):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.path = path
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hasher = MinHasher(num_perm)
+        self._lock = threading.Lock()
+        self._db = None
+        # id -> (signature, numbers, response, created_at)
+        self._entries = {}
+        # (band, band hash) -> ids
+        self._buckets = {}
+        self._stats = {"lookups": 0, "hits": 0}
+
+    @property
+    def lsh_threshold(self):
+        """The similarity from which two emails are likely to share a band."""
+        return (1 / self.bands) ** (1 / self.rows)
+
+    def load(self):
+        """Opens the SQLite file and loads the unexpired entries."""
+        with self._lock:
+            if self._db is not None:
+                return
+            if self.path != ":memory:":
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "id TEXT PRIMARY KEY, signature BLOB NOT NULL, numbers TEXT NOT NULL, "
+                "response TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            if self.ttl:
+                self._db.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl,))
+            self._db.commit()
+            rows = self._db.execute("SELECT id, signature, numbers, response, created_at FROM responses "
+                                    "ORDER BY created_at").fetchall()
+            for entry_id, signature, numbers, response, created_at in rows:
+                signature = np.frombuffer(signature, dtype=np.uint64)
+                if len(signature) == self.hasher.num_perm:
+                    self._insert(entry_id, signature, json.loads(numbers), json.loads(response), created_at)
+
+    def _band_keys(self, signature):
+        return [(band, signature[band * self.rows:(band + 1) * self.rows].tobytes()) for band in range(self.bands)]
+
+    def _insert(self, entry_id, signature, numbers, response, created_at):
+        self._entries[entry_id] = (signature, numbers, response, created_at)
+        for key in self._band_keys(signature):
+            self._buckets.setdefault(key, set()).add(entry_id)
+
+    def _remove(self, entry_id):
+        signature = self._entries.pop(entry_id)[0]
+        for key in self._band_keys(signature):
+            ids = self._buckets.get(key)
+            if ids is not None:
+                ids.discard(entry_id)
+                if not ids:
+                    del self._buckets[key]
+
+    def find(self, text):
+        """Returns (id, response, similarity) of the closest earlier duplicate of text, or None."""
+        self.load()
+        signature = self.hasher.signature(shingles(text))
+        numbers = numbers_of(text)
+        now = time.time()
+        closest, best = 0.0, None
+        with self._lock:
+            self._stats["lookups"] += 1
+            candidates = set()
+            for key in self._band_keys(signature):
+                candidates |= self._buckets.get(key, set())
+            for entry_id in candidates:
+                entry_signature, entry_numbers, response, created_at = self._entries[entry_id]
+                if self.ttl and created_at < now - self.ttl:
+                    continue
+                similarity = float((entry_signature == signature).mean())
+                closest = max(closest, similarity)
+                if entry_numbers == numbers and similarity >= self.threshold and (best is None or similarity > best[2]):
+                    best = (entry_id, response, similarity)
+        if candidates:
+            metrics.observe("dedup_similarity", closest)
+        if best is None:
+            metrics.inc("dedup_lookups_total", result="miss")
+        return best
+
+    def record(self, reused):
+        """Counts whether the answer find() returned was reused."""
+        if reused:
+            with self._lock:
+                self._stats["hits"] += 1
+        metrics.inc("dedup_lookups_total", result="hit" if reused else "unusable")
+
+    def add(self, text, response):
+        """Stores the answer to text; returns its id."""
+        self.load()
+        entry_id = uuid.uuid4().hex
+        signature = self.hasher.signature(shingles(text))
+        numbers = numbers_of(text)
+        created_at = time.time()
+        with self._lock:
+            self._insert(entry_id, signature, numbers, response, created_at)
+            evicted = []
+            if len(self._entries) > self.max_entries:
+                by_age = sorted(self._entries, key=lambda key: self._entries[key][3])
+                evicted = by_age[:len(self._entries) - self.max_entries]
+            for old_id in evicted:
+                self._remove(old_id)
+            self._db.execute("INSERT INTO responses VALUES (?, ?, ?, ?, ?)",
+                             (entry_id, signature.tobytes(), json.dumps(numbers), json.dumps(response), created_at))
+            if evicted:
+                self._db.executemany("DELETE FROM responses WHERE id = ?", [(old_id,) for old_id in evicted])
+            self._db.commit()
+        return entry_id
+
+    def stats(self):
+        """Returns the lookups, hits and stored entries."""
+        with self._lock:
+            return {**self._stats, "entries": len(self._entries)}
+
+
+def personalize(email, old_name, new_name):
+    """Returns email readdressed from old_name to new_name, or None when the name cannot be swapped safely.
+
+    Only the greeting of the first line is rewritten ("Dear Paul," becomes
+    "Dear Anna," or "Hello," without a new name). An email still naming
+    old_name after its greeting is not reused, as the name may as well be
+    the one it is signed with.
+    """
+    if not email:
+        return None
+    lines = email.split("\n")
+    greeting = GREETING.match(lines[0])
+    rest = lines[0][greeting.end():] if greeting else lines[0]
+    if old_name and old_name != new_name and re.search(rf"\b{re.escape(old_name)}\b", "\n".join([rest, *lines[1:]])):
+        return None
+    if greeting:
+        punctuation = greeting.group(3) or ","
+        lines[0] = (f"{greeting.group(1)} {new_name}{punctuation}" if new_name else f"Hello{punctuation}") + rest
+    return "\n".join(lines)
+
+
+def index_from_env():
+    """Builds the index configured by the DEDUP_* environment variables, or None when DEDUP=0."""
+    if os.getenv("DEDUP", "1") != "1":
+        return None
+    ttl = int(os.getenv("DEDUP_TTL", str(7 * 24 * 3600)))
+    index = DuplicateIndex(
+        path=os.getenv("DEDUP_DB", ".dedup/dedup.sqlite3"),
+        threshold=float(os.getenv("DEDUP_THRESHOLD", "0.9")),
+        max_entries=int(os.getenv("DEDUP_MAX_ENTRIES", "10000")),
+        ttl=ttl or None,
+    )
+    metrics.set_buckets("dedup_similarity", SIMILARITY_BUCKETS)
+    return index
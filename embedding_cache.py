@@ -0,0 +1,195 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from typing import List
+
+from langchain_core.embeddings import Embeddings
+
+# disk hits whose last_used update is written in one statement
+TOUCH_BATCH = 256
+
+
+def _to_blob(vector):
+    return array("f", vector).tobytes()
+
+
+def _from_blob(blob):
+    vector = array("f")
+    vector.frombytes(blob)
+    return vector.tolist()
+
+
+class CachedEmbeddings(Embeddings):
+    """Content-addressed cache in front of an embedding model.
+
+    Vectors are looked up in an in-memory LRU first, then in a SQLite file on
+    disk, and only the texts missing from both are sent to the wrapped model
+    (in one embed_documents call). Vectors are stored as packed float32 bytes.
+    Queries and documents share cache entries, which is correct for the OpenAI
+    embedding models where both use the same endpoint.
+
+    The size of the disk tier is tracked in memory and only summed up again
+    when it seems to exceed the limit, and the last_used times of disk hits
+    are written TOUCH_BATCH at a time or with the next store.
+    """
+
+    def __init__(self, embeddings, namespace, cache_dir=".embedding_cache",
+                 memory_items=1024, max_disk_bytes=512 * 1024 * 1024):
+        self.embeddings = embeddings
+        self.namespace = namespace
+        self.memory_items = memory_items
+        self.max_disk_bytes = max_disk_bytes
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "miss_seconds": 0.0}
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(cache_dir, "embeddings.sqlite3"),
+                                   timeout=30, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._db.commit()
+        self._disk_bytes = self._db.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()[0]
+        # key -> time of disk hits not written to last_used yet
+        self._touched = {}
+
+    def _key(self, text):
+        return hashlib.sha256(f"{self.namespace}\0{text}".encode("utf-8")).hexdigest()
+
+    def _remember(self, key, blob):
+        self._memory[key] = blob
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def _flush_touched(self):
+        if self._touched:
+            self._db.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?",
+                                 [(used, key) for key, used in self._touched.items()])
+            self._touched.clear()
+
+    def _evict(self):
+        """Drops the least recently used rows until the disk tier is 90% of its limit."""
+        if self._disk_bytes <= self.max_disk_bytes:
+            return
+        # other processes may share the file, so count it properly before evicting
+        total = self._db.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()[0]
+        self._disk_bytes = total
+        if total <= self.max_disk_bytes:
+            return
+        target = int(self.max_disk_bytes * 0.9)
+        rows = self._db.execute("SELECT key, LENGTH(vector) FROM embeddings ORDER BY last_used").fetchall()
+        stale = []
+        for key, size in rows:
+            if total <= target:
+                break
+            stale.append((key,))
+            total -= size
+        self._db.executemany("DELETE FROM embeddings WHERE key = ?", stale)
+        self._disk_bytes = total
+
+    def _lookup(self, keys):
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    found[key] = self._memory[key]
+                    self._stats["memory_hits"] += 1
+
+            on_disk = [key for key in keys if key not in found]
+            if on_disk:
+                now = time.time()
+                rows = []
+                # stay below SQLite's limit on the number of bound parameters
+                for i in range(0, len(on_disk), 500):
+                    batch = on_disk[i:i + 500]
+                    placeholders = ",".join("?" * len(batch))
+                    rows += self._db.execute(
+                        f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                    ).fetchall()
+                for key, blob in rows:
+                    found[key] = blob
+                    self._remember(key, blob)
+                    self._touched[key] = now
+                    self._stats["disk_hits"] += 1
+                if len(self._touched) >= TOUCH_BATCH:
+                    self._flush_touched()
+                    self._db.commit()
+        return found
+
+    def _store(self, items):
+        with self._lock:
+            now = time.time()
+            for key, blob in items:
+                self._remember(key, blob)
+            self._db.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [(key, blob, now) for key, blob in items],
+            )
+            self._disk_bytes += sum(len(blob) for _, blob in items)
+            self._flush_touched()
+            self._evict()
+            self._db.commit()
+
+    def _split(self, texts):
+        """Returns the cache keys, the vectors already cached and the texts still to embed."""
+        keys = [self._key(text) for text in texts]
+        found = self._lookup(set(keys))
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found:
+                missing.setdefault(key, text)
+        return keys, found, missing
+
+    def _add(self, found, missing, vectors, elapsed):
+        new_items = [(key, _to_blob(vector)) for key, vector in zip(missing, vectors)]
+        self._store(new_items)
+        found.update(new_items)
+        with self._lock:
+            self._stats["misses"] += len(missing)
+            self._stats["miss_seconds"] += elapsed
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, found, missing = self._split(texts)
+        if missing:
+            start = time.perf_counter()
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            self._add(found, missing, vectors, time.perf_counter() - start)
+        return [_from_blob(found[key]) for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        # the SQLite reads and writes run in a worker thread, off the event loop
+        keys, found, missing = await asyncio.to_thread(self._split, texts)
+        if missing:
+            start = time.perf_counter()
+            vectors = await self.embeddings.aembed_documents(list(missing.values()))
+            await asyncio.to_thread(self._add, found, missing, vectors, time.perf_counter() - start)
+        return [_from_blob(found[key]) for key in keys]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
+
+    def stats(self):
+        """Returns the hit/miss counters and an estimate of the embedding time saved."""
+        with self._lock:
+            stats = dict(self._stats)
+        hits = stats["memory_hits"] + stats["disk_hits"]
+        seconds_per_miss = stats["miss_seconds"] / stats["misses"] if stats["misses"] else 0.0
+        stats["hit_rate"] = hits / (hits + stats["misses"]) if hits + stats["misses"] else 0.0
+        stats["estimated_saved_seconds"] = hits * seconds_per_miss
+        return stats
@@ -0,0 +1,317 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from typing import Any, List, Optional
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from tokens import count_tokens
+
+# (marker, response) pairs checked in order against the prompt; the first
+# marker found in the prompt picks the canned response of that chain. The
+# order matters: e.g. the rewrite prompt also contains the draft analysis.
+CANNED_RESPONSES = [
+    ("'final_email'", json.dumps({"final_email": "Dear Paul,\n\nThank you for your interest in Westworld. "
+                                                 "We offer immersive experiences in the Sweetwater town.\n\n"
+                                                 "Best regards,\nSarah\nResident Manager"})),
+    ("'draft_analysis'", json.dumps({"draft_analysis": "The draft should list the experiences and ticket prices."})),
+    ("'email_draft'", json.dumps({"email_draft": "Dear Paul,\n\nThanks for reaching out about Westworld.\n\n"
+                                                 "Best regards,\nSarah\nResident Manager"})),
+    ("'rewrite' (for needs to be rewritten)", json.dumps({"router_decision": "rewrite"})),
+    ("'router_decision'", json.dumps({"router_decision": "research_info"})),
+    ("'questions'", json.dumps({"questions": ["What experiences are available at Westworld?",
+                                              "How much are tickets to Westworld?",
+                                              "What are the opening hours of Westworld?"]})),
+    ("'answers'", json.dumps({"answers": ["Guests can explore Sweetwater and go on narrative adventures.",
+                                          "I don't know.",
+                                          "I don't know."]})),
+    ("Email Categorizer Agent", "product_enquiry"),
+    ("", "Westworld offers immersive western-themed experiences hosted by lifelike androids."),
+]
+
+
+class FakeRateLimitError(Exception):
+    """Raised by FakeChatGroq when a call exceeds its configured rate limits."""
+
+    status_code = 429
+
+
+class FakeServiceError(Exception):
+    """Raised by the fakes at their configured error rate, like a 503 from the provider."""
+
+    status_code = 503
+
+
+class Randomness:
+    """Seeded random source shared by the threads of one fake, so a benchmark sees the same delays and errors."""
+
+    def __init__(self, seed=None):
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def delay(self, latency, jitter):
+        """Returns latency moved by up to jitter seconds either way, never below zero."""
+        if not jitter:
+            return latency
+        with self.lock:
+            return max(0.0, latency + self.random.uniform(-jitter, jitter))
+
+    def fails(self, error_rate):
+        if not error_rate:
+            return False
+        with self.lock:
+            return self.random.random() < error_rate
+
+
+def malform(response, rng):
+    """Returns a JSON response broken in one of the ways LLMs break it."""
+    value = json.loads(response)
+    kind = rng.choice(["prose", "trailing_comma", "single_quotes", "truncated", "renamed_key", "raw_newlines"])
+    if kind == "prose":
+        return f"Here is the JSON you asked for:\n```json\n{response}\n```"
+    if kind == "trailing_comma":
+        return response[:-1] + ",}"
+    if kind == "single_quotes":
+        return repr(value)
+    if kind == "truncated":
+        return response[:-2]
+    if kind == "renamed_key":
+        return json.dumps({"result": next(iter(value.values()))})
+    return response.replace("\\n", "\n")
+
+
+def load_responses(path):
+    """Reads [[marker, response], ...] from a JSON file; responses that are not strings are dumped as JSON."""
+    with open(path) as f:
+        pairs = json.load(f)
+    return [(marker, response if isinstance(response, str) else json.dumps(response)) for marker, response in pairs]
+
+
+class CallLog:
+    """Request and token buckets refilled evenly over the window, like the Groq limits."""
+
+    def __init__(self):
+        self.levels = {}
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def record(self, tokens, rpm, tpm, window):
+        with self.lock:
+            now = time.monotonic()
+            elapsed = now - self.updated
+            self.updated = now
+            for name, limit, amount in (("requests", rpm, 1), ("tokens", tpm, tokens)):
+                if limit is None:
+                    continue
+                level = min(limit, self.levels.get(name, limit) + elapsed * limit / window)
+                if amount > level:
+                    self.levels[name] = level
+                    raise FakeRateLimitError(f"Rate limit reached: {limit} {name} per {window}s")
+                self.levels[name] = level
+            for name, limit, amount in (("requests", rpm, 1), ("tokens", tpm, tokens)):
+                if limit is not None:
+                    self.levels[name] -= amount
+
+
+class FakeChatGroq(BaseChatModel):
+    """Offline stand-in for ChatGroq.
+
+    Answers every chain of graph.py with a canned response after a latency
+    of latency +/- jitter seconds, fails error_rate of the calls with a
+    FakeServiceError, and enforces requests/tokens per window like the Groq
+    API does (window defaults to a minute; shrink it to test rate limiting
+    quickly). For fault injection, slow_rate of the calls take slow_latency
+    seconds instead and malformed_rate of the JSON responses come back broken
+    (see malform). Delays and faults come from a random source seeded with seed.
+    Streamed responses arrive a few characters at a time, spread over the
+    same latency. Responses longer than max_tokens are cut off, as the
+    provider does.
+    """
+
+    model: str = "fake"
+    max_tokens: Optional[int] = None
+    temperature: Optional[float] = None
+    latency: float = 0.2
+    jitter: float = 0.0
+    error_rate: float = 0.0
+    slow_rate: float = 0.0
+    slow_latency: float = 5.0
+    malformed_rate: float = 0.0
+    seed: Optional[int] = None
+    rpm: Optional[int] = None
+    tpm: Optional[int] = None
+    window: float = 60.0
+    responses: List[Any] = CANNED_RESPONSES
+    call_log: Any = None
+    randomness: Any = None
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault("call_log", CallLog())
+        kwargs.setdefault("randomness", Randomness(kwargs.get("seed")))
+        super().__init__(**kwargs)
+
+    @classmethod
+    def from_env(cls, **kwargs):
+        """Builds the fake from the FAKE_LLM_* variables, then kwargs.
+
+        FAKE_LLM_MODELS optionally overrides fields per model, as JSON like
+        {"llama3-8b-8192": {"latency": 0.05, "malformed_rate": 0.1}}.
+        """
+        rpm = os.getenv("FAKE_LLM_RPM")
+        tpm = os.getenv("FAKE_LLM_TPM")
+        seed = os.getenv("FAKE_LLM_SEED")
+        responses = os.getenv("FAKE_LLM_RESPONSES")
+        per_model = json.loads(os.getenv("FAKE_LLM_MODELS") or "{}").get(kwargs.get("model"), {})
+        settings = dict(
+            latency=float(os.getenv("FAKE_LLM_LATENCY", "0.2")),
+            jitter=float(os.getenv("FAKE_LLM_JITTER", "0")),
+            error_rate=float(os.getenv("FAKE_LLM_ERROR_RATE", "0")),
+            slow_rate=float(os.getenv("FAKE_LLM_SLOW_RATE", "0")),
+            slow_latency=float(os.getenv("FAKE_LLM_SLOW_LATENCY", "5")),
+            malformed_rate=float(os.getenv("FAKE_LLM_MALFORMED_RATE", "0")),
+            seed=int(seed) if seed else None,
+            rpm=int(rpm) if rpm else None,
+            tpm=int(tpm) if tpm else None,
+            window=float(os.getenv("FAKE_LLM_WINDOW", "60")),
+            responses=load_responses(responses) + CANNED_RESPONSES if responses else CANNED_RESPONSES,
+        )
+        return cls(**{**settings, **kwargs, **per_model})
+
+    @property
+    def _llm_type(self):
+        return "fake-groq"
+
+    def _respond(self, messages):
+        prompt = "".join(str(message.content) for message in messages)
+        for marker, response in self.responses:
+            if marker in prompt:
+                break
+        self.call_log.record(count_tokens(prompt) + count_tokens(response), self.rpm, self.tpm, self.window)
+        if response.startswith("{") and self.randomness.fails(self.malformed_rate):
+            with self.randomness.lock:
+                response = malform(response, self.randomness.random)
+        if self.max_tokens is not None and count_tokens(response) > self.max_tokens:
+            response = response[:self.max_tokens * 4]
+        return response
+
+    def _outcome(self):
+        """Returns the delay of this call and the error it ends with, if any."""
+        error = FakeServiceError("Service unavailable (injected)") if self.randomness.fails(self.error_rate) else None
+        if self.randomness.fails(self.slow_rate):
+            return self.slow_latency, error
+        return self.randomness.delay(self.latency, self.jitter), error
+
+    def _result(self, response):
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=response))])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        response = self._respond(messages)
+        delay, error = self._outcome()
+        time.sleep(delay)
+        if error:
+            raise error
+        return self._result(response)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        response = self._respond(messages)
+        delay, error = self._outcome()
+        await asyncio.sleep(delay)
+        if error:
+            raise error
+        return self._result(response)
+
+    @staticmethod
+    def _pieces(response, size=8):
+        return [response[i:i + size] for i in range(0, len(response), size)]
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        pieces = self._pieces(self._respond(messages))
+        delay, error = self._outcome()
+        for i, piece in enumerate(pieces):
+            time.sleep(delay / len(pieces))
+            if error and i == len(pieces) // 2:
+                raise error
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=piece))
+            if run_manager:
+                run_manager.on_llm_new_token(piece, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        pieces = self._pieces(self._respond(messages))
+        delay, error = self._outcome()
+        for i, piece in enumerate(pieces):
+            await asyncio.sleep(delay / len(pieces))
+            if error and i == len(pieces) // 2:
+                raise error
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=piece))
+            if run_manager:
+                await run_manager.on_llm_new_token(piece, chunk=chunk)
+            yield chunk
+
+
+class FakeEmbeddings(Embeddings):
+    """Offline stand-in for OpenAIEmbeddings returning deterministic unit vectors.
+
+    Every request takes latency +/- jitter seconds and error_rate of them
+    fail with a FakeServiceError.
+    """
+
+    def __init__(self, size=3072, latency=0.0, jitter=0.0, error_rate=0.0, seed=None):
+        self.size = size
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.randomness = Randomness(seed)
+
+    @classmethod
+    def from_env(cls):
+        seed = os.getenv("FAKE_LLM_SEED")
+        return cls(
+            latency=float(os.getenv("FAKE_EMBEDDING_LATENCY", "0")),
+            jitter=float(os.getenv("FAKE_EMBEDDING_JITTER", "0")),
+            error_rate=float(os.getenv("FAKE_EMBEDDING_ERROR_RATE", "0")),
+            seed=int(seed) if seed else None,
+        )
+
+    def _outcome(self):
+        error = FakeServiceError("Service unavailable (injected)") if self.randomness.fails(self.error_rate) else None
+        return self.randomness.delay(self.latency, self.jitter), error
+
+    def _embed(self, text):
+        values = []
+        seed = text.encode("utf-8")
+        counter = 0
+        while len(values) < self.size:
+            digest = hashlib.sha256(seed + counter.to_bytes(4, "little")).digest()
+            values.extend(b / 255.0 - 0.5 for b in digest)
+            counter += 1
+        values = values[:self.size]
+        norm = sum(v * v for v in values) ** 0.5
+        return [v / norm for v in values]
+
+    def embed_documents(self, texts):
+        delay, error = self._outcome()
+        time.sleep(delay)
+        if error:
+            raise error
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts):
+        delay, error = self._outcome()
+        await asyncio.sleep(delay)
+        if error:
+            raise error
+        return [self._embed(text) for text in texts]
+
+    async def aembed_query(self, text):
+        return (await self.aembed_documents([text]))[0]
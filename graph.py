@@ -1,50 +1,331 @@
-from fastapi import FastAPI
-from pydantic import BaseModel
-from langchain.prompts import PromptTemplate
+from startup import lazy, timed
 
-from langchain_core.output_parsers import StrOutputParser, JsonOutputParser
-from langchain_core.runnables import RunnablePassthrough
+with timed("import langchain"):
+    from langchain.prompts import PromptTemplate
+
+    from langchain_core.output_parsers import StrOutputParser
+    from langchain_core.runnables import RunnableLambda, RunnablePassthrough, ensure_config
+
+    from langchain.schema import Document
+    from langgraph.graph import END, StateGraph
 
 from dotenv import load_dotenv
-from pprint import pprint
 
-from langchain_groq import ChatGroq
+import asyncio
+import contextvars
+import json
+import logging
 import os
-import pickle
-from langchain_community.embeddings import OllamaEmbeddings
-from langchain_community.vectorstores import Chroma
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_openai import OpenAIEmbeddings
-
-from langchain.schema import Document
-from langgraph.graph import END, StateGraph
+import re
+import sys
+import threading
+import time
+import uuid
+from embedding_cache import CachedEmbeddings
+from llm_cache import cache_from_env
+from artifacts import sink_from_env
+from tokens import count_tokens
+from compaction import clean_email, compact_research, truncate_tokens
+from category_classifier import classifier_from_env, match_category, normalize_category
+from dedup import index_from_env, personalize, sender_name
+from reranker import reranker_from_env
+from run_store import load, store_from_env
+from metrics import MetricsCallbackHandler, metrics, trace_id_var
+from resilience import CircuitBreaker, RepairingJsonOutputParser, ResilientLLM, RetryPolicy
+from models import EscalatingChain, ModelRegistry, strict
 
 from typing_extensions import TypedDict
-from typing import List
-
-__import__('pysqlite3')
-import sys
-sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
+from typing import List, Union
+from langchain_core.tracers.context import register_configure_hook
+from concurrent.futures import ThreadPoolExecutor
 
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
 load_dotenv()
+
+# the entry points (main.py, bulk.py, benchmark.py and the other scripts) set up
+# logging with metrics.configure_logging, importing graph leaves it alone
+log = logging.getLogger(__name__)
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
-GROQ_LLM = ChatGroq(
-            model="llama3-70b-8192",
-        )
+# FAKE_LLM=1 swaps in the offline fakes from fakes.py, e.g. for bulk runs against
+# simulated rate limits, so no Groq or OpenAI calls are made
+USE_FAKE_LLM = os.getenv("FAKE_LLM") == "1"
+
+# The LLM client, embedding client, vector store and compiled graph are built
+# on first use (or by warm_up), so importing this module needs no credentials
+# and does not open RAG_DB.
+
+# timeouts, retries, circuit breaker and hedging of every chain's LLM calls, see resilience.py
+llm_policy = RetryPolicy.from_env()
+llm_breaker = CircuitBreaker.from_env()
+# chains whose tokens /stream_email streams; a hedged duplicate would stream its own
+UNHEDGED_CHAINS = {"draft_writer_chain", "rewrite_chain"}
+
+
+# model, max_tokens and temperature of every chain, see models.py
+model_registry = ModelRegistry.from_env()
+# ModelSpec.key -> LLM client
+_chat_models = {}
+_chat_models_lock = threading.Lock()
+
+
+def _build_chat_model(spec):
+    if USE_FAKE_LLM:
+        from fakes import FakeChatGroq
+        return FakeChatGroq.from_env(**spec.llm_kwargs())
+    from langchain_groq import ChatGroq
+    # retries are left to the ResilientLLM of each chain
+    return ChatGroq(
+                timeout=llm_policy.timeout,
+                max_retries=0,
+                **spec.llm_kwargs(),
+            )
+
+
+def get_chat_model(spec):
+    """Returns the LLM client of spec, built on first use and shared by the chains with the same settings."""
+    with _chat_models_lock:
+        if spec.key not in _chat_models:
+            with timed(f"llm {spec.model}"):
+                _chat_models[spec.key] = _build_chat_model(spec)
+        return _chat_models[spec.key]
+
+
+@lazy("llm")
+def get_llm():
+    return get_chat_model(model_registry.default)
+
+
+def _lazy_runnable(get, name):
+    """Runnable standing in for the object get() builds on first use."""
+    async def aget(_):
+        return get()
+    return RunnableLambda(lambda _: get(), afunc=aget, name=name)
+
+
+GROQ_LLM = _lazy_runnable(get_llm, "GROQ_LLM")
+
+
+def chain_llm(chain_name, spec=None):
+    """Returns the LLM of chain_name (or of spec) behind the shared retry policy and circuit breaker."""
+    spec = spec or model_registry.spec(chain_name)
+    llm = _lazy_runnable(lambda: get_chat_model(spec), spec.model)
+    return ResilientLLM(llm, chain_name, llm_policy, llm_breaker, hedge=chain_name not in UNHEDGED_CHAINS)
+
+
+def cache_model(chain_name):
+    """The model settings of chain_name its cached results are keyed on, escalation model included."""
+    return {**model_registry.spec(chain_name).to_dict(), "provider": "fake" if USE_FAKE_LLM else "groq"}
+
+
+# chain name -> EscalatingChain, for the escalation metrics
+escalating_chains = {}
+
+
+def chain_model(chain_name, parser, validate=None):
+    """Returns the LLM of chain_name followed by parser.
+
+    When the registry gives the chain an escalation model, output the parser
+    cannot recover without its default, or that fails validate, is generated
+    again by the escalation model.
+    """
+    spec = model_registry.spec(chain_name)
+    if not spec.escalate_to:
+        return chain_llm(chain_name, spec) | parser
+    chain = EscalatingChain(chain_name, [
+        (spec.model, chain_llm(chain_name, spec) | strict(parser)),
+        (spec.escalate_to, chain_llm(chain_name, spec.escalated()) | parser),
+    ], validate)
+    escalating_chains[chain_name] = chain
+    return chain
+
+# results of the deterministic classifier/router chains, see LLM_CACHE
+with timed("llm_cache"):
+    llm_cache = cache_from_env()
+# where node outputs are stored per run, see ARTIFACT_SINK
+artifact_sink = sink_from_env()
 
 # Load the embedding model from the pickle file
 # with open('embedding_model.pkl', 'rb') as f:
 #     embedding_model = pickle.load(f)
 
-embedding_model = OpenAIEmbeddings(model="text-embedding-3-large")
+EMBEDDING_MODEL = "fake" if USE_FAKE_LLM else "text-embedding-3-large"
+
+
+@lazy("embedding_model")
+def get_embedding_model():
+    if USE_FAKE_LLM:
+        from fakes import FakeEmbeddings
+        embedding_model = FakeEmbeddings.from_env()
+    else:
+        from langchain_openai import OpenAIEmbeddings
+        embedding_model = OpenAIEmbeddings(model=EMBEDDING_MODEL)
+    if os.getenv("EMBEDDING_CACHE", "1") == "1":
+        embedding_model = CachedEmbeddings(
+            embedding_model,
+            namespace=EMBEDDING_MODEL,
+            cache_dir=os.getenv("EMBEDDING_CACHE_DIR", ".embedding_cache"),
+            memory_items=int(os.getenv("EMBEDDING_CACHE_MEMORY_ITEMS", "1024")),
+            max_disk_bytes=int(os.getenv("EMBEDDING_CACHE_MAX_MB", "512")) * 1024 * 1024,
+        )
+    return embedding_model
+
+
+@lazy("dedup_index")
+def get_dedup_index():
+    """Index of answered emails checked before categorize_email, None when DEDUP=0."""
+    index = index_from_env()
+    if index is not None:
+        index.load()
+    return index
+
 
+@lazy("category_classifier")
+def get_category_classifier():
+    """Local kNN email classifier tried before the categorizer LLM, None when CATEGORY_CLASSIFIER=0.
+
+    Its model loads in the background, so a slow or failing download does not
+    hold up startup; emails are categorized by the LLM until it is ready.
+    """
+    classifier = classifier_from_env()
+    if classifier is not None:
+        classifier.start_loading()
+    return classifier
+
+
+@lazy("reranker")
+def get_reranker():
+    """Cross-encoder reranking the retrieved chunks before rag_prompt, None unless RERANK=1."""
+    reranker = reranker_from_env()
+    if reranker is not None:
+        # a model download can take a minute; the top k chunks are used until it is loaded
+        reranker.start_loading()
+    return reranker
+
+
+# max number of generated questions answered at the same time by research_info_search
+RAG_MAX_CONCURRENCY = int(os.getenv("RAG_MAX_CONCURRENCY", "3"))
+# answer recorded for a question whose rag_chain call failed
+RAG_FALLBACK_ANSWER = "I don't know."
+# "per_question" answers each question with its own rag_chain call,
+# "batched" retrieves for all questions at once and answers them in one LLM call
+RESEARCH_MODE = os.getenv("RESEARCH_MODE", "per_question")
+RAG_K = 3
+# token budgets for the research_info sent to each chain and for the cleaned
+# initial_email, see compaction.py
+RESEARCH_TOKEN_BUDGETS = {
+    "draft_writer_chain": int(os.getenv("DRAFT_RESEARCH_TOKENS", "1200")),
+    "draft_analysis_chain": int(os.getenv("ANALYSIS_RESEARCH_TOKENS", "800")),
+    "rewrite_chain": int(os.getenv("REWRITE_RESEARCH_TOKENS", "800")),
+}
+EMAIL_TOKEN_BUDGET = int(os.getenv("EMAIL_TOKEN_BUDGET", "1500"))
+# run the draft analysis at the same time as the rewrite router and throw it away
+# when the router decides not to rewrite, see review_draft_email
+SPECULATIVE_ANALYSIS = os.getenv("SPECULATIVE_ANALYSIS", "0") == "1"
+# runs started through /run_email and /stream_email save their state after every
+# node so a retry with the same thread id resumes, see checkpoints.py
+CHECKPOINTS = os.getenv("CHECKPOINTS", "1") == "1"
+CHECKPOINT_DB = os.getenv("CHECKPOINT_DB", ".checkpoints/checkpoints.sqlite3")
+CHECKPOINT_TTL = float(os.getenv("CHECKPOINT_TTL", "604800"))
+# answer near copies of emails answered before from the stored answers, see dedup.py
+DEDUP = os.getenv("DEDUP", "1") == "1"
+# research answers, RAG questions and draft analysis of each run; GraphState
+# only carries references to them, see run_store.py
+with timed("run_store"):
+    run_store = store_from_env(checkpoints=CHECKPOINTS)
 
 persist_directory = "RAG_DB"
-vectorstore = Chroma(persist_directory=persist_directory, embedding_function=embedding_model)
-retriever = vectorstore.as_retriever(search_kwargs={"k":3})
+# directory of a NumPy snapshot of RAG_DB (see vector_index.py) to retrieve from instead of Chroma
+VECTOR_INDEX = os.getenv("VECTOR_INDEX")
+# "vector" searches the embeddings only, "hybrid" fuses them with BM25 scores
+# and "lexical" uses BM25 alone, see hybrid_retriever.py
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "vector")
+BM25_INDEX = os.getenv("BM25_INDEX", "RAG_DB_BM25")
+HYBRID_LEXICAL_WEIGHT = float(os.getenv("HYBRID_LEXICAL_WEIGHT", "0.5"))
+# candidates taken from each side before fusing
+HYBRID_FETCH_K = int(os.getenv("HYBRID_FETCH_K", "20"))
+# candidate chunks retrieved per question for the reranker, see reranker.py
+RERANK_FETCH_K = int(os.getenv("RERANK_FETCH_K", "20"))
+
+
+@lazy("vectorstore")
+def get_vectorstore():
+    # chromadb needs a newer sqlite3 than some hosts ship
+    __import__('pysqlite3')
+    sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
+    from langchain_community.vectorstores import Chroma
+    return Chroma(persist_directory=persist_directory, embedding_function=get_embedding_model())
+
+
+@lazy("vector_index")
+def get_vector_index():
+    from vector_index import NumpyIndex
+    return NumpyIndex(VECTOR_INDEX)
+
+
+@lazy("bm25_index")
+def get_bm25_index():
+    """Loads the BM25 index from BM25_INDEX, building it from RAG_DB the first time."""
+    from hybrid_retriever import BM25Index
+    if os.path.exists(os.path.join(BM25_INDEX, "postings.npz")):
+        return BM25Index.load(BM25_INDEX)
+    log.info("---BUILDING BM25 INDEX---")
+    index = BM25Index.from_collection(get_vectorstore()._collection)
+    index.save(BM25_INDEX)
+    return index
+
+
+def get_hybrid_retriever(lexical_weight=None, k=RAG_K):
+    from hybrid_retriever import HybridRetriever
+    if lexical_weight is None:
+        lexical_weight = 1.0 if RETRIEVAL_MODE == "lexical" else HYBRID_LEXICAL_WEIGHT
+    return HybridRetriever(index=get_bm25_index(), embeddings=get_embedding_model(),
+                           vector_search=_vector_search, k=k, fetch_k=max(k, HYBRID_FETCH_K),
+                           lexical_weight=lexical_weight)
+
+
+@lazy("retriever")
+def get_retriever():
+    if RETRIEVAL_MODE in ("hybrid", "lexical"):
+        return get_hybrid_retriever()
+    if VECTOR_INDEX:
+        from vector_index import NumpyRetriever
+        return NumpyRetriever(index=get_vector_index(), embeddings=get_embedding_model(), k=RAG_K)
+    return get_vectorstore().as_retriever(search_kwargs={"k":RAG_K})
+
+
+retriever = _lazy_runnable(get_retriever, "retriever")
+
+
+def warm_up():
+  """Builds the LLM clients, embedding client, vector store and graph ahead of the first request.
+
+  Also runs one vector query with a stored embedding, which loads the HNSW
+  segment of RAG_DB (or the pages of VECTOR_INDEX) into memory without
+  calling the embeddings API.
+  """
+  get_llm()
+  for spec in model_registry.specs():
+    get_chat_model(spec)
+  get_embedding_model()
+  get_category_classifier()
+  get_dedup_index()
+  get_reranker()
+  if RETRIEVAL_MODE in ("hybrid", "lexical"):
+    get_bm25_index()
+  if VECTOR_INDEX:
+    index = get_vector_index()
+    with timed("index_preload"):
+      if len(index):
+        index.search(index.vectors[:1], 1)
+  else:
+    collection = get_vectorstore()._collection
+    with timed("hnsw_preload"):
+      sample = collection.get(limit=1, include=["embeddings"])
+      if len(sample["ids"]):
+        collection.query(query_embeddings=[list(sample["embeddings"][0])], n_results=1)
+  get_graph_app()
 
 # docs = vectorstore.similarity_search("What is the westworld park all about?")
 # print(docs)
@@ -65,29 +346,320 @@ rag_prompt = PromptTemplate(
     input_variables=["question","context"],
 )
 
+rag_llm = chain_model("rag_chain", StrOutputParser())
 rag_chain = (
     {"context": retriever , "question": RunnablePassthrough()}
     | rag_prompt
-    | GROQ_LLM
-    | StrOutputParser()
-)
+    | rag_llm
+).with_config(run_name="rag_chain")
+# takes {"question", "context"} with the reranked chunks as context
+reranked_rag_chain = (rag_prompt | rag_llm).with_config(run_name="rag_chain")
 
 # print(rag_chain.invoke("What is the westworld park all about?"))
 
+
+# Batched RAG Chain
+rag_batch_prompt = PromptTemplate(
+    template="""<|begin_of_text|><|start_header_id|>system<|end_header_id|>
+    You are an assistant for question-answering tasks. Use the following pieces of retrieved context to answer each of the numbered questions. If you don't know the answer to a question, just say that you don't know. Use three sentences maximum per answer and keep the answers concise.
+
+    Return a JSON with a single key 'answers' holding a list with one answer string per question, in the same order as the questions, and no premable or explaination.
+     <|eot_id|><|start_header_id|>user<|end_header_id|>
+    QUESTIONS: {questions} \n
+    CONTEXT: {context} \n
+    <|eot_id|>
+    <|start_header_id|>assistant<|end_header_id|>
+    """,
+    input_variables=["questions","context"],
+)
+
+rag_batch_chain = (rag_batch_prompt
+                   | chain_model("rag_batch_chain", RepairingJsonOutputParser(key="answers"))).with_config(run_name="rag_batch_chain")
+
 ######## UTILS #########
-def write_markdown_file(content, filename):
-  """Writes the given content as a markdown file to the local directory.
+def _collect_rag_answers(questions, answers):
+  """Pairs each question with its answer in the research_info blob format.
+
+  A question whose answer is an exception gets RAG_FALLBACK_ANSWER instead.
+  """
+  rag_results = []
+  for question, answer in zip(questions, answers):
+    if isinstance(answer, Exception):
+      log.warning("---RAG FAILED--- %s: %r", question, answer)
+      answer = RAG_FALLBACK_ANSWER
+    log.debug("%s\n%s", question, answer)
+    rag_results.append(question + '\n\n' + str(answer) + "\n\n\n")
+  return rag_results
+
+
+def _reranked_rag_inputs(questions, reranked):
+  return [{"question": question, "context": [document for _, document in hits]}
+          for question, hits in zip(questions, reranked)]
+
+
+def answer_questions(questions):
+  """Runs rag_chain over the questions concurrently.
+
+  Results keep the order of the questions. A question whose chain call fails
+  gets RAG_FALLBACK_ANSWER so the other answers are still returned. With the
+  reranker, the chunks of all questions are retrieved and reranked together
+  first, and each question is answered from its reranked chunks.
+
+  Args:
+    questions: The list of questions to answer.
+  """
+  config = {"max_concurrency": RAG_MAX_CONCURRENCY}
+  reranked = rerank_for_questions(questions)
+  if reranked is None:
+    answers = rag_chain.batch(questions, config=config, return_exceptions=True)
+  else:
+    answers = reranked_rag_chain.batch(_reranked_rag_inputs(questions, reranked), config=config,
+                                       return_exceptions=True)
+  return _collect_rag_answers(questions, answers)
+
+
+async def aanswer_questions(questions):
+  """Async version of answer_questions."""
+  config = {"max_concurrency": RAG_MAX_CONCURRENCY}
+  reranked = await arerank_for_questions(questions)
+  if reranked is None:
+    answers = await rag_chain.abatch(questions, config=config, return_exceptions=True)
+  else:
+    answers = await reranked_rag_chain.abatch(_reranked_rag_inputs(questions, reranked), config=config,
+                                              return_exceptions=True)
+  return _collect_rag_answers(questions, answers)
+
+
+@metrics.time("retriever_latency_seconds", retriever="vector_search")
+def _vector_search(query_embeddings, k):
+  """Searches the Chroma collection (or VECTOR_INDEX) for the k nearest chunks of every query.
+
+  Returns:
+    One list of (id, Document, cosine similarity) per query embedding.
+  """
+  if VECTOR_INDEX:
+    index = get_vector_index()
+    rows, scores = index.search(query_embeddings, k)
+    return [[(index.ids[row], index.document(row), float(score)) for row, score in zip(query_rows, query_scores)]
+            for query_rows, query_scores in zip(rows, scores)]
+
+  results = get_vectorstore()._collection.query(
+      query_embeddings=query_embeddings,
+      n_results=k,
+      include=["documents", "metadatas", "distances"],
+  )
+  # Chroma returns squared l2 distances, which are 2 - 2 * cosine for unit vectors
+  return [[(doc_id, Document(page_content=document, metadata=metadata or {}), 1 - distance / 2)
+           for doc_id, document, metadata, distance in zip(*hits)]
+          for hits in zip(results["ids"], results["documents"], results["metadatas"], results["distances"])]
+
+
+def _unique_documents(results):
+  docs = {}
+  for hits in results:
+    for hit in hits:
+      docs.setdefault(hit[0], hit[1])
+  return list(docs.values())
+
+
+def _query_collection(query_embeddings, k):
+  """Runs one multi-query search on the Chroma collection (or VECTOR_INDEX) and de-duplicates the chunks."""
+  return _unique_documents(_vector_search(query_embeddings, k))
+
+
+def retrieve_for_questions(questions, k=RAG_K):
+  """Retrieves the top k chunks for every question in a single pass.
+
+  All questions are embedded in one request and searched with one multi-query
+  call on the Chroma collection. Chunks returned for several questions are
+  only kept once, in the order they were first seen. With the reranker, the
+  chunks it keeps are returned instead of the top k.
+
+  Args:
+    questions: The list of questions to retrieve context for.
+    k: The number of chunks to fetch per question.
+  """
+  reranked = rerank_for_questions(questions)
+  if reranked is not None:
+    return _unique_documents(reranked)
+  if RETRIEVAL_MODE in ("hybrid", "lexical"):
+    with metrics.time("retriever_latency_seconds", retriever=RETRIEVAL_MODE):
+      return _unique_documents(get_retriever().retrieve_many(questions))
+  return _query_collection(get_embedding_model().embed_documents(questions), k)
+
+
+async def aretrieve_for_questions(questions, k=RAG_K):
+  """Async version of retrieve_for_questions."""
+  reranked = await arerank_for_questions(questions)
+  if reranked is not None:
+    return _unique_documents(reranked)
+  if RETRIEVAL_MODE in ("hybrid", "lexical"):
+    with metrics.time("retriever_latency_seconds", retriever=RETRIEVAL_MODE):
+      return _unique_documents(await get_retriever().aretrieve_many(questions))
+  # the Chroma query blocks, run it off the event loop
+  return await asyncio.to_thread(_query_collection, await get_embedding_model().aembed_documents(questions), k)
+
+
+def _vector_hits(results):
+  return [[(doc_id, document) for doc_id, document, _ in hits] for hits in results]
+
+
+def candidates_for_questions(questions, k):
+  """Returns the k best (id, Document) pairs of every question, retrieved in a single pass."""
+  if RETRIEVAL_MODE in ("hybrid", "lexical"):
+    with metrics.time("retriever_latency_seconds", retriever=RETRIEVAL_MODE):
+      return get_hybrid_retriever(k=k).retrieve_many(questions)
+  return _vector_hits(_vector_search(get_embedding_model().embed_documents(questions), k))
+
+
+async def acandidates_for_questions(questions, k):
+  """Async version of candidates_for_questions."""
+  if RETRIEVAL_MODE in ("hybrid", "lexical"):
+    with metrics.time("retriever_latency_seconds", retriever=RETRIEVAL_MODE):
+      return await get_hybrid_retriever(k=k).aretrieve_many(questions)
+  query_embeddings = await get_embedding_model().aembed_documents(questions)
+  return _vector_hits(await asyncio.to_thread(_vector_search, query_embeddings, k))
+
+
+def _usable_reranker():
+  reranker = get_reranker()
+  return reranker if reranker is not None and reranker.available else None
+
+
+def rerank_for_questions(questions):
+  """Returns the reranked (id, Document) pairs of every question, or None without a usable reranker.
+
+  RERANK_FETCH_K candidates are retrieved per question and all the
+  (question, chunk) pairs of the email are scored in one batch. When that
+  fails, None is returned too and the questions are retrieved for without it.
+
+  Args:
+    questions: The list of questions of one email.
+  """
+  reranker = _usable_reranker()
+  if reranker is None:
+    return None
+  try:
+    return reranker.rerank_many(questions, candidates_for_questions(questions, RERANK_FETCH_K))
+  except Exception as e:
+    log.warning("---RERANK FAILED--- %r", e)
+    return None
+
+
+async def arerank_for_questions(questions):
+  """Async version of rerank_for_questions; the cross-encoder runs in a worker thread."""
+  reranker = _usable_reranker()
+  if reranker is None:
+    return None
+  try:
+    candidates = await acandidates_for_questions(questions, RERANK_FETCH_K)
+    return await asyncio.to_thread(reranker.rerank_many, questions, candidates)
+  except Exception as e:
+    log.warning("---RERANK FAILED--- %r", e)
+    return None
+
+
+def _batched_rag_inputs(questions, docs):
+  log.info("---RETRIEVED %d UNIQUE CHUNKS FOR %d QUESTIONS---", len(docs), len(questions))
+  numbered_questions = '\n'.join(f"{i + 1}. {question}" for i, question in enumerate(questions))
+  context = '\n\n'.join(doc.page_content for doc in docs)
+  return {"questions": numbered_questions, "context": context}
+
+
+def _collect_batched_answers(questions, answers):
+  answers = list(answers)
+  answers += [RAG_FALLBACK_ANSWER] * (len(questions) - len(answers))
+  return _collect_rag_answers(questions, answers)
+
+
+def answer_questions_batched(questions):
+  """Answers all the questions with one retrieval pass and one LLM call.
+
+  Returns the same list of question/answer blobs as answer_questions.
+
+  Args:
+    questions: The list of questions to answer.
+  """
+  inputs = _batched_rag_inputs(questions, retrieve_for_questions(questions))
+  try:
+    answers = rag_batch_chain.invoke(inputs)['answers']
+  except Exception as e:
+    log.warning("---BATCHED RAG FAILED--- %r", e)
+    answers = []
+  return _collect_batched_answers(questions, answers)
+
+
+async def aanswer_questions_batched(questions):
+  """Async version of answer_questions_batched."""
+  inputs = _batched_rag_inputs(questions, await aretrieve_for_questions(questions))
+  try:
+    answers = (await rag_batch_chain.ainvoke(inputs))['answers']
+  except Exception as e:
+    log.warning("---BATCHED RAG FAILED--- %r", e)
+    answers = []
+  return _collect_batched_answers(questions, answers)
+
+
+def _prompt_tokens(state, node, prompt, inputs):
+  """Returns the prompt_tokens state field with the size of the prompt node just sent added."""
+  prompt_tokens = dict(state.get("prompt_tokens") or {})
+  prompt_tokens[node] = prompt_tokens.get(node, 0) + count_tokens(prompt.format(**inputs))
+  return prompt_tokens
+
+
+def stored(run_id, field, value):
+  """Puts a large state field in the run store and returns the reference the state keeps instead."""
+  return run_store.put(run_id, field, value)
+
+
+def loaded(state, field):
+  """Returns the value of a state field kept by reference; only references of the run itself are followed."""
+  return load(run_store, state.get(field), state.get("run_id"))
+
+
+def prepared_email(state):
+  """Returns the email text the chains see, the cleaned one once prepare_email has run."""
+  return state["clean_email"] if "clean_email" in state else state["initial_email"]
+
+
+async def run_store_io(func, *args):
+  """Calls func, which reads or writes the run store, in a thread when the store would block the event loop."""
+  if run_store.blocking:
+    return await asyncio.to_thread(func, *args)
+  return func(*args)
+
+
+def _safe_run_id(run_id):
+  return isinstance(run_id, str) and re.fullmatch(r"[A-Za-z0-9_.-]{1,128}", run_id) is not None and run_id.strip(".") != ""
+
+
+def new_run_id(state):
+  """Returns the id prepare_email gives the graph run: a fresh uuid, after the client's run_id when it sent one.
+
+  The client's run_id only names the run, so a client cannot pick the id of
+  another run and read or overwrite its artifacts and run store values.
+  Anything that is not a safe directory name is dropped.
+  """
+  run_id = uuid.uuid4().hex
+  client_run_id = state.get("run_id")
+  return f"{client_run_id}-{run_id}" if _safe_run_id(client_run_id) else run_id
+
+
+def get_run_id(state):
+  """Returns the run id of the graph run, used to keep each run's artifacts apart."""
+  run_id = state.get("run_id")
+  return run_id if _safe_run_id(run_id) else uuid.uuid4().hex
+
+
+def write_artifact(run_id, content, name):
+  """Hands a node output to the artifact sink without waiting for it to be stored.
 
   Args:
-    content: The string content to write to the file.
-    filename: The filename to save the file as.
+    run_id: The id of the graph run the artifact belongs to.
+    content: The string, dict or list to store.
+    name: The artifact name, e.g. "draft_email".
   """
-  if type(content) == dict:
-    content = '\n'.join(f"{key}: {value}" for key, value in content.items())
-  if type(content) == list:
-    content = '\n'.join(content)
-  with open(f"{filename}.md", "w") as f:
-    f.write(content)
+  artifact_sink.write(run_id, name, content)
 
 
 #Categorize EMAIL
@@ -99,14 +671,14 @@ prompt = PromptTemplate(
 
      <|eot_id|><|start_header_id|>user<|end_header_id|>
     Conduct a comprehensive analysis of the email provided and categorize into one of the following categories:
-        price_equiry - used when someone is asking for information about pricing \
+        price_enquiry - used when someone is asking for information about pricing \
         customer_complaint - used when someone is complaining about something \
         product_enquiry - used when someone is asking for information about a product feature, benefit or service but not about pricing \\
         customer_feedback - used when someone is giving feedback about a product \
         off_topic when it doesnt relate to any other category \
 
 
-            Output a single cetgory only from the types ('price_equiry', 'customer_complaint', 'product_enquiry', 'customer_feedback', 'off_topic') \
+            Output a single cetgory only from the types ('price_enquiry', 'customer_complaint', 'product_enquiry', 'customer_feedback', 'off_topic') \
             eg:
             'price_enquiry' \
 
@@ -117,7 +689,10 @@ prompt = PromptTemplate(
     input_variables=["initial_email"],
 )
 
-email_category_generator = prompt | GROQ_LLM | StrOutputParser()
+email_category_generator = llm_cache.wrap("email_category_generator", prompt,
+                                          prompt | chain_model("email_category_generator", StrOutputParser(),
+                                                                    validate=match_category),
+                                          cacheable=match_category, model=cache_model("email_category_generator"))
 
 
 ## Research Router
@@ -144,7 +719,13 @@ research_router_prompt = PromptTemplate(
     input_variables=["initial_email","email_category"],
 )
 
-research_router = research_router_prompt | GROQ_LLM | JsonOutputParser()
+research_router = llm_cache.wrap("research_router", research_router_prompt,
+                                 research_router_prompt
+                                 | chain_model("research_router",
+                                               RepairingJsonOutputParser(key="router_decision",
+                                                                         choices=["research_info", "draft_email"],
+                                                                         default="research_info")),
+                                 model=cache_model("research_router"))
 
 ## RAG CHAIN QUESTIONS GENERATOR
 search_rag_prompt = PromptTemplate(
@@ -164,7 +745,10 @@ search_rag_prompt = PromptTemplate(
     input_variables=["initial_email","email_category"],
 )
 
-rag_chain_question_generator = search_rag_prompt | GROQ_LLM | JsonOutputParser()
+rag_chain_question_generator = llm_cache.wrap("rag_chain_question_generator", search_rag_prompt,
+                                              search_rag_prompt | chain_model("rag_chain_question_generator",
+                                                                              RepairingJsonOutputParser(key="questions")),
+                                              model=cache_model("rag_chain_question_generator"))
 
 
 ## Write Draft Email
@@ -180,7 +764,7 @@ draft_writer_prompt = PromptTemplate(
             If the customer email is 'customer_complaint' then try to assure we value them and that we are addressing their issues.
             If the customer email is 'customer_feedback' then try to assure we value them and that we are addressing their issues.
             If the customer email is 'product_enquiry' then try to give them the info the researcher provided in a succinct and friendly way.
-            If the customer email is 'price_equiry' then try to give the pricing info they requested.
+            If the customer email is 'price_enquiry' then try to give the pricing info they requested.
 
             You never make up information that hasn't been provided by the research_info or in the initial_email.
             Always sign off the emails in appropriate manner and from Sarah the Resident Manager.
@@ -195,7 +779,8 @@ draft_writer_prompt = PromptTemplate(
     input_variables=["initial_email","email_category","research_info"],
 )
 
-draft_writer_chain = draft_writer_prompt | GROQ_LLM | JsonOutputParser()
+draft_writer_chain = (draft_writer_prompt
+                      | chain_model("draft_writer_chain", RepairingJsonOutputParser(key="email_draft", plain_text=True))).with_config(run_name="draft_writer_chain")
 
 
 ## Draft Email Analysis
@@ -224,7 +809,9 @@ draft_analysis_prompt = PromptTemplate(
     input_variables=["initial_email","email_category","research_info"],
 )
 
-draft_analysis_chain = draft_analysis_prompt | GROQ_LLM | JsonOutputParser()
+draft_analysis_chain = (draft_analysis_prompt
+                        | chain_model("draft_analysis_chain",
+                                      RepairingJsonOutputParser(key="draft_analysis", plain_text=True))).with_config(run_name="draft_analysis_chain")
 
 
 ## Rewrite Router
@@ -249,7 +836,13 @@ rewrite_router_prompt = PromptTemplate(
     input_variables=["initial_email","email_category","draft_email"],
 )
 
-rewrite_router = rewrite_router_prompt | GROQ_LLM | JsonOutputParser()
+rewrite_router = llm_cache.wrap("rewrite_router", rewrite_router_prompt,
+                                rewrite_router_prompt
+                                | chain_model("rewrite_router",
+                                              RepairingJsonOutputParser(key="router_decision",
+                                                                        choices=["rewrite", "no_rewrite"],
+                                                                        default="rewrite")),
+                                model=cache_model("rewrite_router"))
 
 
 # Rewrite Email with Analysis
@@ -277,24 +870,47 @@ rewrite_email_prompt = PromptTemplate(
                      ],
 )
 
-rewrite_chain = rewrite_email_prompt | GROQ_LLM | JsonOutputParser()
+rewrite_chain = (rewrite_email_prompt
+                 | chain_model("rewrite_chain", RepairingJsonOutputParser(key="final_email", plain_text=True))).with_config(run_name="rewrite_chain")
 
 
 ### State
 
-class GraphState(TypedDict):
+class NodeState(TypedDict, total=False):
+    """Fields of GraphState set by the nodes, which clients need not send."""
+
+    clean_email : str
+    run_id : str
+    rewrite_decision : str
+    speculation_stats : dict
+    prompt_tokens : dict
+    trace_id : str
+    duplicate_of : str
+
+
+class GraphState(NodeState):
 
     """
     Represents the state of our graph
 
     Atrributes:
-        initial_email: email
+        initial_email: email, as the client sent it
+        clean_email: the initial email without HTML, quotes and signature, cut to EMAIL_TOKEN_BUDGET,
+        set by prepare_email; the chains read this one
         email_category: email category
         draft_email: LLM generation
         final_email: LLM generation
-        research_info: list of documents
+        research_info: reference to the research answers in the run store, see run_store.py
         info_needed: whether to add search info
         num_steps: number of steps
+        run_id: id of the graph run, set by prepare_email after the run_id the client gave, if any
+        rewrite_decision: rewrite router decision, set in speculative mode
+        speculation_stats: latency saved and tokens wasted by the speculative analysis
+        prompt_tokens: estimated prompt tokens sent to the LLM by each node
+        trace_id: id tagging the logs of the graph run, set by prepare_email when not given
+        duplicate_of: id of the earlier email whose answer was reused, set by reuse_duplicate
+        draft_email_feedback, rag_questions: references to the draft analysis and the RAG questions
+        (clients may also pass the values of these three fields themselves)
     
     """
 
@@ -302,164 +918,343 @@ class GraphState(TypedDict):
     email_category : str
     draft_email : str
     final_email : str
-    research_info : List[str]
+    research_info : Union[str, List[str]]
     info_needed : bool
     num_steps : int
-    draft_email_feedback : dict
-    rag_questions : List[str]
+    draft_email_feedback : Union[str, dict]
+    rag_questions : Union[str, List[str]]
 
 
 ################################ NODES ########################
+# Every node and conditional edge has a sync version for scripts and an
+# async version (prefixed with "a") used when the graph runs under asyncio.
+# Both share the helpers that read the state and build the state update.
+
+def prepare_email(state):
+    """strip HTML, quoted replies and signatures from the initial email before any chain sees it"""
+    trace_id = state.get("trace_id") or uuid.uuid4().hex
+    trace_id_var.set(trace_id)
+    log.info("---PREPARING INITIAL EMAIL---")
+    # the client's email is kept as it was sent; the chains read clean_email
+    email = truncate_tokens(clean_email(state['initial_email']), EMAIL_TOKEN_BUDGET)
+    return {"clean_email": email, "prompt_tokens": {}, "trace_id": trace_id, "run_id": new_run_id(state)}
+
+
+def _reuse_update(state, match):
+    entry_id, response, similarity = match
+    name = sender_name(prepared_email(state))
+    final_email = personalize(response["final_email"], response.get("name"), name)
+    draft_email = personalize(response["draft_email"], response.get("name"), name)
+    if final_email is None or draft_email is None:
+        log.info("---DUPLICATE OF %s CANNOT BE READDRESSED--- similarity %.2f", entry_id, similarity)
+        return None
+    log.info("---REUSING ANSWER TO DUPLICATE %s--- similarity %.2f", entry_id, similarity)
+    run_id = get_run_id(state)
+    write_artifact(run_id, response["email_category"], "email_category")
+    write_artifact(run_id, final_email, "final_email")
+    return {"duplicate_of": entry_id, "email_category": response["email_category"],
+            "research_info": stored(run_id, "research_info", response["research_info"]),
+            "draft_email": draft_email, "final_email": final_email,
+            "num_steps": int(state["num_steps"]) + 1, "run_id": run_id}
+
+
+def reuse_duplicate(state):
+    """answer a near copy of an email answered before with that answer, readdressed to the new sender"""
+    log.info("---CHECKING FOR DUPLICATE EMAIL---")
+    index = get_dedup_index()
+    match = index.find(prepared_email(state)) if index is not None else None
+    update = _reuse_update(state, match) if match is not None else None
+    if match is not None:
+        index.record(update is not None)
+    return update or {"duplicate_of": ""}
+
+
+async def areuse_duplicate(state):
+    """answer a near copy of an email answered before with that answer, readdressed to the new sender"""
+    # a reused answer's research is written to the run store
+    return await run_store_io(reuse_duplicate, state)
+
+
+def remember_response(state):
+    """store the answer so near copies of this email can reuse it"""
+    index = get_dedup_index()
+    if index is not None:
+        index.add(prepared_email(state), {
+            "email_category": state["email_category"],
+            "research_info": loaded(state, "research_info") or [],
+            "draft_email": state["draft_email"],
+            "final_email": state["final_email"],
+            "name": sender_name(prepared_email(state)),
+        })
+    return
 
-def categorize_email(state):
-    """take the initial email and categorize it"""
-    print("---CATEGORIZING INITIAL EMAIL---")
-    initial_email = state['initial_email']
+
+async def aremember_response(state):
+    """store the answer so near copies of this email can reuse it"""
+    # the SQLite write would block the event loop
+    return await asyncio.to_thread(remember_response, state)
+
+
+def _categorize_inputs(state):
+    log.info("---CATEGORIZING INITIAL EMAIL---")
+    return {"initial_email": prepared_email(state)}
+
+
+def _local_category(inputs):
+    """Returns (category, vector) from the local kNN classifier; category is None when it is not confident."""
+    classifier = get_category_classifier()
+    if classifier is None:
+        return None, None
+    vector = classifier.embed(inputs["initial_email"])
+    email_category, confidence = classifier.classify(vector)
+    if email_category is not None:
+        log.info("---CATEGORIZED LOCALLY--- confidence %.2f", confidence)
+    return email_category, vector
+
+
+def _learn_category(vector, answer):
+    """Adds an email the LLM categorized to the local classifier's exemplars.
+
+    An answer naming no category is not learned: its off_topic fallback is
+    a guess, and the kNN would then skip the LLM for similar emails.
+    """
+    email_category = match_category(answer)
+    classifier = get_category_classifier()
+    if classifier is not None and email_category is not None:
+        classifier.learn(vector, email_category)
+
+
+def _categorize_update(state, email_category, inputs, used_llm):
+    metrics.inc("category_decisions_total", source="llm" if used_llm else "knn")
     num_steps = int(state['num_steps'])
     num_steps += 1
+    run_id = get_run_id(state)
+    log.debug("%s", email_category)
 
-    email_category = email_category_generator.invoke({"initial_email": initial_email})
-    print(email_category)
-    
-    # save to local disk
-    write_markdown_file(email_category, "email_category")
-
-    return {"email_category": email_category, "num_steps":num_steps}
+    # save to the artifact sink
+    write_artifact(run_id, email_category, "email_category")
 
+    prompt_tokens = dict(state.get("prompt_tokens") or {})
+    if used_llm:
+        prompt_tokens = _prompt_tokens(state, "categorize_email", prompt, inputs)
+    return {"email_category": email_category, "num_steps":num_steps, "run_id": run_id,
+            "prompt_tokens": prompt_tokens}
 
-def research_info_search(state):
 
-    print("---RESEARCH INFO RAG---")
-    initial_email = state["initial_email"]
-    email_category = state["email_category"]
+def categorize_email(state):
+    """take the initial email and categorize it, asking the LLM only when the local classifier is unsure"""
+    inputs = _categorize_inputs(state)
+    email_category, vector = _local_category(inputs)
+    if email_category is not None:
+        return _categorize_update(state, email_category, inputs, used_llm=False)
+    answer = email_category_generator.invoke(inputs)
+    email_category = normalize_category(answer)
+    _learn_category(vector, answer)
+    return _categorize_update(state, email_category, inputs, used_llm=True)
+
+
+async def acategorize_email(state):
+    """take the initial email and categorize it, asking the LLM only when the local classifier is unsure"""
+    inputs = _categorize_inputs(state)
+    # embedding on the CPU and saving exemplars would block the event loop
+    email_category, vector = await asyncio.to_thread(_local_category, inputs)
+    if email_category is not None:
+        return _categorize_update(state, email_category, inputs, used_llm=False)
+    answer = await email_category_generator.ainvoke(inputs)
+    email_category = normalize_category(answer)
+    await asyncio.to_thread(_learn_category, vector, answer)
+    return _categorize_update(state, email_category, inputs, used_llm=True)
+
+
+def _research_inputs(state):
+    log.info("---RESEARCH INFO RAG---")
+    return {"initial_email": prepared_email(state),
+            "email_category": state["email_category"]}
+
+
+def _research_update(state, generated_questions, rag_results, elapsed, inputs):
     num_steps = state['num_steps']
     num_steps += 1
+    log.info("---RESEARCH (%s) TOOK %.2fs---", RESEARCH_MODE, elapsed)
+    log.debug("%s", rag_results)
+
+    write_artifact(get_run_id(state), rag_results, "research_info")
+    write_artifact(get_run_id(state), generated_questions, "rag_questions")
+
+    return {"research_info": stored(get_run_id(state), "research_info", rag_results),
+            "rag_questions": stored(get_run_id(state), "rag_questions", generated_questions), "num_steps":num_steps,
+            "prompt_tokens": _prompt_tokens(state, "research_info_search", search_rag_prompt, inputs)}
+
 
-    # Web search
-    generated_questions = rag_chain_question_generator.invoke({"initial_email": initial_email,
-                                            "email_category": email_category })
+def research_info_search(state):
+    inputs = _research_inputs(state)
+    generated_questions = rag_chain_question_generator.invoke(inputs)
     generated_questions = generated_questions['questions']
-    # print(questions)
 
-    rag_results = []
-    for question in generated_questions:
-        print(question)
+    start = time.perf_counter()
+    if RESEARCH_MODE == "batched":
+        rag_results = answer_questions_batched(generated_questions)
+    else:
+        rag_results = answer_questions(generated_questions)
+    return _research_update(state, generated_questions, rag_results, time.perf_counter() - start, inputs)
 
-        temp_docs = rag_chain.invoke(question)
-        print(temp_docs)
-        
-        question_results = question + '\n\n' + temp_docs + "\n\n\n"
-        if rag_results is not None:
-            rag_results.append(question_results)
-        else:
-            rag_results = [question_results]
 
-    print(rag_results)
-    print(type(rag_results))
+async def aresearch_info_search(state):
+    inputs = _research_inputs(state)
+    generated_questions = await rag_chain_question_generator.ainvoke(inputs)
+    generated_questions = generated_questions['questions']
 
-    write_markdown_file(rag_results, "research_info")
-    write_markdown_file(generated_questions, "rag_questions")
+    start = time.perf_counter()
+    if RESEARCH_MODE == "batched":
+        rag_results = await aanswer_questions_batched(generated_questions)
+    else:
+        rag_results = await aanswer_questions(generated_questions)
+    return await run_store_io(_research_update, state, generated_questions, rag_results,
+                              time.perf_counter() - start, inputs)
 
-    return {"research_info": rag_results,"rag_questions":generated_questions, "num_steps":num_steps}
 
+def _draft_inputs(state):
+    log.info("---DRAFT EMAIL WRITER---")
+    return {"initial_email": prepared_email(state),
+            "email_category": state["email_category"],
+            "research_info": compact_research(loaded(state, "research_info"),
+                                              RESEARCH_TOKEN_BUDGETS["draft_writer_chain"])}
 
-def draft_email_writer(state):
-    print("---DRAFT EMAIL WRITER---")
-    ## Get the state
-    initial_email = state["initial_email"]
-    email_category = state["email_category"]
-    research_info = state["research_info"]
+
+def _draft_update(state, draft_email, inputs):
     num_steps = state['num_steps']
     num_steps += 1
-
-    # Generate draft email
-    draft_email = draft_writer_chain.invoke({"initial_email": initial_email,
-                                     "email_category": email_category,
-                                     "research_info":research_info})
-    print(draft_email)
-    # print(type(draft_email))
+    log.debug("%s", draft_email)
 
     email_draft = draft_email['email_draft']
-    write_markdown_file(email_draft, "draft_email")
+    write_artifact(get_run_id(state), email_draft, "draft_email")
 
-    return {"draft_email": email_draft, "num_steps":num_steps}
+    return {"draft_email": email_draft, "num_steps":num_steps,
+            "prompt_tokens": _prompt_tokens(state, "draft_email_writer", draft_writer_prompt, inputs)}
 
 
-def analyze_draft_email(state):
-    print("---DRAFT EMAIL ANALYZER---")
-    ## Get the state
-    initial_email = state["initial_email"]
-    email_category = state["email_category"]
-    draft_email = state["draft_email"]
-    research_info = state["research_info"]
+def draft_email_writer(state):
+    inputs = _draft_inputs(state)
+    draft_email = draft_writer_chain.invoke(inputs)
+    return _draft_update(state, draft_email, inputs)
+
+
+async def adraft_email_writer(state):
+    inputs = await run_store_io(_draft_inputs, state)
+    draft_email = await draft_writer_chain.ainvoke(inputs)
+    return _draft_update(state, draft_email, inputs)
+
+
+def _analysis_inputs(state):
+    log.info("---DRAFT EMAIL ANALYZER---")
+    return {"initial_email": prepared_email(state),
+            "email_category": state["email_category"],
+            "research_info": compact_research(loaded(state, "research_info"),
+                                              RESEARCH_TOKEN_BUDGETS["draft_analysis_chain"]),
+            "draft_email": state["draft_email"]}
+
+
+def _analysis_update(state, draft_email_feedback, inputs):
     num_steps = state['num_steps']
     num_steps += 1
 
-    # Generate draft email
-    draft_email_feedback = draft_analysis_chain.invoke({"initial_email": initial_email,
-                                                "email_category": email_category,
-                                                "research_info":research_info,
-                                                "draft_email":draft_email}
-                                               )
-    # print(draft_email)
-    # print(type(draft_email))
+    write_artifact(get_run_id(state), str(draft_email_feedback), "draft_email_feedback")
+    return {"draft_email_feedback": stored(get_run_id(state), "draft_email_feedback", draft_email_feedback),
+            "num_steps":num_steps,
+            "prompt_tokens": _prompt_tokens(state, "analyze_draft_email", draft_analysis_prompt, inputs)}
+
 
-    write_markdown_file(str(draft_email_feedback), "draft_email_feedback")
-    return {"draft_email_feedback": draft_email_feedback, "num_steps":num_steps}
+def analyze_draft_email(state):
+    inputs = _analysis_inputs(state)
+    draft_email_feedback = draft_analysis_chain.invoke(inputs)
+    return _analysis_update(state, draft_email_feedback, inputs)
 
 
-def rewrite_email(state):
-    print("---ReWRITE EMAIL ---")
-    ## Get the state
-    initial_email = state["initial_email"]
-    email_category = state["email_category"]
-    draft_email = state["draft_email"]
-    research_info = state["research_info"]
-    draft_email_feedback = state["draft_email_feedback"]
+async def aanalyze_draft_email(state):
+    inputs = await run_store_io(_analysis_inputs, state)
+    draft_email_feedback = await draft_analysis_chain.ainvoke(inputs)
+    return await run_store_io(_analysis_update, state, draft_email_feedback, inputs)
+
+
+def _rewrite_inputs(state):
+    log.info("---ReWRITE EMAIL ---")
+    return {"initial_email": prepared_email(state),
+            "email_category": state["email_category"],
+            "research_info": compact_research(loaded(state, "research_info"),
+                                              RESEARCH_TOKEN_BUDGETS["rewrite_chain"]),
+            "draft_email": state["draft_email"],
+            "email_analysis": loaded(state, "draft_email_feedback")}
+
+
+def _rewrite_update(state, final_email, inputs):
     num_steps = state['num_steps']
     num_steps += 1
 
-    # Generate draft email
-    final_email = rewrite_chain.invoke({"initial_email": initial_email,
-                                                "email_category": email_category,
-                                                "research_info":research_info,
-                                                "draft_email":draft_email,
-                                                "email_analysis": draft_email_feedback}
-                                               )
+    write_artifact(get_run_id(state), str(final_email), "final_email")
 
-    write_markdown_file(str(final_email), "final_email")
-    
-    return {"final_email": final_email['final_email'], "num_steps":num_steps}
+    return {"final_email": final_email['final_email'], "num_steps":num_steps,
+            "prompt_tokens": _prompt_tokens(state, "rewrite_email", rewrite_email_prompt, inputs)}
 
 
+def rewrite_email(state):
+    inputs = _rewrite_inputs(state)
+    final_email = rewrite_chain.invoke(inputs)
+    return _rewrite_update(state, final_email, inputs)
+
+
+async def arewrite_email(state):
+    inputs = await run_store_io(_rewrite_inputs, state)
+    final_email = await rewrite_chain.ainvoke(inputs)
+    return _rewrite_update(state, final_email, inputs)
+
 
 def no_rewrite(state):
-    print("---NO REWRITE EMAIL ---")
+    log.info("---NO REWRITE EMAIL ---")
     ## Get the state
     draft_email = state["draft_email"]
     num_steps = state['num_steps']
     num_steps += 1
 
-    write_markdown_file(str(draft_email), "final_email")
+    write_artifact(get_run_id(state), str(draft_email), "final_email")
     return {"final_email": draft_email, "num_steps":num_steps}
 
 
 def state_printer(state):
     """print the state"""
-    print("---STATE PRINTER---")
-    print(f"Initial Email: {state['initial_email']} \n" )
-    print(f"Email Category: {state['email_category']} \n")
-    print(f"Draft Email: {state['draft_email']} \n" )
-    print(f"Final Email: {state['final_email']} \n" )
-    print(f"Research Info: {state['research_info']} \n")
-    print(f"RAG Questions: {state['rag_questions']} \n")
-    print(f"Num Steps: {state['num_steps']} \n")
+    log.info("---STATE PRINTER---")
+    # formatting the whole state is expensive, only do it when it is logged
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Initial Email: %s \n", state['initial_email'])
+        log.debug("Email Category: %s \n", state['email_category'])
+        log.debug("Draft Email: %s \n", state['draft_email'])
+        log.debug("Final Email: %s \n", state['final_email'])
+        log.debug("Research Info: %s \n", loaded(state, 'research_info'))
+        log.debug("RAG Questions: %s \n", loaded(state, 'rag_questions'))
+        log.debug("Num Steps: %s \n", state['num_steps'])
     return
 
 
 
 #################### CONDITIONAL EDGES #####################
 
+def _research_route_inputs(state):
+    log.info("---ROUTE TO RESEARCH---")
+    return {"initial_email": prepared_email(state),
+            "email_category": state["email_category"]}
+
+
+def _research_route(router):
+    log.debug("%s", router)
+
+    if router['router_decision'] == 'research_info':
+        log.info("---ROUTE EMAIL TO RESEARCH INFO---")
+        return "research_info"
+
+    elif router['router_decision'] == 'draft_email':
+        log.info("---ROUTE EMAIL TO DRAFT EMAIL---")
+        return "draft_email"
+
+
 def route_to_research(state):
     """
     Route email to RAG or not.
@@ -468,98 +1263,354 @@ def route_to_research(state):
     Returns:
         str: Next node to call
     """
+    return _research_route(research_router.invoke(_research_route_inputs(state)))
 
-    print("---ROUTE TO RESEARCH---")
-    initial_email = state["initial_email"]
-    email_category = state["email_category"]
-
-
-    router = research_router.invoke({"initial_email": initial_email,"email_category":email_category })
-    print(router)
-    # print(type(router))
-    print(router['router_decision'])
 
-    if router['router_decision'] == 'research_info':
-        print("---ROUTE EMAIL TO RESEARCH INFO---")
-        return "research_info"
-    
-    elif router['router_decision'] == 'draft_email':
-        print("---ROUTE EMAIL TO DRAFT EMAIL---")
-        return "draft_email"
-    
+async def aroute_to_research(state):
+    """Async version of route_to_research."""
+    return _research_route(await research_router.ainvoke(_research_route_inputs(state)))
 
-def route_to_rewrite(state):
 
-    print("---ROUTE TO REWRITE---")
-    initial_email = state["initial_email"]
-    email_category = state["email_category"]
-    draft_email = state["draft_email"]
-    # research_info = state["research_info"]
+def _rewrite_route_inputs(state):
+    log.info("---ROUTE TO REWRITE---")
+    return {"initial_email": prepared_email(state),
+            "email_category": state["email_category"],
+            "draft_email": state["draft_email"]}
 
-    # draft_email = "Yo we can't help you, best regards Sarah"
 
-    router = rewrite_router.invoke({"initial_email": initial_email,
-                                     "email_category":email_category,
-                                     "draft_email":draft_email}
-                                   )
-    print(router)
-    print(router['router_decision'])
+def _rewrite_route(router):
+    log.debug("%s", router)
 
     if router['router_decision'] == 'rewrite':
-        print("---ROUTE TO ANALYSIS - REWRITE---")
+        log.info("---ROUTE TO ANALYSIS - REWRITE---")
         return "rewrite"
-    
+
     elif router['router_decision'] == 'no_rewrite':
-        print("---ROUTE EMAIL TO FINAL EMAIL---")
+        log.info("---ROUTE EMAIL TO FINAL EMAIL---")
         return "no_rewrite"
-    
+
+
+def route_to_rewrite(state):
+    return _rewrite_route(rewrite_router.invoke(_rewrite_route_inputs(state)))
+
+
+async def aroute_to_rewrite(state):
+    return _rewrite_route(await rewrite_router.ainvoke(_rewrite_route_inputs(state)))
+
+
+def _speculation_stats(decision, router_seconds, analysis_seconds, analysis_inputs, draft_email_feedback):
+    """Compares the speculative review with running the router and the analysis one after the other.
+
+    When the draft is rewritten the analysis ran while the router was deciding,
+    saving the shorter of the two calls. Otherwise the analysis is discarded and
+    its prompt (plus its completion, if it finished) is wasted.
+    """
+    used = decision == "rewrite"
+    stats = {
+        "decision": decision,
+        "router_seconds": round(router_seconds, 3),
+        "analysis_seconds": round(analysis_seconds, 3) if analysis_seconds is not None else None,
+        "latency_saved_seconds": round(min(router_seconds, analysis_seconds), 3) if used else 0.0,
+        "wasted_prompt_tokens": 0,
+        "wasted_completion_tokens": 0,
+    }
+    if not used:
+        stats["wasted_prompt_tokens"] = count_tokens(draft_analysis_prompt.format(**analysis_inputs))
+        if draft_email_feedback is not None:
+            stats["wasted_completion_tokens"] = count_tokens(json.dumps(draft_email_feedback))
+    log.info("---SPECULATION STATS--- %s", stats)
+    return stats
+
+
+def _timed_invoke(chain, inputs, config=None):
+    start = time.perf_counter()
+    return chain.invoke(inputs, config), time.perf_counter() - start
+
+
+async def _atimed_invoke(chain, inputs):
+    start = time.perf_counter()
+    return await chain.ainvoke(inputs), time.perf_counter() - start
+
+
+def _review_update(state, decision, draft_email_feedback, stats, analysis_inputs, router_inputs):
+    update = {"rewrite_decision": decision, "speculation_stats": stats,
+              "prompt_tokens": _prompt_tokens(state, "review_draft_email", rewrite_router_prompt, router_inputs)}
+    if decision == "rewrite":
+        update.update(_analysis_update(dict(state, prompt_tokens=update["prompt_tokens"]),
+                                       draft_email_feedback, analysis_inputs))
+    return update
+
+
+def review_draft_email(state):
+    """Runs the rewrite router and, speculatively, the draft analysis at the same time.
+
+    The analysis result is only kept when the router decides to rewrite.
+    """
+    analysis_inputs = _analysis_inputs(state)
+    executor = ThreadPoolExecutor(max_workers=1)
+    start = time.perf_counter()
+    # the node's config (callbacks, tracing) and the trace id contextvar do not cross threads by themselves
+    analysis = executor.submit(contextvars.copy_context().run, _timed_invoke, draft_analysis_chain, analysis_inputs,
+                               ensure_config())
+    executor.shutdown(wait=False)
+
+    router_inputs = _rewrite_route_inputs(state)
+    decision = _rewrite_route(rewrite_router.invoke(router_inputs))
+    router_seconds = time.perf_counter() - start
+
+    draft_email_feedback = None
+    analysis_seconds = None
+    if decision == "rewrite":
+        draft_email_feedback, analysis_seconds = analysis.result()
+    elif analysis.done() and analysis.exception() is None:
+        draft_email_feedback, _ = analysis.result()
+
+    stats = _speculation_stats(decision, router_seconds, analysis_seconds, analysis_inputs, draft_email_feedback)
+    return _review_update(state, decision, draft_email_feedback, stats, analysis_inputs, router_inputs)
+
+
+async def areview_draft_email(state):
+    """Async version of review_draft_email; a discarded analysis call is cancelled."""
+    analysis_inputs = await run_store_io(_analysis_inputs, state)
+    start = time.perf_counter()
+    analysis = asyncio.ensure_future(_atimed_invoke(draft_analysis_chain, analysis_inputs))
+    # a discarded analysis may still fail; mark its exception as retrieved
+    analysis.add_done_callback(lambda task: task.cancelled() or task.exception())
+
+    try:
+        router_inputs = _rewrite_route_inputs(state)
+        decision = _rewrite_route(await rewrite_router.ainvoke(router_inputs))
+    except BaseException:
+        analysis.cancel()
+        raise
+    router_seconds = time.perf_counter() - start
+
+    draft_email_feedback = None
+    analysis_seconds = None
+    if decision == "rewrite":
+        draft_email_feedback, analysis_seconds = await analysis
+    elif analysis.done() and not analysis.cancelled() and analysis.exception() is None:
+        draft_email_feedback, _ = analysis.result()
+    else:
+        analysis.cancel()
+
+    stats = _speculation_stats(decision, router_seconds, analysis_seconds, analysis_inputs, draft_email_feedback)
+    return await run_store_io(_review_update, state, decision, draft_email_feedback, stats, analysis_inputs,
+                              router_inputs)
+
+
+def route_after_dedup(state):
+    """answered duplicates skip the pipeline"""
+    return "duplicate" if state.get("duplicate_of") else "new"
+
+
+def route_after_review(state):
+    return state.get("rewrite_decision", "rewrite")
+
 
 ##### GRAPH #######
 
 
-workflow = StateGraph(GraphState)
+def _node(func, afunc=None):
+    """Wraps a node or edge so the graph runs func under invoke and afunc under ainvoke/astream.
+
+    Both are timed in the node_latency_seconds histogram and log with the
+    trace id of the run.
+
+    Nodes without an async version make no network calls, so their func is
+    called directly on the event loop instead of being sent to a thread.
+    """
+    name = func.__name__
+    if afunc is None:
+        async def afunc(state):
+            return func(state)
+
+    def timed_func(state):
+        trace_id_var.set(state.get("trace_id") or "-")
+        with metrics.time("node_latency_seconds", node=name):
+            return func(state)
+
+    async def timed_afunc(state):
+        trace_id_var.set(state.get("trace_id") or "-")
+        with metrics.time("node_latency_seconds", node=name):
+            return await afunc(state)
+
+    return RunnableLambda(timed_func, afunc=timed_afunc, name=name)
+
+
+def build_workflow():
+    """Returns the StateGraph of the email assistant, wired for the current settings."""
+    workflow = StateGraph(GraphState)
+
+    # Define the Nodes
+    workflow.add_node("prepare_email", _node(prepare_email))
+    workflow.add_node("categorize_email", _node(categorize_email, acategorize_email))
+    workflow.add_node("research_info_search", _node(research_info_search, aresearch_info_search))
+    workflow.add_node("state_printer", _node(state_printer))
+    workflow.add_node("draft_email_writer", _node(draft_email_writer, adraft_email_writer))
+    if not SPECULATIVE_ANALYSIS:
+        workflow.add_node("analyze_draft_email", _node(analyze_draft_email, aanalyze_draft_email))
+    workflow.add_node("rewrite_email", _node(rewrite_email, arewrite_email))
+    workflow.add_node("no_rewrite", _node(no_rewrite))
+
+    workflow.set_entry_point("prepare_email")
+    if DEDUP:
+        workflow.add_node("reuse_duplicate", _node(reuse_duplicate, areuse_duplicate))
+        workflow.add_node("remember_response", _node(remember_response, aremember_response))
+        workflow.add_edge("prepare_email", "reuse_duplicate")
+        workflow.add_conditional_edges(
+            "reuse_duplicate",
+            route_after_dedup,
+            {
+                "duplicate": "state_printer",
+                "new": "categorize_email",
+            },
+        )
+    else:
+        workflow.add_edge("prepare_email", "categorize_email")
+
+    # workflow.add_conditional_edges(
+    #     "categorize_email",
+
+    #     _node(route_to_research, aroute_to_research),
+    #     {
+    #         "research_info": "research_info_search",
+    #         "draft_email": "draft_email_writer"
+    #     },
+    # )
+
+    workflow.add_edge("categorize_email", "research_info_search")
+    workflow.add_edge("research_info_search", "draft_email_writer")
+
+
+    if SPECULATIVE_ANALYSIS:
+        # the analysis runs alongside the router inside review_draft_email
+        workflow.add_node("review_draft_email", _node(review_draft_email, areview_draft_email))
+        workflow.add_edge("draft_email_writer", "review_draft_email")
+        workflow.add_conditional_edges(
+            "review_draft_email",
+            route_after_review,
+            {
+                "rewrite": "rewrite_email",
+                "no_rewrite": "no_rewrite",
+            },
+        )
+    else:
+        workflow.add_conditional_edges(
+            "draft_email_writer", #This needs to be checked again, you should analyze the draft email before deciding to rewrite - compare the results one after the other
+            _node(route_to_rewrite, aroute_to_rewrite),
+            {
+                "rewrite": "analyze_draft_email", 
+                "no_rewrite": "no_rewrite",
+            },
+        )
 
-# Define the Nodes
-workflow.add_node("categorize_email", categorize_email)
-workflow.add_node("research_info_search", research_info_search)
-workflow.add_node("state_printer", state_printer)
-workflow.add_node("draft_email_writer", draft_email_writer)
-workflow.add_node("analyze_draft_email", analyze_draft_email)
-workflow.add_node("rewrite_email", rewrite_email)
-workflow.add_node("no_rewrite", no_rewrite)
+        workflow.add_edge("analyze_draft_email", "rewrite_email")
+    # answers are stored for reuse by later near copies once they are final
+    answered = "remember_response" if DEDUP else "state_printer"
+    workflow.add_edge("rewrite_email", answered)
+    workflow.add_edge("no_rewrite", answered)
+    if DEDUP:
+        workflow.add_edge("remember_response", "state_printer")
+    workflow.add_edge("state_printer", END)
 
-workflow.set_entry_point("categorize_email")
+    return workflow
 
-# workflow.add_conditional_edges(
-#     "categorize_email",
 
-#     route_to_research,
-#     {
-#         "research_info": "research_info_search",
-#         "draft_email": "draft_email_writer"
-#     },
-# )
+# chains whose latency, LLM calls and tokens are reported on /metrics
+CHAIN_NAMES = ["email_category_generator", "research_router", "rag_chain_question_generator", "rag_chain",
+               "rag_batch_chain", "draft_writer_chain", "draft_analysis_chain", "rewrite_router", "rewrite_chain"]
+metrics_handler = MetricsCallbackHandler(CHAIN_NAMES)
+# added to every run's callbacks: binding it to the compiled graph is lost when
+# astream_events or langserve pass callbacks of their own
+metrics_handler_var = contextvars.ContextVar("metrics_handler", default=metrics_handler)
+register_configure_hook(metrics_handler_var, inheritable=True)
 
-workflow.add_edge("categorize_email", "research_info_search")
-workflow.add_edge("research_info_search", "draft_email_writer")
 
+def _cache_metrics():
+    gauges = {}
+    for chain, counts in llm_cache.stats().items():
+        lookups = counts.get("hits", 0) + counts.get("misses", 0)
+        gauges[("llm_cache_hit_rate", (("chain", chain),))] = counts.get("hits", 0) / lookups if lookups else 0.0
+    # only report the embedding cache once something built it
+    if get_embedding_model.is_built() and isinstance(get_embedding_model(), CachedEmbeddings):
+        stats = get_embedding_model().stats()
+        gauges["embedding_cache_hit_rate"] = stats["hit_rate"]
+        gauges["embedding_cache_saved_seconds"] = stats["estimated_saved_seconds"]
+    return gauges
 
-workflow.add_conditional_edges(
-    "draft_email_writer", #This needs to be checked again, you should analyze the draft email before deciding to rewrite - compare the results one after the other
-    route_to_rewrite,
-    {
-        "rewrite": "analyze_draft_email", 
-        "no_rewrite": "no_rewrite",
-    },
-)
 
-workflow.add_edge("analyze_draft_email", "rewrite_email")
-workflow.add_edge("rewrite_email","state_printer")
-workflow.add_edge("no_rewrite", "state_printer")
-workflow.add_edge("state_printer", END)
+metrics.add_collector(_cache_metrics)
+metrics.add_collector(lambda: {"llm_circuit_open": int(llm_breaker.state != "closed")})
+
+
+def _escalation_metrics():
+    gauges = {}
+    for chain_name, chain in escalating_chains.items():
+        stats = chain.stats()
+        gauges[("llm_escalation_rate", (("chain", chain_name),))] = (
+            stats["escalations"] / stats["calls"] if stats["calls"] else 0.0)
+    return gauges
+
+
+metrics.add_collector(_escalation_metrics)
+
+
+def _dedup_metrics():
+    if not get_dedup_index.is_built() or get_dedup_index() is None:
+        return {}
+    index = get_dedup_index()
+    stats = index.stats()
+    return {"dedup_hit_rate": stats["hits"] / stats["lookups"] if stats["lookups"] else 0.0,
+            "dedup_entries": stats["entries"],
+            "dedup_threshold": index.threshold,
+            "dedup_lsh_threshold": index.lsh_threshold}
+
+
+metrics.add_collector(_dedup_metrics)
+
 
 #compile
-graph_app = workflow.compile()
+# graph_app.invoke() runs the sync nodes, graph_app.ainvoke()/abatch()/astream()
+# (used by langserve for /invoke, /batch and /stream) run the async ones.
+@lazy("graph")
+def get_graph_app():
+    return build_workflow().compile()
+
+
+# AsyncSqliteSaver is bound to the event loop it is built on, so the checkpointer
+# is built on the server's loop (main.py's startup or first request)
+@lazy("checkpointer")
+def get_checkpointer():
+    from checkpoints import expire, open_checkpointer, open_sync_checkpointer
+    saver = open_sync_checkpointer(CHECKPOINT_DB)
+    expired = expire(saver, CHECKPOINT_TTL)
+    saver.conn.close()
+    if expired:
+        log.info("---EXPIRED %d CHECKPOINTED RUNS---", expired)
+    return open_checkpointer(CHECKPOINT_DB)
+
+
+async def aclose_checkpointer():
+    """Closes the checkpointer's connection; its aiosqlite thread would otherwise keep the process alive."""
+    if CHECKPOINTS and get_checkpointer.is_built():
+        await get_checkpointer().conn.close()
+
+
+# the same graph saving its state after every node; every call needs a thread id
+# in config["configurable"], so graph_app stays the default for langserve and bulk runs
+@lazy("checkpointed_graph")
+def get_checkpointed_app():
+    if not CHECKPOINTS:
+        return get_graph_app()
+    return build_workflow().compile(checkpointer=get_checkpointer())
+
+
+def __getattr__(name):
+    # graph_app is compiled on first access, e.g. by `from graph import graph_app`
+    if name == "graph_app":
+        return get_graph_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 
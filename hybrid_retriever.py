@@ -0,0 +1,333 @@
+"""BM25 inverted index over the RAG_DB chunks, and a retriever fusing it with vector search.
+
+Questions about exact terms (ride names, ticket tiers, prices) are often
+missed by the dense search alone. HybridRetriever scores the chunks with
+BM25 as well and ranks them by a weighted sum of both scores, each scaled
+to 0..1. When every top lexical hit contains every term of a question the
+embedding call for that question is skipped.
+
+The index is kept next to RAG_DB in two files:
+
+    postings.npz     vocabulary and the postings in CSR form (doc rows and term frequencies)
+    documents.json   ids, texts and metadatas of the indexed chunks
+
+    python hybrid_retriever.py build RAG_DB_BM25
+    python hybrid_retriever.py update RAG_DB_BM25
+    python hybrid_retriever.py bench RAG_DB_BM25 questions.txt
+
+update only re-indexes the chunks that were added, changed or removed in
+RAG_DB since the index was saved.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import re
+import time
+from collections import Counter
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+POSTINGS_FILE = "postings.npz"
+DOCUMENTS_FILE = "documents.json"
+# words too common to help a lexical match
+STOPWORDS = frozenset("""
+a about all an and any are as at be but by can could do does for from has have how i if in is it its
+me my no not of on or our so that the their them there these they this to us was we what when where
+which who why will with would you your
+""".split())
+TOKEN = re.compile(r"[a-z0-9]+(?:[.'][a-z0-9]+)*")
+
+
+def tokenize(text):
+    """Lowercased words and numbers of text, without stopwords; "$45.00" gives "45.00"."""
+    return [token for token in TOKEN.findall(text.lower()) if token not in STOPWORDS]
+
+
+class BM25Index:
+    """In-memory BM25 index with incremental upsert/delete, saved to a directory."""
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.ids = []
+        self.texts = []
+        self.metadatas = []
+        self.lengths = []
+        self.rows = {}
+        self.postings = {}
+        self._free = []
+
+    def __len__(self):
+        return len(self.rows)
+
+    def upsert(self, ids, texts, metadatas=None):
+        """Adds chunks, replacing the ones already indexed under the same id."""
+        metadatas = metadatas or [{}] * len(ids)
+        self.delete([doc_id for doc_id in ids if doc_id in self.rows])
+        for doc_id, text, metadata in zip(ids, texts, metadatas):
+            counts = Counter(tokenize(text))
+            if self._free:
+                row = self._free.pop()
+                self.ids[row], self.texts[row], self.metadatas[row] = doc_id, text, metadata or {}
+                self.lengths[row] = sum(counts.values())
+            else:
+                row = len(self.ids)
+                self.ids.append(doc_id)
+                self.texts.append(text)
+                self.metadatas.append(metadata or {})
+                self.lengths.append(sum(counts.values()))
+            self.rows[doc_id] = row
+            for term, count in counts.items():
+                self.postings.setdefault(term, {})[row] = count
+
+    def delete(self, ids):
+        """Removes the chunks indexed under ids; unknown ids are ignored."""
+        for doc_id in ids:
+            row = self.rows.pop(doc_id, None)
+            if row is None:
+                continue
+            for term in set(tokenize(self.texts[row])):
+                postings = self.postings.get(term)
+                if postings is not None:
+                    postings.pop(row, None)
+                    if not postings:
+                        del self.postings[term]
+            self.ids[row], self.texts[row], self.metadatas[row], self.lengths[row] = None, "", {}, 0
+            self._free.append(row)
+
+    def scores(self, query):
+        """Returns (BM25 score of every row, query terms) for query."""
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        terms = set(tokenize(query))
+        if not self.rows or not terms:
+            return scores, terms
+        lengths = np.asarray(self.lengths, dtype=np.float32)
+        average_length = lengths.sum() / len(self.rows)
+        for term in terms:
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            rows = np.fromiter(postings.keys(), dtype=np.int64, count=len(postings))
+            counts = np.fromiter(postings.values(), dtype=np.float32, count=len(postings))
+            idf = math.log(1 + (len(self.rows) - len(postings) + 0.5) / (len(postings) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * lengths[rows] / average_length)
+            scores[rows] += idf * counts * (self.k1 + 1) / (counts + norm)
+        return scores, terms
+
+    def search(self, query, k):
+        """Returns [(row, score)] of the k best matching chunks with a score above 0."""
+        scores, _ = self.scores(query)
+        return self.top(scores, k)
+
+    @staticmethod
+    def top(scores, k):
+        """Returns [(row, score)] of the k highest scores above 0."""
+        k = min(k, int((scores > 0).sum()))
+        if not k:
+            return []
+        rows = np.argpartition(-scores, k - 1)[:k]
+        rows = rows[np.argsort(-scores[rows])]
+        return [(int(row), float(scores[row])) for row in rows]
+
+    def covers(self, row, terms):
+        """True when the chunk at row contains every one of terms."""
+        return all(row in self.postings.get(term, ()) for term in terms)
+
+    def document(self, row):
+        return Document(page_content=self.texts[row], metadata=self.metadatas[row])
+
+    def save(self, path):
+        """Writes the index to path, dropping the rows of deleted chunks."""
+        live = sorted(self.rows.values())
+        new_row = {row: i for i, row in enumerate(live)}
+        vocabulary = sorted(self.postings)
+        pointers = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        doc_rows, counts = [], []
+        for i, term in enumerate(vocabulary):
+            postings = sorted((new_row[row], count) for row, count in self.postings[term].items())
+            doc_rows.extend(row for row, _ in postings)
+            counts.extend(count for _, count in postings)
+            pointers[i + 1] = len(doc_rows)
+
+        os.makedirs(path, exist_ok=True)
+        tmp_path = os.path.join(path, "postings.tmp.npz")
+        np.savez_compressed(tmp_path, vocabulary=np.array(vocabulary, dtype=str), pointers=pointers,
+                            rows=np.array(doc_rows, dtype=np.int32), counts=np.array(counts, dtype=np.uint16),
+                            lengths=np.array([self.lengths[row] for row in live], dtype=np.int32),
+                            params=np.array([self.k1, self.b]))
+        os.replace(tmp_path, os.path.join(path, POSTINGS_FILE))
+        tmp_path = os.path.join(path, DOCUMENTS_FILE + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"ids": [self.ids[row] for row in live], "texts": [self.texts[row] for row in live],
+                       "metadatas": [self.metadatas[row] for row in live]}, f)
+        os.replace(tmp_path, os.path.join(path, DOCUMENTS_FILE))
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(os.path.join(path, POSTINGS_FILE))
+        with open(os.path.join(path, DOCUMENTS_FILE)) as f:
+            documents = json.load(f)
+        k1, b = data["params"]
+        index = cls(k1=float(k1), b=float(b))
+        index.ids, index.texts, index.metadatas = documents["ids"], documents["texts"], documents["metadatas"]
+        index.lengths = data["lengths"].tolist()
+        index.rows = {doc_id: row for row, doc_id in enumerate(index.ids)}
+        pointers, rows, counts = data["pointers"], data["rows"].tolist(), data["counts"].tolist()
+        for i, term in enumerate(data["vocabulary"].tolist()):
+            start, end = pointers[i], pointers[i + 1]
+            index.postings[term] = dict(zip(rows[start:end], counts[start:end]))
+        return index
+
+    @classmethod
+    def from_collection(cls, collection):
+        """Indexes every chunk of a Chroma collection."""
+        data = collection.get(include=["documents", "metadatas"])
+        index = cls()
+        index.upsert(data["ids"], [document or "" for document in data["documents"]], data["metadatas"])
+        return index
+
+    def sync(self, collection):
+        """Brings the index up to date with a Chroma collection; returns the (upserted, deleted) counts."""
+        data = collection.get(include=["documents", "metadatas"])
+        changed = [(doc_id, document or "", metadata)
+                   for doc_id, document, metadata in zip(data["ids"], data["documents"], data["metadatas"])
+                   if doc_id not in self.rows or self.texts[self.rows[doc_id]] != (document or "")
+                   or self.metadatas[self.rows[doc_id]] != (metadata or {})]
+        removed = set(self.rows) - set(data["ids"])
+        if changed:
+            self.upsert(*map(list, zip(*changed)))
+        self.delete(removed)
+        return len(changed), len(removed)
+
+
+class HybridRetriever(BaseRetriever):
+    """Ranks chunks by lexical_weight * BM25 + (1 - lexical_weight) * vector similarity.
+
+    Both scores are divided by the best score of the question first. With a
+    lexical_weight of 1 no question is embedded; between 0 and 1 a question
+    is not embedded when each of its top k BM25 hits contains all its terms.
+    vector_search(query_embeddings, fetch_k) returns, per query, a list of
+    (id, Document, similarity).
+    """
+
+    index: BM25Index
+    embeddings: object
+    vector_search: object
+    k: int = 4
+    fetch_k: int = 20
+    lexical_weight: float = 0.5
+
+    def _plan(self, questions):
+        """Returns the lexical hits and query terms of every question, and which questions need embedding."""
+        lexical, needs_vectors = [], []
+        for question in questions:
+            scores, terms = self.index.scores(question)
+            hits = self.index.top(scores, self.fetch_k)
+            lexical.append(hits)
+            exact = len(hits) >= self.k and all(self.index.covers(row, terms) for row, _ in hits[:self.k])
+            needs_vectors.append(self.lexical_weight == 0 or (self.lexical_weight < 1 and not exact))
+        return lexical, needs_vectors
+
+    def _fuse(self, lexical_hits, vector_hits):
+        scores, documents = {}, {}
+        if lexical_hits:
+            best = lexical_hits[0][1]
+            for row, score in lexical_hits:
+                doc_id = self.index.ids[row]
+                scores[doc_id] = self.lexical_weight * score / best
+                documents[doc_id] = self.index.document(row)
+        if vector_hits:
+            best = max(similarity for _, _, similarity in vector_hits) or 1.0
+            for doc_id, document, similarity in vector_hits:
+                scores[doc_id] = scores.get(doc_id, 0.0) + (1 - self.lexical_weight) * similarity / best
+                documents.setdefault(doc_id, document)
+        ranked = sorted(scores, key=scores.get, reverse=True)[:self.k]
+        return [(doc_id, documents[doc_id]) for doc_id in ranked]
+
+    def _results(self, lexical, needs_vectors, embedded):
+        vector_hits = iter(self.vector_search(embedded, self.fetch_k) if embedded else [])
+        return [self._fuse(hits, next(vector_hits) if needs else None)
+                for hits, needs in zip(lexical, needs_vectors)]
+
+    def retrieve_many(self, questions):
+        """Returns the top k (id, Document) pairs of every question, embedding the ones that need it in one request."""
+        lexical, needs_vectors = self._plan(questions)
+        to_embed = [question for question, needs in zip(questions, needs_vectors) if needs]
+        embedded = self.embeddings.embed_documents(to_embed) if to_embed else []
+        return self._results(lexical, needs_vectors, embedded)
+
+    async def aretrieve_many(self, questions):
+        """Async version of retrieve_many."""
+        lexical, needs_vectors = self._plan(questions)
+        to_embed = [question for question, needs in zip(questions, needs_vectors) if needs]
+        embedded = await self.embeddings.aembed_documents(to_embed) if to_embed else []
+        # the vector search blocks, run it off the event loop
+        return await asyncio.to_thread(self._results, lexical, needs_vectors, embedded)
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        return [document for _, document in self.retrieve_many([query])[0]]
+
+    async def _aget_relevant_documents(self, query, *, run_manager=None):
+        return [document for _, document in (await self.aretrieve_many([query]))[0]]
+
+
+def benchmark(retriever, questions, repeat=5):
+    """Returns p50/p95 latency of retrieving each question, and how many skipped the embedding call."""
+    latencies = []
+    for _ in range(repeat):
+        for question in questions:
+            start = time.perf_counter()
+            retriever.retrieve_many([question])
+            latencies.append(time.perf_counter() - start)
+    _, needs_vectors = retriever._plan(questions)
+    latencies = np.array(latencies) * 1000
+    return {"questions": len(questions), "lexical_weight": retriever.lexical_weight,
+            "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+            "p95_ms": round(float(np.percentile(latencies, 95)), 3),
+            "embedding_calls_skipped": needs_vectors.count(False)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build and benchmark the BM25 index of RAG_DB.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build_parser = commands.add_parser("build", help="index every chunk of the Chroma collection of graph.py")
+    build_parser.add_argument("path", help="directory to write the index to")
+    update_parser = commands.add_parser("update", help="re-index the chunks that changed in the Chroma collection")
+    update_parser.add_argument("path")
+    bench_parser = commands.add_parser("bench", help="time retrieval through graph.py's retrieval settings")
+    bench_parser.add_argument("path")
+    bench_parser.add_argument("questions", nargs="?", help="text file with one question per line")
+    bench_parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    from metrics import configure_logging
+    configure_logging()
+
+    if args.command == "build":
+        import graph
+        start = time.perf_counter()
+        index = BM25Index.from_collection(graph.get_vectorstore()._collection)
+        index.save(args.path)
+        print(f"indexed {len(index)} chunks, {len(index.postings)} terms in {time.perf_counter() - start:.2f}s")
+    elif args.command == "update":
+        import graph
+        index = BM25Index.load(args.path)
+        upserted, deleted = index.sync(graph.get_vectorstore()._collection)
+        index.save(args.path)
+        print(f"re-indexed {upserted} chunks, removed {deleted}")
+    else:
+        os.environ["BM25_INDEX"] = args.path
+        # time the embedding calls themselves, not cache hits of the earlier repeats
+        os.environ.setdefault("EMBEDDING_CACHE", "0")
+        import graph
+        if args.questions:
+            with open(args.questions) as f:
+                questions = [line.strip() for line in f if line.strip()]
+        else:
+            questions = list(dict.fromkeys(text.split(".")[0] for text in graph.get_bm25_index().texts))[:50]
+        for weight in (0.0, 0.5, 1.0):
+            retriever = graph.get_hybrid_retriever(lexical_weight=weight)
+            print(json.dumps(benchmark(retriever, questions, args.repeat)))
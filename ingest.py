@@ -0,0 +1,220 @@
+"""Incremental ingestion of source documents into RAG_DB.
+
+Files (HTML, markdown and text) are read one at a time, split with
+RecursiveCharacterTextSplitter and identified by the sha256 of each chunk.
+Only chunks whose hash is not in the collection yet are embedded, in large
+batches with a bounded number of requests in flight; chunks that no source
+produces any more are deleted. A manifest next to RAG_DB remembers the
+size, mtime and hash of every file, so unchanged files are not even split.
+
+    python ingest.py docs/ --batch-size 256 --parallel 4
+    python ingest.py docs/ --dry-run
+
+The paths given are taken as the whole corpus: chunks of sources ingested
+before but not found under them now are deleted. Chunks that were not
+added by this tool (e.g. the original CSV import) are left alone unless
+--prune is given.
+"""
+import argparse
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bs4 import BeautifulSoup
+from langchain.text_splitter import Language, RecursiveCharacterTextSplitter
+
+EXTENSIONS = {".html": "html", ".htm": "html", ".md": "markdown", ".markdown": "markdown", ".txt": "text"}
+MANIFEST_VERSION = 1
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def find_sources(paths):
+    """Yields every supported file under paths, in a stable order."""
+    for path in paths:
+        if os.path.isfile(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if os.path.splitext(name)[1].lower() in EXTENSIONS:
+                    yield os.path.join(root, name)
+
+
+def load_text(path):
+    """Returns the text of a source file, with the markup of HTML files stripped."""
+    with open(path, encoding="utf-8", errors="replace") as f:
+        text = f.read()
+    if EXTENSIONS.get(os.path.splitext(path)[1].lower()) == "html":
+        soup = BeautifulSoup(text, "html.parser")
+        for tag in soup(["script", "style", "head", "nav", "footer"]):
+            tag.decompose()
+        text = soup.get_text("\n")
+    return text
+
+
+def splitter_for(path, chunk_size, chunk_overlap):
+    if EXTENSIONS.get(os.path.splitext(path)[1].lower()) == "markdown":
+        return RecursiveCharacterTextSplitter.from_language(Language.MARKDOWN, chunk_size=chunk_size,
+                                                            chunk_overlap=chunk_overlap)
+    return RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {"version": MANIFEST_VERSION, "sources": {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, path):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+class IngestStats:
+    """What one ingestion run did."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.files = 0
+        self.files_unchanged = 0
+        self.chunks = 0
+        self.chunks_embedded = 0
+        self.chunks_deleted = 0
+        self.embedding_requests = 0
+
+    def report(self):
+        return {
+            "files": self.files,
+            "files_unchanged": self.files_unchanged,
+            "chunks": self.chunks,
+            "chunks_embedded": self.chunks_embedded,
+            "chunks_deleted": self.chunks_deleted,
+            "embedding_requests": self.embedding_requests,
+            "seconds": round(time.perf_counter() - self.started, 3),
+        }
+
+
+def ingest(paths, collection, embeddings, manifest_path, chunk_size=1000, chunk_overlap=100,
+           batch_size=256, parallel=4, prune=False, dry_run=False):
+    """Brings collection up to date with the files under paths and returns the IngestStats.
+
+    Args:
+        paths: Files or directories to read sources from.
+        collection: The chromadb collection to upsert into and delete from.
+        embeddings: The LangChain Embeddings used for new chunks.
+        manifest_path: The JSON file remembering what every source produced.
+        chunk_size, chunk_overlap: The RecursiveCharacterTextSplitter settings.
+        batch_size: The number of chunks sent in one embeddings request.
+        parallel: The maximum number of embeddings requests in flight.
+        prune: Also delete chunks in the collection that no source produced.
+        dry_run: Report what would change without embedding or writing anything.
+    """
+    stats = IngestStats()
+    manifest = load_manifest(manifest_path)
+    previous = manifest["sources"]
+    sources = {}
+    # id -> (text, metadata) of every chunk that has to be in the collection
+    wanted = {}
+
+    for path in find_sources(paths):
+        stats.files += 1
+        stat = os.stat(path)
+        entry = previous.get(path)
+        if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            stats.files_unchanged += 1
+            sources[path] = entry
+            for chunk_id in entry["chunks"]:
+                wanted.setdefault(chunk_id, None)
+            continue
+
+        text = load_text(path)
+        file_hash = content_hash(text)
+        if entry and entry["hash"] == file_hash:
+            stats.files_unchanged += 1
+            sources[path] = dict(entry, size=stat.st_size, mtime=stat.st_mtime)
+            for chunk_id in entry["chunks"]:
+                wanted.setdefault(chunk_id, None)
+            continue
+
+        chunk_ids = []
+        for chunk in splitter_for(path, chunk_size, chunk_overlap).split_text(text):
+            chunk_id = content_hash(chunk)
+            chunk_ids.append(chunk_id)
+            if wanted.get(chunk_id) is None:
+                wanted[chunk_id] = (chunk, {"source": path, "content_hash": chunk_id})
+        sources[path] = {"size": stat.st_size, "mtime": stat.st_mtime, "hash": file_hash, "chunks": chunk_ids}
+
+    stats.chunks = len(wanted)
+    existing = set(collection.get(include=[])["ids"])
+    new_ids = [chunk_id for chunk_id, chunk in wanted.items() if chunk_id not in existing and chunk is not None]
+    if prune:
+        stale = existing - set(wanted)
+    else:
+        managed = {chunk_id for entry in previous.values() for chunk_id in entry["chunks"]}
+        stale = (managed & existing) - set(wanted)
+
+    batches = [new_ids[i:i + batch_size] for i in range(0, len(new_ids), batch_size)]
+    stats.embedding_requests = len(batches)
+    stats.chunks_embedded = len(new_ids)
+    stats.chunks_deleted = len(stale)
+    if dry_run:
+        return stats
+
+    def embed(batch):
+        return batch, embeddings.embed_documents([wanted[chunk_id][0] for chunk_id in batch])
+
+    with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+        # collection writes stay on this thread, one batch at a time in submission order
+        for batch, vectors in executor.map(embed, batches):
+            collection.upsert(ids=batch, embeddings=vectors,
+                              documents=[wanted[chunk_id][0] for chunk_id in batch],
+                              metadatas=[wanted[chunk_id][1] for chunk_id in batch])
+    if stale:
+        stale = sorted(stale)
+        for i in range(0, len(stale), batch_size):
+            collection.delete(ids=stale[i:i + batch_size])
+
+    manifest["sources"] = sources
+    save_manifest(manifest, manifest_path)
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Add, update and remove RAG_DB chunks from source documents.")
+    parser.add_argument("paths", nargs="+", help="files or directories of .html, .md and .txt documents")
+    parser.add_argument("--manifest", default="RAG_DB_ingest.json", help="file remembering what every source produced")
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--chunk-overlap", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=256, help="chunks per embeddings request")
+    parser.add_argument("--parallel", type=int, default=4, help="embeddings requests in flight")
+    parser.add_argument("--prune", action="store_true", help="also delete chunks no source produced, e.g. old imports")
+    parser.add_argument("--dry-run", action="store_true", help="only report what would change")
+    args = parser.parse_args()
+    from metrics import configure_logging
+    configure_logging()
+
+    import graph
+    collection = graph.get_vectorstore()._collection
+    stats = ingest(args.paths, collection, graph.get_embedding_model(), args.manifest,
+                   chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap, batch_size=args.batch_size,
+                   parallel=args.parallel, prune=args.prune, dry_run=args.dry_run)
+    report = stats.report()
+
+    if not args.dry_run and (report["chunks_embedded"] or report["chunks_deleted"]):
+        if os.path.exists(os.path.join(graph.BM25_INDEX, "postings.npz")):
+            from hybrid_retriever import BM25Index
+            index = BM25Index.load(graph.BM25_INDEX)
+            report["bm25_upserted"], report["bm25_deleted"] = index.sync(collection)
+            index.save(graph.BM25_INDEX)
+        if graph.VECTOR_INDEX:
+            print(f"---RAG_DB CHANGED, RUN: python vector_index.py export {graph.VECTOR_INDEX}---")
+    print(json.dumps(report))
@@ -0,0 +1,228 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from langchain_core.runnables import RunnableLambda
+
+
+def template_hash(prompt, model=None):
+    """Hashes the prompt template and the model settings, so cached results die with either."""
+    text = prompt.template
+    if model is not None:
+        text += "\0" + json.dumps(model, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+def normalize_inputs(inputs, input_variables):
+    """Returns the prompt variables with unicode and whitespace normalized."""
+    normalized = {}
+    for name in sorted(input_variables):
+        value = inputs.get(name)
+        if isinstance(value, str):
+            value = " ".join(unicodedata.normalize("NFC", value).split())
+        normalized[name] = value
+    return normalized
+
+
+def cache_key(chain_name, prompt_hash, normalized_inputs):
+    payload = json.dumps(normalized_inputs, sort_keys=True, default=str)
+    digest = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    return f"{chain_name}:{prompt_hash}:{digest}"
+
+
+class InMemoryCacheBackend:
+    """Process-local LRU backend."""
+
+    # get and set never wait on I/O, async callers may use them on the event loop
+    blocking = False
+
+    def __init__(self, max_items=4096):
+        self.max_items = max_items
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at is not None and expires_at < time.time():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            self._items[key] = (value, expires_at)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def invalidate(self, chain_name, prompt_hash):
+        """Drops the entries of chain_name written for any other template."""
+        prefix = f"{chain_name}:"
+        current = f"{chain_name}:{prompt_hash}:"
+        with self._lock:
+            for key in [key for key in self._items if key.startswith(prefix) and not key.startswith(current)]:
+                del self._items[key]
+
+
+class SQLiteCacheBackend:
+    """SQLite backend, shared by every worker process on the host."""
+
+    # async callers run get and set in a thread
+    blocking = True
+
+    def __init__(self, path=".llm_cache/llm_cache.sqlite3"):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            "key TEXT PRIMARY KEY, chain_name TEXT NOT NULL, prompt_hash TEXT NOT NULL, "
+            "value TEXT NOT NULL, expires_at REAL)"
+        )
+        self._db.execute("DELETE FROM llm_cache WHERE expires_at IS NOT NULL AND expires_at < ?", (time.time(),))
+        self._db.commit()
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute("SELECT value, expires_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        value, expires_at = row
+        if expires_at is not None and expires_at < time.time():
+            return None
+        return json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        chain_name, prompt_hash, _ = key.split(":", 2)
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, chain_name, prompt_hash, value, expires_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, chain_name, prompt_hash, json.dumps(value), expires_at),
+            )
+            self._db.commit()
+
+    def invalidate(self, chain_name, prompt_hash):
+        """Drops the entries of chain_name written for any other template."""
+        with self._lock:
+            self._db.execute("DELETE FROM llm_cache WHERE chain_name = ? AND prompt_hash != ?",
+                             (chain_name, prompt_hash))
+            self._db.commit()
+
+
+class LLMCache:
+    """Caches the results of deterministic chains.
+
+    Results are keyed on the chain name, the hash of the prompt template and
+    model settings, and the normalized prompt variables. A hit returns the stored result without
+    calling the chain at all. Results whose cacheable attribute is False,
+    like the default a parser falls back to, are returned but not stored.
+    """
+
+    def __init__(self, backend, ttl=None):
+        self.backend = backend
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def _count(self, chain_name, outcome):
+        with self._lock:
+            counts = self._stats.setdefault(chain_name, {"hits": 0, "misses": 0})
+            counts[outcome] += 1
+
+    def wrap(self, chain_name, prompt, chain, ttl=None, cacheable=None, model=None):
+        """Returns chain with a cache lookup in front of invoke and ainvoke.
+
+        Args:
+            chain_name: Names the chain in the cache keys and the hit counters.
+            prompt: The chain's prompt, whose template hash is part of the keys.
+            chain: The chain to cache the results of.
+            ttl: Seconds a result stays valid; None for the cache's ttl.
+            cacheable: Optional check of a result; False keeps it out of the cache.
+            model: The model settings chain generates with (e.g. ModelSpec.to_dict());
+                results cached under other settings are not served and are dropped.
+        """
+        prompt_hash = template_hash(prompt, model)
+        ttl = ttl if ttl is not None else self.ttl
+        self.backend.invalidate(chain_name, prompt_hash)
+
+        def _key(inputs):
+            return cache_key(chain_name, prompt_hash, normalize_inputs(inputs, prompt.input_variables))
+
+        def _store(key, result):
+            if getattr(result, "cacheable", True) and (cacheable is None or cacheable(result)):
+                self.backend.set(key, result, ttl)
+
+        def _invoke(inputs, config):
+            key = _key(inputs)
+            cached = self.backend.get(key)
+            if cached is not None:
+                self._count(chain_name, "hits")
+                return cached
+            self._count(chain_name, "misses")
+            result = chain.invoke(inputs, config)
+            _store(key, result)
+            return result
+
+        async def _ainvoke(inputs, config):
+            key = _key(inputs)
+            if self.backend.blocking:
+                cached = await asyncio.to_thread(self.backend.get, key)
+            else:
+                cached = self.backend.get(key)
+            if cached is not None:
+                self._count(chain_name, "hits")
+                return cached
+            self._count(chain_name, "misses")
+            result = await chain.ainvoke(inputs, config)
+            if self.backend.blocking:
+                await asyncio.to_thread(_store, key, result)
+            else:
+                _store(key, result)
+            return result
+
+        return RunnableLambda(_invoke, afunc=_ainvoke, name=chain_name)
+
+    def stats(self):
+        """Returns the hit/miss counters per chain."""
+        with self._lock:
+            return {name: dict(counts) for name, counts in self._stats.items()}
+
+
+class NoCache(LLMCache):
+    """Stand-in used when caching is switched off; wrap only names the chain after chain_name."""
+
+    def __init__(self):
+        super().__init__(backend=None)
+
+    def wrap(self, chain_name, prompt, chain, ttl=None, cacheable=None, model=None):
+        return chain.with_config(run_name=chain_name)
+
+
+def cache_from_env():
+    """Builds the LLM cache selected by the LLM_CACHE environment variable."""
+    backend_name = os.getenv("LLM_CACHE", "memory")
+    ttl = int(os.getenv("LLM_CACHE_TTL", "86400")) or None
+    if backend_name == "off":
+        return NoCache()
+    if backend_name == "sqlite":
+        backend = SQLiteCacheBackend(os.getenv("LLM_CACHE_PATH", ".llm_cache/llm_cache.sqlite3"))
+    elif backend_name == "memory":
+        backend = InMemoryCacheBackend(int(os.getenv("LLM_CACHE_MAX_ITEMS", "4096")))
+    else:
+        raise ValueError(f"Unknown LLM_CACHE backend: {backend_name!r}")
+    return LLMCache(backend, ttl=ttl)
@@ -1,8 +1,25 @@
-from fastapi import FastAPI
-from langserve import add_routes
+import json
+import logging
+import os
+import uuid
 
+from startup import report, timed
 
-from graph import graph_app
+with timed("import fastapi"):
+    from fastapi import FastAPI, HTTPException, Query, Request
+    from fastapi.responses import PlainTextResponse, StreamingResponse
+    from langserve import add_routes
+
+
+with timed("import graph"):
+    from graph import aclose_checkpointer, get_category_classifier, get_checkpointed_app, graph_app, run_store, warm_up
+from bulk import BulkStats, RateLimiter, process_emails
+from checkpoints import acompact_thread, aplan_run, arun_status, thread_config
+from metrics import configure_logging, metrics
+from run_store import ProjectedGraph, aproject, parse_fields
+from streaming import OUTPUT_FIELDS, stream_progress
+
+log = logging.getLogger(__name__)
 
 app = FastAPI(
     title="LangChain Server",
@@ -10,7 +27,224 @@ app = FastAPI(
     description="A simple api server using Langchain's Runnable interfaces",
 )
 
+
+
+def _output_fields(config, request):
+    """Reads the ?fields= projection of /invoke, /batch and /stream into the run config."""
+    fields = request.query_params.get("fields")
+    if fields:
+        config.setdefault("configurable", {})["output_fields"] = parse_fields(fields, None)
+    return config
+
+
+# clients get the whole state, references resolved, unless they pick fields with
+# ?fields=final_email,email_category; research_info and the other large fields are
+# then looked up in the run store only when asked for
 add_routes(
     app,
-    graph_app
+    ProjectedGraph(graph_app, run_store),
+    per_req_config_modifier=_output_fields,
 )
+
+
+@app.on_event("startup")
+def warm_up_graph():
+    """Opens the vector store and loads its HNSW segment before the first request is served.
+
+    Set WARM_UP=0 to skip this and build everything on first use instead.
+    """
+    # LOG_LEVEL=INFO shows the progress of every node, DEBUG also the chain outputs
+    configure_logging()
+    if os.getenv("WARM_UP", "1") == "1":
+        with timed("warm_up"):
+            warm_up()
+            get_checkpointed_app()
+    log.info("---STARTUP TIMINGS--- %s", json.dumps(report()))
+
+
+@app.on_event("shutdown")
+def save_exemplars():
+    """Saves the exemplars the local classifier learned since its last save."""
+    if get_category_classifier.is_built() and get_category_classifier() is not None:
+        get_category_classifier().flush()
+
+
+@app.on_event("shutdown")
+async def close_checkpointer():
+    """Closes the checkpoint database, so the server process can exit."""
+    await aclose_checkpointer()
+
+
+@app.get("/startup")
+def startup_timings():
+    """Returns how long each import and resource took to load, in seconds."""
+    return report()
+
+
+@app.get("/metrics")
+def metrics_endpoint(format: str = "prometheus"):
+    """Returns the node, chain, LLM and retriever latency histograms, token counters and cache hit rates.
+
+    The Prometheus text format is returned by default, ?format=json gives the
+    same numbers with p50/p95/p99 estimated from the histogram buckets.
+    """
+    if format == "json":
+        return metrics.snapshot()
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+# shared by every /bulk request of this process so they stay under the Groq limits together
+bulk_limiter = RateLimiter.from_env()
+
+
+@app.post("/bulk")
+async def bulk(request: Request, concurrency: int = Query(8, ge=1)):
+    """Runs a JSONL body of emails through the graph and streams JSONL results as they finish.
+
+    The last line holds the throughput report under the "stats" key.
+    """
+    # read the body up front: once the response starts streaming, starlette
+    # listens on the same channel for client disconnects
+    body = await request.body()
+    try:
+        emails = [json.loads(line) for line in body.splitlines() if line.strip()]
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid JSONL body: {e}")
+
+    async def results():
+        stats = BulkStats()
+        async for result in process_emails(emails, app=graph_app,
+                                           limiter=bulk_limiter, concurrency=concurrency, stats=stats):
+            yield json.dumps(result) + "\n"
+        yield json.dumps({"stats": stats.report()}) + "\n"
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
+
+def _fields(body):
+    fields = body.get("fields")
+    if isinstance(fields, list):
+        return [str(field) for field in fields]
+    return parse_fields(fields if isinstance(fields, str) else None, OUTPUT_FIELDS)
+
+
+async def _output(values, fields):
+    return await aproject(run_store, values, fields)
+
+
+def _thread_id(body):
+    return str(body.get("thread_id") or uuid.uuid4().hex)
+
+
+async def _read_email_body(request):
+    try:
+        body = await request.json()
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid JSON body: {e}")
+    if not isinstance(body, dict):
+        raise HTTPException(status_code=400, detail="The body needs to be a JSON object")
+    return body
+
+
+def _email_inputs(body):
+    if not isinstance(body.get("initial_email"), str):
+        return None
+    inputs = {"initial_email": body["initial_email"], "num_steps": 0}
+    if body.get("run_id"):
+        inputs["run_id"] = str(body["run_id"])
+    return inputs
+
+
+async def _compact(app, thread_id):
+    if app.checkpointer is not None:
+        await acompact_thread(app.checkpointer, thread_id)
+
+
+@app.post("/run_email")
+async def run_email(request: Request):
+    """Runs one email through the checkpointed graph and returns the result.
+
+    The body is {"initial_email": ..., "thread_id": ..., "run_id": ..., "fields": [...]}
+    with optional thread_id, run_id and fields (the state fields to return,
+    OUTPUT_FIELDS by default, "*" for all). A failed run answers 502 with its thread_id;
+    sending the same thread_id again resumes it from the last completed node
+    (initial_email can then be left out), and a thread that already finished
+    returns its saved result without running anything.
+    """
+    body = await _read_email_body(request)
+    checkpointed_app = get_checkpointed_app()
+    thread_id = _thread_id(body)
+    inputs, status = await aplan_run(checkpointed_app, _email_inputs(body), thread_id)
+    if status == "new" and inputs is None:
+        raise HTTPException(status_code=400, detail="The body needs an initial_email string")
+    try:
+        if status == "completed":
+            output = (await checkpointed_app.aget_state(thread_config(thread_id))).values
+        else:
+            output = await checkpointed_app.ainvoke(inputs, thread_config(thread_id))
+            await _compact(checkpointed_app, thread_id)
+    except Exception as e:
+        log.warning("---RUN FAILED--- thread %s: %r", thread_id, e)
+        detail = {"thread_id": thread_id, "error": repr(e), "resumable": checkpointed_app.checkpointer is not None}
+        if checkpointed_app.checkpointer is not None:
+            detail["completed_nodes"] = (await arun_status(checkpointed_app, thread_id))["completed_nodes"]
+        raise HTTPException(status_code=502, detail=detail)
+    return {"thread_id": thread_id, "status": status, **(await _output(output, _fields(body)))}
+
+
+@app.get("/runs/{thread_id}")
+async def run_status(thread_id: str, fields: str = ""):
+    """Returns the status ("completed", "interrupted" or "unknown"), completed and next nodes of a checkpointed run.
+
+    ?fields= picks the state fields of its output like the body of /run_email does.
+    """
+    checkpointed_app = get_checkpointed_app()
+    if checkpointed_app.checkpointer is None:
+        raise HTTPException(status_code=404, detail="Checkpoints are disabled (CHECKPOINTS=0)")
+    status = await arun_status(checkpointed_app, thread_id)
+    values = status.pop("values")
+    if status["status"] == "unknown":
+        raise HTTPException(status_code=404, detail=f"No run with thread_id {thread_id}")
+    status["output"] = await _output(values, parse_fields(fields, OUTPUT_FIELDS))
+    return status
+
+
+@app.post("/stream_email")
+async def stream_email(request: Request):
+    """Runs one email through the graph and streams its progress as JSONL events.
+
+    The body is {"initial_email": ..., "thread_id": ..., "run_id": ..., "fields": [...]}
+    with optional thread_id, run_id and fields. Node start/end events arrive as the graph
+    moves, the draft and final email text arrive token by token, and the last
+    line is the "end" event holding the result and the thread_id. Like
+    /run_email, a retry with the thread_id of a failed stream resumes it.
+    """
+    body = await _read_email_body(request)
+    checkpointed_app = get_checkpointed_app()
+    thread_id = _thread_id(body)
+    inputs, status = await aplan_run(checkpointed_app, _email_inputs(body), thread_id)
+    if status == "new" and inputs is None:
+        raise HTTPException(status_code=400, detail="The body needs an initial_email string")
+    fields = _fields(body)
+
+    async def events():
+        try:
+            if status == "completed":
+                values = (await checkpointed_app.aget_state(thread_config(thread_id))).values
+                output = await _output(values, fields)
+                yield json.dumps({"event": "end", "output": output, "thread_id": thread_id}) + "\n"
+                return
+            async for event in stream_progress(checkpointed_app, inputs, thread_config(thread_id),
+                                               output=lambda values: values):
+                if event["event"] == "end":
+                    event["output"] = await _output(event["output"], fields)
+                    event["thread_id"] = thread_id
+                    await _compact(checkpointed_app, thread_id)
+                yield json.dumps(event) + "\n"
+        except Exception as e:
+            log.warning("---RUN FAILED--- thread %s: %r", thread_id, e)
+            yield json.dumps({"event": "error", "error": repr(e), "thread_id": thread_id,
+                              "resumable": checkpointed_app.checkpointer is not None}) + "\n"
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
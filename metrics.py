@@ -0,0 +1,310 @@
+"""Process-wide metrics and logging setup for the email assistant.
+
+Latency histograms, counters and the gauges of registered collectors are
+served by main.py on /metrics in the Prometheus text format (or as JSON
+with ?format=json):
+
+    node_latency_seconds{node}          every graph node and routing edge
+    chain_latency_seconds{chain}        the named chains of graph.py
+    llm_latency_seconds{chain,model}    the LLM calls made inside each chain
+    llm_prompt_tokens_total{chain,model}, llm_completion_tokens_total{chain,model}
+    retriever_latency_seconds{retriever}
+    dedup_similarity                    similarity of the closest earlier email, see dedup.py
+    *_hit_rate and other gauges of the caches
+
+Log records carry the trace id of the graph run they belong to.
+"""
+import contextvars
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from tokens import count_tokens
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# trace id of the graph run the current node belongs to, see graph._node
+trace_id_var = contextvars.ContextVar("trace_id", default="-")
+
+
+class Histogram:
+    """Cumulative-bucket histogram like Prometheus's."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile; inf when it is past the last bucket."""
+        if not self.count:
+            return 0.0
+        for bound, count in zip(self.buckets, self.counts):
+            if count >= q * self.count:
+                return bound
+        return float("inf")
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{str(value)}"' for key, value in pairs) + "}"
+
+
+class Metrics:
+    """Thread-safe registry of histograms, counters and collector gauges."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.collectors = []
+        # histogram name -> buckets, for histograms of something other than latencies
+        self.buckets = {}
+        # raw observations per histogram key, only kept once keep_samples() was called
+        self.samples = None
+
+    def set_buckets(self, name, buckets):
+        """Uses buckets instead of LATENCY_BUCKETS for the name histogram."""
+        with self._lock:
+            self.buckets[name] = tuple(buckets)
+
+    def observe(self, name, seconds, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets.get(name, LATENCY_BUCKETS))
+            histogram.observe(seconds)
+            if self.samples is not None:
+                self.samples.setdefault(key, []).append(seconds)
+
+    def keep_samples(self):
+        """Keeps every observation from now on, for exact percentiles in benchmarks; memory grows with each one."""
+        with self._lock:
+            if self.samples is None:
+                self.samples = {}
+
+    def samples_of(self, name, label):
+        """Returns {value of label: observations} of the name histogram, see keep_samples."""
+        with self._lock:
+            return {dict(labels).get(label): list(values) for (key_name, labels), values in (self.samples or {}).items()
+                    if key_name == name}
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    @contextmanager
+    def time(self, name, **labels):
+        """Observes how long the block took in the name histogram."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def add_collector(self, collect):
+        """Registers a function returning {gauge name: value} or {(gauge name, ((label, value), ...)): value}, called on every scrape."""
+        self.collectors.append(collect)
+
+    def _gauges(self):
+        gauges = {}
+        for collect in self.collectors:
+            try:
+                values = collect()
+            except Exception as e:
+                logging.getLogger(__name__).warning("metrics collector failed: %r", e)
+                continue
+            for key, value in values.items():
+                name, labels = key if isinstance(key, tuple) else (key, ())
+                gauges[(name, _labels(dict(labels)))] = value
+        return gauges
+
+    def snapshot(self):
+        """Returns every metric as plain JSON-able dicts; histograms as count, sum and bucket quantiles."""
+        with self._lock:
+            histograms = {key: (h.count, h.sum, h.quantile(0.5), h.quantile(0.95), h.quantile(0.99))
+                          for key, h in self.histograms.items()}
+            counters = dict(self.counters)
+        key_name = lambda key: key[0] + _format_labels(key[1])
+        return {
+            "histograms": {key_name(key): {"count": count, "sum": round(total, 6), "p50": p50, "p95": p95, "p99": p99}
+                           for key, (count, total, p50, p95, p99) in sorted(histograms.items())},
+            "counters": {key_name(key): value for key, value in sorted(counters.items())},
+            "gauges": {key_name(key): value for key, value in sorted(self._gauges().items())},
+        }
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            histograms = sorted((key, list(h.counts), h.count, h.sum, h.buckets) for key, h in self.histograms.items())
+            counters = sorted(self.counters.items())
+        typed = set()
+        for (name, labels), counts, count, total, buckets in histograms:
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            for bound, bucket_count in zip(buckets, counts):
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {bucket_count}")
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+        for (name, labels), value in sorted(self._gauges().items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} gauge")
+                typed.add(name)
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+            self.counters.clear()
+            if self.samples is not None:
+                self.samples = {}
+
+
+metrics = Metrics()
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """Records chain, LLM and retriever latencies and token counts from LangChain callbacks.
+
+    Chains are only timed when their run name is in chain_names; LLM calls
+    are attributed to the closest such chain they run under, and labelled
+    with the model that served them.
+    """
+
+    run_inline = True
+
+    def __init__(self, chain_names):
+        self.chain_names = set(chain_names)
+        self._lock = threading.Lock()
+        # run_id -> (name, parent_run_id, start time)
+        self._runs = {}
+        # LLM run_id -> prompt messages, to estimate the tokens when the provider reports none
+        self._prompts = {}
+
+    def _start(self, run_id, parent_run_id, name):
+        with self._lock:
+            self._runs[run_id] = (name, parent_run_id, time.perf_counter())
+
+    def _end(self, run_id):
+        with self._lock:
+            return self._runs.pop(run_id, None)
+
+    def _chain_of(self, run_id):
+        with self._lock:
+            while run_id is not None and run_id in self._runs:
+                name, parent_run_id, _ = self._runs[run_id]
+                if name in self.chain_names:
+                    return name
+                run_id = parent_run_id
+        return "other"
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, **kwargs):
+        self._start(run_id, parent_run_id, kwargs.get("name"))
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        run = self._end(run_id)
+        if run is not None and run[0] in self.chain_names:
+            metrics.observe("chain_latency_seconds", time.perf_counter() - run[2], chain=run[0])
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        run = self._end(run_id)
+        if run is not None and run[0] in self.chain_names:
+            metrics.inc("chain_errors_total", chain=run[0])
+
+    @staticmethod
+    def _model(kwargs):
+        return (kwargs.get("metadata") or {}).get("ls_model_name") or "unknown"
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, **kwargs):
+        # an LLM run's name is the model, which is never one of chain_names
+        self._start(run_id, parent_run_id, self._model(kwargs))
+        self._prompts[run_id] = messages
+
+    def on_llm_start(self, serialized, prompts, *, run_id, parent_run_id=None, **kwargs):
+        self._start(run_id, parent_run_id, self._model(kwargs))
+        self._prompts[run_id] = prompts
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        chain = self._chain_of(run_id)
+        run = self._end(run_id)
+        prompt = self._prompts.pop(run_id, None)
+        model = run[0] if run is not None else "unknown"
+        if run is not None:
+            metrics.observe("llm_latency_seconds", time.perf_counter() - run[2], chain=chain, model=model)
+
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        prompt_tokens, completion_tokens = usage.get("prompt_tokens"), usage.get("completion_tokens")
+        generations = [generation for generations in response.generations for generation in generations]
+        for generation in generations:
+            usage_metadata = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if usage_metadata and prompt_tokens is None:
+                prompt_tokens, completion_tokens = usage_metadata["input_tokens"], usage_metadata["output_tokens"]
+        if prompt_tokens is None:
+            prompt_tokens = count_tokens(str(prompt or ""))
+            completion_tokens = sum(count_tokens(generation.text) for generation in generations)
+        metrics.inc("llm_prompt_tokens_total", prompt_tokens, chain=chain, model=model)
+        metrics.inc("llm_completion_tokens_total", completion_tokens, chain=chain, model=model)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        chain = self._chain_of(run_id)
+        run = self._end(run_id)
+        self._prompts.pop(run_id, None)
+        metrics.inc("llm_errors_total", chain=chain, model=run[0] if run is not None else "unknown")
+
+    def on_retriever_start(self, serialized, query, *, run_id, parent_run_id=None, **kwargs):
+        self._start(run_id, parent_run_id, kwargs.get("name") or (serialized or {}).get("name") or "retriever")
+
+    def on_retriever_end(self, documents, *, run_id, **kwargs):
+        run = self._end(run_id)
+        if run is not None:
+            metrics.observe("retriever_latency_seconds", time.perf_counter() - run[2], retriever=run[0])
+
+    def on_retriever_error(self, error, *, run_id, **kwargs):
+        self._end(run_id)
+
+
+class TraceIdFilter(logging.Filter):
+    """Adds the trace id of the current graph run to log records."""
+
+    def filter(self, record):
+        record.trace_id = trace_id_var.get()
+        return True
+
+
+def configure_logging(level=None):
+    """Sets up the root logger from LOG_LEVEL (default WARNING), with the trace id in every line."""
+    handler = logging.StreamHandler()
+    handler.addFilter(TraceIdFilter())
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(trace_id)s] %(name)s: %(message)s"))
+    root = logging.getLogger()
+    if not any(isinstance(f, TraceIdFilter) for h in root.handlers for f in h.filters):
+        root.addHandler(handler)
+    root.setLevel(level or os.getenv("LOG_LEVEL", "WARNING").upper())
@@ -0,0 +1,226 @@
+"""Model registry for the LLM chains of graph.py.
+
+Each chain gets its own model, max_tokens and temperature. By default the
+one-word decisions (the categorizer and the research and rewrite routers)
+run on a small, fast model and escalate to the large model when the small
+model's output does not validate; every other chain uses the large model.
+
+The defaults can be changed with MODEL_REGISTRY, a JSON file (or inline
+JSON) like:
+
+    {
+      "default": {"model": "llama3-70b-8192"},
+      "chains": {
+        "research_router": {"model": "llama3-8b-8192", "max_tokens": 32,
+                            "temperature": 0, "escalate_to": "llama3-70b-8192"},
+        "draft_writer_chain": {"temperature": 0.5}
+      }
+    }
+
+Chain entries override the built-in entry of that chain; fields they leave
+out come from "default". MODEL_TIERING=0 drops the built-in small-model
+entries, so every chain not listed in MODEL_REGISTRY uses the default model.
+"""
+import json
+import logging
+import os
+import threading
+
+from langchain_core.exceptions import OutputParserException
+from langchain_core.runnables import Runnable
+
+from metrics import metrics
+
+log = logging.getLogger(__name__)
+
+LARGE_MODEL = "llama3-70b-8192"
+SMALL_MODEL = "llama3-8b-8192"
+
+# built-in tiers: chains answering with a single label or router decision
+DEFAULT_CHAIN_SPECS = {
+    "email_category_generator": {"model": SMALL_MODEL, "max_tokens": 16, "temperature": 0,
+                                 "escalate_to": LARGE_MODEL},
+    "research_router": {"model": SMALL_MODEL, "max_tokens": 32, "temperature": 0, "escalate_to": LARGE_MODEL},
+    "rewrite_router": {"model": SMALL_MODEL, "max_tokens": 32, "temperature": 0, "escalate_to": LARGE_MODEL},
+}
+
+
+class ModelSpec:
+    """The model and generation settings of a chain.
+
+    Args:
+        model: The provider's model name.
+        max_tokens: The most tokens the model may generate; None for the provider default.
+        temperature: The sampling temperature; None for the provider default.
+        escalate_to: The model retried with when this model's output fails
+            validation, or None to accept it as it is.
+    """
+
+    def __init__(self, model=LARGE_MODEL, max_tokens=None, temperature=None, escalate_to=None):
+        self.model = model
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.escalate_to = escalate_to
+
+    @property
+    def key(self):
+        """Identifies the LLM client the spec needs; specs with equal keys share one."""
+        return (self.model, self.max_tokens, self.temperature)
+
+    def escalated(self):
+        """The spec of the escalation model, with this spec's generation settings."""
+        return ModelSpec(self.escalate_to, self.max_tokens, self.temperature)
+
+    def llm_kwargs(self):
+        """Keyword arguments for the chat model client."""
+        kwargs = {"model": self.model}
+        if self.max_tokens is not None:
+            kwargs["max_tokens"] = self.max_tokens
+        if self.temperature is not None:
+            kwargs["temperature"] = self.temperature
+        return kwargs
+
+    def to_dict(self):
+        return {"model": self.model, "max_tokens": self.max_tokens,
+                "temperature": self.temperature, "escalate_to": self.escalate_to}
+
+    def __repr__(self):
+        return f"ModelSpec({self.to_dict()!r})"
+
+
+class ModelRegistry:
+    """Looks up the ModelSpec of each chain.
+
+    Args:
+        default: The spec of chains without an entry of their own.
+        chains: Chain name -> dict of ModelSpec fields; missing fields, except
+            escalate_to, are taken from default.
+    """
+
+    def __init__(self, default=None, chains=None):
+        self.default = default or ModelSpec()
+        self.chains = {name: self._spec(fields) for name, fields in (chains or {}).items()}
+
+    def _spec(self, fields):
+        unknown = set(fields) - {"model", "max_tokens", "temperature", "escalate_to"}
+        if unknown:
+            raise ValueError(f"Unknown model registry fields: {sorted(unknown)}")
+        return ModelSpec(
+            model=fields.get("model", self.default.model),
+            max_tokens=fields.get("max_tokens", self.default.max_tokens),
+            temperature=fields.get("temperature", self.default.temperature),
+            escalate_to=fields.get("escalate_to"),
+        )
+
+    @classmethod
+    def from_env(cls):
+        config = os.getenv("MODEL_REGISTRY", "").strip()
+        if config and not config.startswith("{"):
+            with open(config) as f:
+                config = f.read()
+        config = json.loads(config) if config else {}
+        default = dict(config.get("default") or {})
+        default.setdefault("model", os.getenv("LLM_MODEL", LARGE_MODEL))
+        chains = dict(DEFAULT_CHAIN_SPECS) if os.getenv("MODEL_TIERING", "1") == "1" else {}
+        chains.update(config.get("chains") or {})
+        return cls(ModelSpec(**default), chains)
+
+    def spec(self, chain_name):
+        return self.chains.get(chain_name, self.default)
+
+    def specs(self):
+        """Every spec an LLM client may be built for, escalation models included."""
+        specs = [self.default]
+        for spec in self.chains.values():
+            specs.append(spec)
+            if spec.escalate_to:
+                specs.append(spec.escalated())
+        return list({spec.key: spec for spec in specs}.values())
+
+    def to_dict(self):
+        return {"default": self.default.to_dict(),
+                "chains": {name: spec.to_dict() for name, spec in sorted(self.chains.items())}}
+
+
+class EscalatingChain(Runnable):
+    """Runs the tiers of a chain in turn until one's output validates.
+
+    Every tier but the last must raise OutputParserException, or fail
+    validate, on output it cannot stand behind; the last tier's output is
+    returned as it is.
+
+    Args:
+        name: The chain the tiers belong to, used for the escalation metrics.
+        tiers: (model name, runnable) pairs, the runnable being the tier's LLM
+            followed by its output parser.
+        validate: Optional check of a parsed output; False escalates it.
+    """
+
+    def __init__(self, name, tiers, validate=None):
+        self.name = name
+        self.tiers = tiers
+        self.validate = validate
+        self._lock = threading.Lock()
+        self._calls = 0
+        self._escalations = 0
+
+    @property
+    def InputType(self):
+        return self.tiers[0][1].InputType
+
+    @property
+    def OutputType(self):
+        return self.tiers[-1][1].OutputType
+
+    def _check(self, output):
+        return None if self.validate is None or self.validate(output) else "invalid"
+
+    def _escalate(self, model, reason):
+        with self._lock:
+            self._escalations += 1
+        metrics.inc("llm_escalations_total", chain=self.name, reason=reason)
+        log.info("---ESCALATING--- %s output of %s was %s", self.name, model, reason)
+
+    def _count_call(self):
+        with self._lock:
+            self._calls += 1
+
+    def invoke(self, input, config=None, **kwargs):
+        self._count_call()
+        for model, tier in self.tiers[:-1]:
+            try:
+                output = tier.invoke(input, config, **kwargs)
+            except OutputParserException:
+                reason = "parse_error"
+            else:
+                reason = self._check(output)
+                if reason is None:
+                    return output
+            self._escalate(model, reason)
+        return self.tiers[-1][1].invoke(input, config, **kwargs)
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        self._count_call()
+        for model, tier in self.tiers[:-1]:
+            try:
+                output = await tier.ainvoke(input, config, **kwargs)
+            except OutputParserException:
+                reason = "parse_error"
+            else:
+                reason = self._check(output)
+                if reason is None:
+                    return output
+            self._escalate(model, reason)
+        return await self.tiers[-1][1].ainvoke(input, config, **kwargs)
+
+    def stats(self):
+        """Returns the calls and escalations so far."""
+        with self._lock:
+            return {"calls": self._calls, "escalations": self._escalations}
+
+
+def strict(parser):
+    """Copy of a RepairingJsonOutputParser raising instead of falling back to its default."""
+    if getattr(parser, "default", None) is None:
+        return parser
+    return parser.model_copy(update={"default": None})
@@ -0,0 +1,232 @@
+"""Cross-encoder reranking of the chunks retrieved for the RAG chain.
+
+The retriever over-fetches fetch_k candidate chunks per question, and
+Reranker scores every (question, chunk) pair of an email in one batched
+pass of a local CPU cross-encoder. Per question it keeps the best chunks
+that score at least threshold, as long as they fit in token_budget tokens,
+so rag_prompt gets fewer, more relevant chunks than the top k of the
+vector search. A chunk retrieved more than once for the same question is
+only scored once.
+
+    python reranker.py bench questions.txt
+
+times the reranker on the CPU and compares the rag_prompt tokens of the
+reranked chunks with those of the plain top k, through graph.py's
+retrieval settings.
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+from metrics import configure_logging, metrics
+from tokens import count_tokens
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+# the same models exported for fastembed's ONNX runtime
+FASTEMBED_MODELS = {
+    "cross-encoder/ms-marco-MiniLM-L-6-v2": "Xenova/ms-marco-MiniLM-L-6-v2",
+    "cross-encoder/ms-marco-MiniLM-L-12-v2": "Xenova/ms-marco-MiniLM-L-12-v2",
+}
+
+
+def load_cross_encoder(model_name, batch_size=64):
+    """Returns a function scoring (query, text) pairs from 0 to 1 on the CPU, or None when no backend is installed."""
+    try:
+        from sentence_transformers import CrossEncoder
+        model = CrossEncoder(model_name, device="cpu")
+        # single-label models end in a sigmoid
+        return lambda pairs: np.asarray(model.predict(pairs, batch_size=batch_size, show_progress_bar=False),
+                                        dtype=np.float32)
+    except ImportError:
+        pass
+    try:
+        from fastembed.rerank.cross_encoder import TextCrossEncoder
+        model = TextCrossEncoder(model_name=FASTEMBED_MODELS.get(model_name, model_name))
+        # fastembed returns the logits
+        return lambda pairs: 1 / (1 + np.exp(-np.array(list(model.rerank_pairs(pairs, batch_size=batch_size)),
+                                                          dtype=np.float32)))
+    except ImportError:
+        return None
+
+
+class Reranker:
+    """Keeps the chunks a cross-encoder finds relevant to each question.
+
+    Args:
+        model_name: The cross-encoder, a sentence_transformers model name.
+        threshold: The score from 0 to 1 a chunk needs to be kept.
+        token_budget: The most tokens of chunks kept per question.
+        min_keep: Chunks kept per question whatever their score and size, so
+            every question gets some context.
+        batch_size: Pairs the cross-encoder scores at a time.
+    """
+
+    def __init__(self, model_name=DEFAULT_MODEL, threshold=0.1, token_budget=450, min_keep=1, batch_size=64):
+        self.model_name = model_name
+        self.threshold = threshold
+        self.token_budget = token_budget
+        self.min_keep = min_keep
+        self.batch_size = batch_size
+        self._score = None
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._loader = None
+        self._loader_lock = threading.Lock()
+
+    def start_loading(self):
+        """Loads the cross-encoder in a background thread, once."""
+        with self._loader_lock:
+            if self._loaded or self._loader is not None:
+                return
+            self._loader = threading.Thread(target=self.load, name="reranker-load", daemon=True)
+        self._loader.start()
+
+    def load(self):
+        """Loads the cross-encoder; the reranker is unavailable when it cannot be loaded."""
+        with self._lock:
+            if self._loaded:
+                return
+            try:
+                self._score = load_cross_encoder(self.model_name, self.batch_size)
+            except Exception as e:  # e.g. the model cannot be downloaded
+                log.warning("---RERANKER DISABLED--- %r", e)
+            else:
+                if self._score is None:
+                    log.warning("---RERANKER DISABLED: install sentence_transformers or fastembed---")
+            self._loaded = True
+
+    @property
+    def available(self):
+        """Whether the cross-encoder is loaded; starts loading it otherwise, without waiting."""
+        if not self._loaded:
+            self.start_loading()
+            return False
+        return self._score is not None
+
+    def rerank_many(self, questions, candidates):
+        """Returns the (id, Document) pairs kept for every question, best first.
+
+        Args:
+            questions: The questions of one email.
+            candidates: Per question, the over-fetched (id, Document) pairs.
+        """
+        self.load()
+        # (question, id) -> position of the pair in the scored batch
+        positions, pairs, documents = {}, [], {}
+        for question, hits in zip(questions, candidates):
+            for doc_id, document in hits:
+                documents.setdefault(doc_id, document)
+                if (question, doc_id) not in positions:
+                    positions[(question, doc_id)] = len(pairs)
+                    pairs.append((question, document.page_content))
+        if not pairs:
+            return [[] for _ in questions]
+        with metrics.time("retriever_latency_seconds", retriever="rerank"):
+            scores = self._score(pairs)
+
+        tokens = {}
+        kept_per_question = []
+        for question, hits in zip(questions, candidates):
+            ranked = sorted(dict.fromkeys(doc_id for doc_id, _ in hits),
+                            key=lambda doc_id: scores[positions[(question, doc_id)]], reverse=True)
+            kept, used = [], 0
+            for doc_id in ranked:
+                if doc_id not in tokens:
+                    tokens[doc_id] = count_tokens(documents[doc_id].page_content)
+                score = scores[positions[(question, doc_id)]]
+                if len(kept) >= self.min_keep:
+                    # ranked best first, so every chunk after one below threshold is too
+                    if score < self.threshold:
+                        break
+                    # a smaller chunk further down may still fit
+                    if used + tokens[doc_id] > self.token_budget:
+                        continue
+                kept.append((doc_id, documents[doc_id]))
+                used += tokens[doc_id]
+            metrics.inc("rerank_chunks_total", len(kept), result="kept")
+            metrics.inc("rerank_chunks_total", len(ranked) - len(kept), result="dropped")
+            kept_per_question.append(kept)
+        log.info("---RERANKED %d PAIRS FOR %d QUESTIONS---", len(pairs), len(questions))
+        return kept_per_question
+
+
+def reranker_from_env():
+    """Builds the reranker configured by the RERANK_* environment variables, or None when RERANK=0."""
+    # off until the model has been benchmarked on the serving hosts, see `python reranker.py bench`
+    if os.getenv("RERANK", "0") != "1":
+        return None
+    return Reranker(
+        model_name=os.getenv("RERANK_MODEL", DEFAULT_MODEL),
+        threshold=float(os.getenv("RERANK_THRESHOLD", "0.1")),
+        token_budget=int(os.getenv("RERANK_TOKEN_BUDGET", "450")),
+    )
+
+
+def benchmark(graph, reranker, questions, per_email=3, fetch_k=20, repeat=5):
+    """Returns the reranking latency per email and the rag_prompt tokens with and without reranking.
+
+    The questions are answered per_email at a time, as the questions one
+    email generates; the baseline sends the top graph.RAG_K chunks of the
+    same candidates to rag_prompt.
+    """
+    emails = [questions[i:i + per_email] for i in range(0, len(questions), per_email)]
+    candidates = [graph.candidates_for_questions(email, fetch_k) for email in emails]
+    reranker.rerank_many(emails[0], candidates[0])  # loads the model and warms it up
+
+    latencies = []
+    for _ in range(repeat):
+        for email, hits in zip(emails, candidates):
+            start = time.perf_counter()
+            reranker.rerank_many(email, hits)
+            latencies.append(time.perf_counter() - start)
+
+    baseline_tokens = reranked_tokens = kept = 0
+    for email, hits in zip(emails, candidates):
+        for question, question_hits, reranked in zip(email, hits, reranker.rerank_many(email, hits)):
+            top_k = [document for _, document in question_hits[:graph.RAG_K]]
+            baseline_tokens += count_tokens(graph.rag_prompt.format(question=question, context=top_k))
+            reranked_tokens += count_tokens(graph.rag_prompt.format(
+                question=question, context=[document for _, document in reranked]))
+            kept += len(reranked)
+    latencies = np.array(latencies) * 1000
+    pairs = sum(len(question_hits) for hits in candidates for question_hits in hits)
+    return {"model": reranker.model_name, "emails": len(emails), "questions": len(questions), "fetch_k": fetch_k,
+            "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+            "p95_ms": round(float(np.percentile(latencies, 95)), 3),
+            "pairs_per_second": round(pairs * repeat / (latencies.sum() / 1000), 1),
+            "chunks_per_question": round(kept / len(questions), 2),
+            "rag_prompt_tokens_top_k": baseline_tokens,
+            "rag_prompt_tokens_reranked": reranked_tokens,
+            "prompt_token_reduction": round(1 - reranked_tokens / baseline_tokens, 3) if baseline_tokens else 0.0}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the cross-encoder reranker of the RAG chain.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    bench_parser = commands.add_parser("bench", help="time reranking on the CPU and measure the prompt tokens saved")
+    bench_parser.add_argument("questions", nargs="?", help="text file with one question per line")
+    bench_parser.add_argument("--per-email", type=int, default=3, help="questions reranked together")
+    bench_parser.add_argument("--fetch-k", type=int, default=int(os.getenv("RERANK_FETCH_K", "20")))
+    bench_parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    configure_logging()
+
+    import graph
+    if args.questions:
+        with open(args.questions) as f:
+            questions = [line.strip() for line in f if line.strip()]
+    else:
+        texts = graph.get_vectorstore()._collection.get(limit=150, include=["documents"])["documents"]
+        questions = list(dict.fromkeys(text.split(".")[0] for text in texts))[:48]
+    reranker = graph.get_reranker() or Reranker()
+    reranker.load()
+    if not reranker.available:
+        raise SystemExit("no cross-encoder could be loaded, install sentence_transformers")
+    print(json.dumps(benchmark(graph, reranker, questions, args.per_email, args.fetch_k, args.repeat)))
@@ -0,0 +1,526 @@
+"""Shared call layer for the LLM chains of graph.py.
+
+Every chain calls the LLM through a ResilientLLM, which adds:
+
+    - a timeout per attempt and a deadline for the whole call;
+    - retries of rate limit, timeout, connection and 5xx errors with jittered
+      exponential backoff, waiting at least as long as a 429's Retry-After;
+    - a circuit breaker shared by all chains, failing calls at once while the
+      provider keeps erroring instead of queueing them behind retries;
+    - optional hedging: when an attempt is slower than a percentile of the
+      chain's recent latencies, a duplicate request is sent and the first
+      answer wins.
+
+RepairingJsonOutputParser fixes the usual malformations of LLM JSON (code
+fences, prose around the object, trailing commas, single quotes, raw
+newlines, a cut-off end, a missing or misspelled key) locally, so they
+neither fail the run nor cost another generation.
+"""
+import ast
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, List, Optional
+
+from langchain_core.exceptions import OutputParserException
+from langchain_core.output_parsers import JsonOutputParser
+from langchain_core.runnables import Runnable
+from langchain_core.utils.json import parse_partial_json
+
+from metrics import metrics
+
+log = logging.getLogger(__name__)
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+RETRYABLE_NAMES = ("Timeout", "Connection", "RateLimit", "InternalServer", "ServiceUnavailable", "Overloaded")
+# threads running both requests of a hedged sync call
+_hedge_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="llm-hedge")
+
+
+class CircuitOpenError(Exception):
+    """Raised without calling the LLM while the circuit breaker is open."""
+
+    status_code = 503
+
+
+def status_code(error):
+    code = getattr(error, "status_code", None)
+    if code is None:
+        code = getattr(getattr(error, "response", None), "status_code", None)
+    return code
+
+
+def is_retryable(error):
+    """Whether error is worth retrying: rate limits, timeouts, connection and server errors."""
+    if isinstance(error, CircuitOpenError):
+        return False
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError, ConnectionError)):
+        return True
+    code = status_code(error)
+    if code is not None:
+        return code in RETRYABLE_STATUS
+    return any(name in type(error).__name__ for name in RETRYABLE_NAMES)
+
+
+def retry_after(error):
+    """Returns the seconds a 429 response asked to wait, if it said."""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """Timeouts, retries and hedging of the LLM calls.
+
+    Args:
+        timeout: Seconds one attempt may take.
+        deadline: Seconds the whole call, retries and backoff included, may take.
+        attempts: The maximum number of attempts.
+        backoff_base, backoff_max: The first and the largest backoff ceiling in
+            seconds; the wait is drawn uniformly below base * 2**retry.
+        hedge_percentile: Send a duplicate request once an attempt is slower than
+            this percentile of the chain's recent latencies; 0 turns hedging off.
+        hedge_min_samples: Latencies a chain needs before it is hedged.
+    """
+
+    def __init__(self, timeout=30.0, deadline=90.0, attempts=4, backoff_base=0.5, backoff_max=8.0,
+                 hedge_percentile=0.0, hedge_min_samples=20):
+        self.timeout = timeout
+        self.deadline = deadline
+        self.attempts = attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            timeout=float(os.getenv("LLM_TIMEOUT", "30")),
+            deadline=float(os.getenv("LLM_DEADLINE", "90")),
+            attempts=int(os.getenv("LLM_ATTEMPTS", "4")),
+            backoff_base=float(os.getenv("LLM_BACKOFF_BASE", "0.5")),
+            backoff_max=float(os.getenv("LLM_BACKOFF_MAX", "8")),
+            hedge_percentile=float(os.getenv("LLM_HEDGE_PERCENTILE", "0")),
+            hedge_min_samples=int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20")),
+        )
+
+    def backoff(self, retry, error=None):
+        ceiling = min(self.backoff_max, self.backoff_base * 2 ** retry)
+        return max(random.uniform(0, ceiling), retry_after(error) or 0.0)
+
+
+class CircuitBreaker:
+    """Opens after failures consecutive retryable errors and lets one trial call through every cooldown seconds."""
+
+    def __init__(self, failures=5, cooldown=30.0):
+        self.failures = failures
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._consecutive = 0
+        self._opened_at = None
+        self._trial_running = False
+
+    @classmethod
+    def from_env(cls):
+        return cls(failures=int(os.getenv("LLM_BREAKER_FAILURES", "5")),
+                   cooldown=float(os.getenv("LLM_BREAKER_COOLDOWN", "30")))
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            return "half_open" if time.monotonic() - self._opened_at >= self.cooldown else "open"
+
+    @property
+    def healthy(self):
+        """Whether the last call succeeded; hedging is skipped otherwise so it does not add to the load."""
+        return self._consecutive == 0
+
+    def allow(self):
+        """Raises CircuitOpenError unless a call may go out now."""
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at >= self.cooldown and not self._trial_running:
+                self._trial_running = True
+                return
+        raise CircuitOpenError("LLM circuit breaker is open after repeated provider errors")
+
+    def record_success(self):
+        with self._lock:
+            self._consecutive = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._consecutive += 1
+            if self._trial_running or self._consecutive >= self.failures:
+                if self._opened_at is None or self._trial_running:
+                    log.warning("---LLM CIRCUIT BREAKER OPEN--- after %d failures", self._consecutive)
+                self._opened_at = time.monotonic()
+                self._trial_running = False
+
+
+class LatencyWindow:
+    """The most recent latencies of a chain, for its hedging threshold."""
+
+    def __init__(self, size=200):
+        self._values = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._values.append(seconds)
+
+    def percentile(self, q, min_samples):
+        with self._lock:
+            if len(self._values) < max(1, min_samples):
+                return None
+            values = sorted(self._values)
+        return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+class ResilientLLM(Runnable):
+    """Runs llm with the timeouts, retries, circuit breaker and hedging of policy.
+
+    Args:
+        llm: The runnable calling the provider, e.g. graph.GROQ_LLM.
+        name: The chain the calls belong to, used for its latency window and metrics.
+        policy: The RetryPolicy.
+        breaker: The CircuitBreaker, shared by every chain using the same provider.
+        hedge: Whether this chain may be hedged; streamed chains should not be,
+            as both requests would stream their tokens.
+    """
+
+    def __init__(self, llm, name, policy, breaker, hedge=True):
+        self.llm = llm
+        self.name = name
+        self.policy = policy
+        self.breaker = breaker
+        self.hedge = hedge
+        self.latencies = LatencyWindow()
+
+    @property
+    def InputType(self):
+        return self.llm.InputType
+
+    @property
+    def OutputType(self):
+        return self.llm.OutputType
+
+    def _hedge_delay(self):
+        if not (self.hedge and self.policy.hedge_percentile and self.breaker.healthy):
+            return None
+        return self.latencies.percentile(self.policy.hedge_percentile, self.policy.hedge_min_samples)
+
+    def _timeout(self, deadline):
+        return max(0.0, min(self.policy.timeout, deadline - time.monotonic()))
+
+    def _succeeded(self, start):
+        self.breaker.record_success()
+        self.latencies.add(time.monotonic() - start)
+
+    def _failed(self, error, retry, deadline):
+        """Records a failed attempt and returns the backoff before the next one, or None to give up."""
+        if isinstance(error, CircuitOpenError):
+            metrics.inc("llm_circuit_rejections_total", chain=self.name)
+            return None
+        retryable = is_retryable(error)
+        if retryable:
+            self.breaker.record_failure()
+        else:
+            # the provider answered, the request itself was wrong
+            self.breaker.record_success()
+        if isinstance(error, (TimeoutError, asyncio.TimeoutError)):
+            metrics.inc("llm_timeouts_total", chain=self.name)
+        if not retryable or retry + 1 >= self.policy.attempts:
+            return None
+        backoff = self.policy.backoff(retry, error)
+        if time.monotonic() + backoff >= deadline:
+            return None
+        metrics.inc("llm_retries_total", chain=self.name)
+        log.info("---LLM RETRY--- %s attempt %d failed with %r, retrying in %.2fs", self.name, retry + 1, error, backoff)
+        return backoff
+
+    # sync
+
+    def _attempt(self, input, config, kwargs, deadline):
+        delay = self._hedge_delay()
+        if delay is None:
+            return self.llm.invoke(input, config, **kwargs)
+        first = _hedge_executor.submit(contextvars.copy_context().run, self.llm.invoke, input, config, **kwargs)
+        done, _ = wait([first], timeout=delay)
+        if done:
+            return first.result()
+        metrics.inc("llm_hedged_requests_total", chain=self.name)
+        second = _hedge_executor.submit(contextvars.copy_context().run, self.llm.invoke, input, config, **kwargs)
+        # a sync request cannot be cancelled, the slower one finishes in the background
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=self._timeout(deadline), return_when=FIRST_COMPLETED)
+            if not done:
+                raise TimeoutError()
+            for future in done:
+                if future.exception() is None:
+                    if future is second:
+                        metrics.inc("llm_hedge_wins_total", chain=self.name)
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def invoke(self, input, config=None, **kwargs):
+        deadline = time.monotonic() + self.policy.deadline
+        for retry in range(self.policy.attempts):
+            start = time.monotonic()
+            try:
+                self.breaker.allow()
+                output = self._attempt(input, config, kwargs, deadline)
+            except Exception as e:
+                backoff = self._failed(e, retry, deadline)
+                if backoff is None:
+                    raise
+                time.sleep(backoff)
+                continue
+            self._succeeded(start)
+            return output
+
+    def stream(self, input, config=None, **kwargs):
+        deadline = time.monotonic() + self.policy.deadline
+        for retry in range(self.policy.attempts):
+            start = time.monotonic()
+            started = False
+            try:
+                self.breaker.allow()
+                for chunk in self.llm.stream(input, config, **kwargs):
+                    started = True
+                    yield chunk
+            except Exception as e:
+                # chunks already passed on cannot be taken back
+                backoff = None if started else self._failed(e, retry, deadline)
+                if backoff is None:
+                    raise
+                time.sleep(backoff)
+                continue
+            self._succeeded(start)
+            return
+
+    # async
+
+    async def _aattempt(self, input, config, kwargs, deadline):
+        timeout = self._timeout(deadline)
+        delay = self._hedge_delay()
+        if delay is None or delay >= timeout:
+            return await asyncio.wait_for(self.llm.ainvoke(input, config, **kwargs), timeout)
+        first = asyncio.ensure_future(self.llm.ainvoke(input, config, **kwargs))
+        done, _ = await asyncio.wait([first], timeout=delay)
+        if done:
+            return first.result()
+        metrics.inc("llm_hedged_requests_total", chain=self.name)
+        second = asyncio.ensure_future(self.llm.ainvoke(input, config, **kwargs))
+        pending = {first, second}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=self._timeout(deadline),
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise asyncio.TimeoutError()
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            metrics.inc("llm_hedge_wins_total", chain=self.name)
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        deadline = time.monotonic() + self.policy.deadline
+        for retry in range(self.policy.attempts):
+            start = time.monotonic()
+            try:
+                self.breaker.allow()
+                output = await self._aattempt(input, config, kwargs, deadline)
+            except Exception as e:
+                backoff = self._failed(e, retry, deadline)
+                if backoff is None:
+                    raise
+                await asyncio.sleep(backoff)
+                continue
+            self._succeeded(start)
+            return output
+
+    async def astream(self, input, config=None, **kwargs):
+        deadline = time.monotonic() + self.policy.deadline
+        for retry in range(self.policy.attempts):
+            start = time.monotonic()
+            started = False
+            try:
+                self.breaker.allow()
+                async for chunk in self.llm.astream(input, config, **kwargs):
+                    started = True
+                    yield chunk
+            except Exception as e:
+                backoff = None if started else self._failed(e, retry, deadline)
+                if backoff is None:
+                    raise
+                await asyncio.sleep(backoff)
+                continue
+            self._succeeded(start)
+            return
+
+
+def _strip_fences(text):
+    match = re.search(r"```(?:json)?\s*(.*?)(?:```|$)", text, re.DOTALL)
+    return match.group(1) if match else text
+
+
+def _escape_newlines_in_strings(text):
+    out = []
+    in_string = escaped = False
+    for char in text:
+        if in_string and not escaped and char == "\n":
+            out.append("\\n")
+            continue
+        if char == '"' and not escaped:
+            in_string = not in_string
+        escaped = char == "\\" and not escaped
+        out.append(char)
+    return "".join(out)
+
+
+def repair_json(text):
+    """Returns the JSON object in text, repaired when it is malformed, or None when there is none.
+
+    Also returns which repair worked, for the llm_json_repairs_total metric.
+    """
+    text = _strip_fences(text.strip())
+    start = text.find("{")
+    if start == -1:
+        return None, None
+    end = text.rfind("}")
+    candidate = text[start:end + 1] if end > start else text[start:]
+    candidate = candidate.replace("“", '"').replace("”", '"')
+    attempts = [
+        ("extract", lambda: json.loads(candidate)),
+        ("trailing_comma", lambda: json.loads(re.sub(r",\s*([}\]])", r"\1", candidate))),
+        ("newlines", lambda: json.loads(_escape_newlines_in_strings(re.sub(r",\s*([}\]])", r"\1", candidate)))),
+        ("python_literal", lambda: ast.literal_eval(candidate)),
+        ("truncated", lambda: parse_partial_json(_escape_newlines_in_strings(text[start:]))),
+    ]
+    for kind, parse in attempts:
+        try:
+            value = parse()
+        except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
+            continue
+        if isinstance(value, dict):
+            return value, kind
+    return None, None
+
+
+def _normalize_choice(value, choices):
+    if not isinstance(value, str):
+        return None
+    normalized = re.sub(r"[\s\-]+", "_", value.strip().strip("'\"").lower())
+    if normalized in choices:
+        return normalized
+    # longest first, so "no_rewrite" is not read as "rewrite"
+    for choice in sorted(choices, key=len, reverse=True):
+        if choice in normalized:
+            return choice
+    return None
+
+
+class DefaultedOutput(dict):
+    """Parsed output whose key holds the parser's default because the LLM output could not be recovered.
+
+    llm_cache does not cache it, so one bad answer is not replayed for the whole TTL.
+    """
+
+    cacheable = False
+
+
+class RepairingJsonOutputParser(JsonOutputParser):
+    """JsonOutputParser that repairs malformed output locally instead of failing the chain.
+
+    Args:
+        key: The single key the prompt asks for. When the object lacks it, a
+            lone value under another key is used instead; when there is no
+            object at all, the choice the text names is used (see choices).
+        plain_text: Take output without any JSON object as the value of key,
+            for keys holding free text like an email.
+        choices: The values key may take; other spellings are normalized to
+            them (e.g. "No Rewrite" to "no_rewrite").
+        default: The value of key when nothing else recovers it; without one
+            an unrecoverable output still raises OutputParserException.
+    """
+
+    key: Optional[str] = None
+    plain_text: bool = False
+    choices: Optional[List[str]] = None
+    default: Any = None
+
+    def _fix_key(self, parsed, text, kind):
+        if self.key is None:
+            return parsed, kind
+        if parsed is None:
+            parsed, kind = {}, "no_object"
+            if self.choices:
+                choice = _normalize_choice(text, self.choices)
+                if choice:
+                    parsed[self.key] = choice
+            elif self.plain_text and text.strip():
+                parsed[self.key] = _strip_fences(text.strip()).strip()
+        if self.key not in parsed and len(parsed) == 1:
+            value = next(iter(parsed.values()))
+            if not self.choices or _normalize_choice(value, self.choices):
+                parsed = {self.key: value}
+                kind = kind or "renamed_key"
+        if self.choices and self.key in parsed and parsed[self.key] not in self.choices:
+            choice = _normalize_choice(parsed[self.key], self.choices)
+            if choice:
+                parsed = {**parsed, self.key: choice}
+                kind = kind or "choice"
+        if self.key not in parsed or (self.choices and parsed[self.key] not in self.choices):
+            if self.default is None:
+                raise OutputParserException(f"Missing key {self.key!r} in LLM output", llm_output=text)
+            parsed = DefaultedOutput({**parsed, self.key: self.default})
+            kind = "default"
+        return parsed, kind
+
+    def parse_result(self, result, *, partial=False):
+        if partial:
+            return super().parse_result(result, partial=True)
+        text = result[0].text
+        kind = None
+        try:
+            parsed = super().parse_result(result)
+        except OutputParserException:
+            parsed, kind = repair_json(text)
+            if parsed is None and self.key is None:
+                raise
+        if parsed is not None and not isinstance(parsed, dict):
+            if self.key is None:
+                return parsed
+            parsed = None
+        parsed, kind = self._fix_key(parsed, text, kind)
+        if kind:
+            metrics.inc("llm_json_repairs_total", kind=kind)
+            log.info("---REPAIRED LLM JSON--- %s", kind)
+        return parsed
@@ -0,0 +1,277 @@
+"""Run-scoped store for the large GraphState fields.
+
+The research answers, the generated RAG questions and the draft analysis
+are written to a RunStore once, and GraphState carries a short reference
+to them ("run_store://<run_id>/<field>") instead of the values. Every node
+update, checkpoint and streamed /stream chunk then copies the reference,
+and only the nodes that need a value load it.
+
+project() turns the final state into what a client asked for: the chosen
+fields only, with references replaced by their values. Only the fields the
+graph stores (STORED_FIELDS) are resolved, and only references to the run
+the state belongs to, so a client cannot read another run's values by
+sending its reference.
+"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from langchain_core.runnables import Runnable
+
+log = logging.getLogger(__name__)
+
+REF_PREFIX = "run_store://"
+# the state fields the graph keeps by reference; any other field is returned as it is
+STORED_FIELDS = ("research_info", "rag_questions", "draft_email_feedback")
+
+
+def is_ref(value):
+    return isinstance(value, str) and value.startswith(REF_PREFIX)
+
+
+def make_ref(run_id, field):
+    return f"{REF_PREFIX}{run_id}/{field}"
+
+
+def _parse_ref(ref):
+    run_id, _, field = ref[len(REF_PREFIX):].rpartition("/")
+    return run_id, field
+
+
+class MemoryRunStore:
+    """Keeps the values of the runs that wrote one in the last ttl seconds in memory.
+
+    Runs expire by age rather than by count, so the references of a run in
+    progress stay valid however many runs start meanwhile.
+    """
+
+    # put and get never wait on I/O, async callers may use them on the event loop
+    blocking = False
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        # run_id -> (time of its last put, {field: value}), oldest first
+        self._runs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, run_id, field, value):
+        now = time.monotonic()
+        with self._lock:
+            _, values = self._runs.pop(run_id, (now, {}))
+            values[field] = value
+            self._runs[run_id] = (now, values)
+            while self._runs and next(iter(self._runs.values()))[0] < now - self.ttl:
+                self._runs.popitem(last=False)
+        return make_ref(run_id, field)
+
+    def get(self, ref):
+        run_id, field = _parse_ref(ref)
+        with self._lock:
+            _, values = self._runs.get(run_id, (None, {}))
+            if field not in values:
+                raise KeyError(f"{ref} is not in the run store")
+            return values[field]
+
+
+class SQLiteRunStore:
+    """Keeps the values in SQLite, so checkpointed runs still find them after a restart.
+
+    Values not written to for ttl seconds are deleted when the store opens and
+    then by put, at most every expire_every seconds.
+    """
+
+    # async callers run put and get in a thread, see graph.run_store_io
+    blocking = True
+
+    def __init__(self, path=".checkpoints/run_store.sqlite3", ttl=7 * 24 * 3600, expire_every=600):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.ttl = ttl
+        self.expire_every = expire_every
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS run_values ("
+            "run_id TEXT NOT NULL, field TEXT NOT NULL, value TEXT NOT NULL, updated_at REAL NOT NULL, "
+            "PRIMARY KEY (run_id, field))"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS run_values_updated_at ON run_values (updated_at)")
+        self._next_expiry = 0.0
+        with self._lock:
+            self._expire(time.time())
+            self._db.commit()
+
+    def _expire(self, now):
+        if self.ttl and now >= self._next_expiry:
+            deleted = self._db.execute("DELETE FROM run_values WHERE updated_at < ?", (now - self.ttl,)).rowcount
+            if deleted:
+                log.info("---EXPIRED %d RUN STORE VALUES---", deleted)
+            self._next_expiry = now + self.expire_every
+
+    def put(self, run_id, field, value):
+        now = time.time()
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO run_values VALUES (?, ?, ?, ?)",
+                             (run_id, field, json.dumps(value), now))
+            self._expire(now)
+            self._db.commit()
+        return make_ref(run_id, field)
+
+    def get(self, ref):
+        run_id, field = _parse_ref(ref)
+        with self._lock:
+            row = self._db.execute("SELECT value FROM run_values WHERE run_id = ? AND field = ?",
+                                   (run_id, field)).fetchone()
+        if row is None:
+            raise KeyError(f"{ref} is not in the run store")
+        return json.loads(row[0])
+
+
+def store_from_env(checkpoints=False):
+    """Builds the run store selected by RUN_STORE; it defaults to sqlite when runs are checkpointed."""
+    backend = os.getenv("RUN_STORE", "sqlite" if checkpoints else "memory")
+    if backend == "memory":
+        return MemoryRunStore(float(os.getenv("RUN_STORE_TTL", "3600")))
+    if backend == "sqlite":
+        return SQLiteRunStore(os.getenv("RUN_STORE_PATH", ".checkpoints/run_store.sqlite3"),
+                              ttl=float(os.getenv("CHECKPOINT_TTL", "604800")) or None)
+    raise ValueError(f"Unknown RUN_STORE backend: {backend!r}")
+
+
+def load(store, value, run_id):
+    """Returns the value a state field holds, loading it from store when it is a reference.
+
+    A reference to another run than run_id is not followed and loads as None.
+    """
+    if not is_ref(value):
+        return value
+    if not run_id or _parse_ref(value)[0] != run_id:
+        log.warning("---FOREIGN RUN STORE REFERENCE IGNORED--- %s", value)
+        return None
+    return store.get(value)
+
+
+def project(store, values, fields, run_id=None):
+    """Returns the fields of the state values, references replaced by their values.
+
+    Args:
+        store: The RunStore the references point into.
+        values: A graph state, or the update of one node.
+        fields: The fields to return; None returns every field.
+        run_id: The run the values belong to, when they do not hold their
+            own run_id (the update of a node other than the first).
+    """
+    if not isinstance(values, dict):
+        return values
+    run_id = values.get("run_id") or run_id
+    names = values.keys() if fields is None else [field for field in fields if field in values]
+    projected = {}
+    for name in names:
+        if name not in STORED_FIELDS:
+            projected[name] = values[name]
+            continue
+        try:
+            projected[name] = load(store, values[name], run_id)
+        except KeyError:
+            log.warning("---RUN STORE MISS--- %s", values[name])
+            projected[name] = None
+    return projected
+
+
+async def aproject(store, values, fields, run_id=None):
+    """Async version of project(); a blocking store is read in a thread."""
+    if store.blocking:
+        return await asyncio.to_thread(project, store, values, fields, run_id)
+    return project(store, values, fields, run_id)
+
+
+def _chunk_run_id(chunk, run_id):
+    """Returns the run_id a streamed chunk carries, or run_id when it has none."""
+    if not isinstance(chunk, dict):
+        return run_id
+    if isinstance(chunk.get("run_id"), str):
+        return chunk["run_id"]
+    for update in chunk.values():
+        if isinstance(update, dict) and isinstance(update.get("run_id"), str):
+            return update["run_id"]
+    return run_id
+
+
+def parse_fields(text, default):
+    """Reads a comma separated field list, "*" for every field; empty text gives default."""
+    if not text:
+        return default
+    if text.strip() == "*":
+        return None
+    return [field.strip() for field in text.split(",") if field.strip()]
+
+
+class ProjectedGraph(Runnable):
+    """Serves a compiled graph with only the output fields the caller picked.
+
+    The fields come from config["configurable"]["output_fields"] (None for
+    all of them), falling back to default_fields, the whole state unless
+    given. Final states of invoke and
+    batch are projected; streamed chunks, which hold one node's update each,
+    have their node updates projected the same way.
+    """
+
+    def __init__(self, graph, store, default_fields=None):
+        self.graph = graph
+        self.store = store
+        self.default_fields = default_fields
+
+    @property
+    def InputType(self):
+        return self.graph.InputType
+
+    @property
+    def OutputType(self):
+        # any subset of the state fields, as the caller picks which ones come back
+        return dict
+
+    def get_input_schema(self, config=None):
+        return self.graph.get_input_schema(config)
+
+    @property
+    def config_specs(self):
+        return self.graph.config_specs
+
+    def _fields(self, config):
+        configurable = (config or {}).get("configurable") or {}
+        return configurable.get("output_fields", self.default_fields)
+
+    def _project_chunk(self, chunk, fields, run_id):
+        # {node: update} in the "updates" stream mode
+        if isinstance(chunk, dict) and all(isinstance(update, dict) or update is None for update in chunk.values()):
+            return {node: project(self.store, update, fields, run_id) for node, update in chunk.items()}
+        return project(self.store, chunk, fields, run_id)
+
+    def invoke(self, input, config=None, **kwargs):
+        return project(self.store, self.graph.invoke(input, config, **kwargs), self._fields(config))
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        return await aproject(self.store, await self.graph.ainvoke(input, config, **kwargs), self._fields(config))
+
+    def stream(self, input, config=None, **kwargs):
+        fields = self._fields(config)
+        # only the first node's update names the run; later ones are projected against it
+        run_id = None
+        for chunk in self.graph.stream(input, config, **kwargs):
+            run_id = _chunk_run_id(chunk, run_id)
+            yield self._project_chunk(chunk, fields, run_id)
+
+    async def astream(self, input, config=None, **kwargs):
+        fields = self._fields(config)
+        run_id = None
+        async for chunk in self.graph.astream(input, config, **kwargs):
+            run_id = _chunk_run_id(chunk, run_id)
+            if self.store.blocking:
+                yield await asyncio.to_thread(self._project_chunk, chunk, fields, run_id)
+            else:
+                yield self._project_chunk(chunk, fields, run_id)
@@ -0,0 +1,67 @@
+"""Startup timing for the email assistant.
+
+Import steps and lazily built resources record how long they took, so cold
+start time can be tracked between releases:
+
+    python startup.py
+
+imports main.py, runs the warm-up hook and prints the timings as JSON.
+"""
+import functools
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+_process_start = time.perf_counter()
+_timings = {}
+_lock = threading.Lock()
+
+
+@contextmanager
+def timed(name):
+    """Records how long the block took under name."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        with _lock:
+            _timings[name] = round(time.perf_counter() - start, 4)
+
+
+def lazy(name):
+    """Builds the decorated factory's value on first call, once, and times it under name."""
+    def decorator(factory):
+        lock = threading.Lock()
+        built = []
+
+        @functools.wraps(factory)
+        def get():
+            if not built:
+                with lock:
+                    if not built:
+                        with timed(name):
+                            built.append(factory())
+            return built[0]
+
+        get.is_built = lambda: bool(built)
+        return get
+
+    return decorator
+
+
+def report():
+    """Returns the recorded timings in seconds, plus the time since this module was imported."""
+    with _lock:
+        timings = dict(_timings)
+    timings["since_first_import"] = round(time.perf_counter() - _process_start, 4)
+    return timings
+
+
+if __name__ == "__main__":
+    # record into the startup module main.py imports, not into this __main__ copy
+    import startup
+    with startup.timed("import main"):
+        import main
+    main.warm_up_graph()
+    print(json.dumps(startup.report(), indent=2))
@@ -0,0 +1,74 @@
+"""Progress streaming for single graph runs.
+
+stream_progress() turns the graph's astream_events into a short list of
+events a support console can render as they arrive:
+
+    {"event": "node_start", "node": "draft_email_writer"}
+    {"event": "token", "node": "draft_email_writer", "field": "email_draft", "text": "Dear Pa"}
+    {"event": "node_end", "node": "draft_email_writer", "seconds": 1.2}
+    {"event": "end", "output": {"email_category": ..., "final_email": ..., ...}}
+
+Token events carry the new text of the email field, read from the partial
+JSON the LLM has produced so far.
+"""
+import time
+
+from langchain_core.utils.json import parse_partial_json
+
+# node -> JSON field of its LLM output whose text is streamed
+STREAMED_FIELDS = {"draft_email_writer": "email_draft", "rewrite_email": "final_email"}
+# state fields sent with the end event
+OUTPUT_FIELDS = ["run_id", "trace_id", "email_category", "draft_email", "final_email", "num_steps", "duplicate_of"]
+
+
+def partial_field(text, field):
+    """Returns the value of field in the partial JSON object text, or None when it has not started yet."""
+    start = text.find("{")
+    if start == -1:
+        return None
+    parsed = parse_partial_json(text[start:])
+    if not isinstance(parsed, dict):
+        return None
+    value = parsed.get(field)
+    return value if isinstance(value, str) else None
+
+
+async def stream_progress(app, inputs, config=None, output=None):
+    """Runs app on inputs and yields node, token and end events as dicts.
+
+    output turns the final state into the end event's output; by default it
+    holds the OUTPUT_FIELDS of the state.
+    """
+    if output is None:
+        output = lambda values: {field: values.get(field) for field in OUTPUT_FIELDS}
+    node_started = {}
+    llm_text = {}
+    sent = {}
+    async for event in app.astream_events(inputs, config=config, version="v2"):
+        kind = event["event"]
+        node = event["metadata"].get("langgraph_node")
+        # node runs sit directly under the graph run; the node's own callable is nested below them
+        is_node_run = (len(event["parent_ids"]) == 1 and event["name"] == node
+                       and not node.startswith("__"))
+
+        if kind == "on_chain_start" and is_node_run:
+            node_started[event["run_id"]] = time.perf_counter()
+            yield {"event": "node_start", "node": node}
+
+        elif kind == "on_chain_end" and is_node_run:
+            seconds = time.perf_counter() - node_started.pop(event["run_id"], time.perf_counter())
+            yield {"event": "node_end", "node": node, "seconds": round(seconds, 3)}
+
+        elif kind == "on_chat_model_stream" and node in STREAMED_FIELDS:
+            run_id = event["run_id"]
+            llm_text[run_id] = llm_text.get(run_id, "") + str(event["data"]["chunk"].content)
+            value = partial_field(llm_text[run_id], STREAMED_FIELDS[node])
+            previous = sent.get(run_id, "")
+            # partial strings only grow; anything else means the parse is not settled yet
+            if value and len(value) > len(previous) and value.startswith(previous):
+                sent[run_id] = value
+                yield {"event": "token", "node": node, "field": STREAMED_FIELDS[node],
+                       "text": value[len(previous):]}
+
+        elif kind == "on_chain_end" and not event["parent_ids"]:
+            yield {"event": "end", "output": output(event["data"].get("output") or {})}
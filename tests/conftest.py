@@ -0,0 +1,25 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+# the modules live at the repository root
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# graph.py reads its settings on import: run the tests offline, without local models or files
+for name, value in (("FAKE_LLM", "1"), ("FAKE_LLM_LATENCY", "0"), ("LLM_CACHE", "off"), ("EMBEDDING_CACHE", "0"),
+                    ("CATEGORY_CLASSIFIER", "0"), ("RERANK", "0"), ("DEDUP", "0"), ("ARTIFACT_SINK", "memory"),
+                    ("WARM_UP", "0"), ("CHECKPOINTS", "0")):
+    os.environ.setdefault(name, value)
+
+
+@pytest.fixture(scope="session")
+def rag_db_copy(tmp_path_factory):
+    """Points graph.py at a copy of RAG_DB, as Chroma writes to the directory it opens."""
+    import graph
+    path = tmp_path_factory.mktemp("rag") / "RAG_DB"
+    shutil.copytree(os.path.join(ROOT, "RAG_DB"), path)
+    graph.persist_directory = str(path)
+    return path
@@ -0,0 +1,40 @@
+import os
+import time
+
+from artifacts import LocalArtifactSink
+
+
+def test_local_sink_writes_one_directory_per_run(tmp_path):
+    sink = LocalArtifactSink(str(tmp_path))
+    sink.write("run-1", "email_category", "booking")
+    sink.write("run-1", "research_info", ["q\n\na", "q2\n\na2"])
+    sink.write("run-2", "draft_email_feedback", {"decision": "rewrite"})
+    sink.flush()
+
+    assert (tmp_path / "run-1" / "email_category.md").read_text() == "booking"
+    assert (tmp_path / "run-1" / "research_info.md").read_text() == "q\n\na\nq2\n\na2"
+    assert (tmp_path / "run-2" / "draft_email_feedback.md").read_text() == "decision: rewrite"
+
+
+def test_local_sink_deletes_the_artifacts_of_idle_runs(tmp_path):
+    old = tmp_path / "old-run"
+    old.mkdir()
+    (old / "final_email.md").write_text("Dear Paul,")
+    week_ago = time.time() - 8 * 24 * 3600
+    os.utime(old, (week_ago, week_ago))
+
+    sink = LocalArtifactSink(str(tmp_path), ttl=7 * 24 * 3600)
+    sink.write("new-run", "final_email", "Dear Anna,")
+    sink.flush()
+    assert sorted(os.listdir(tmp_path)) == ["new-run"]
+
+
+def test_local_sink_keeps_everything_without_a_ttl(tmp_path):
+    old = tmp_path / "old-run"
+    old.mkdir()
+    os.utime(old, (0, 0))
+
+    sink = LocalArtifactSink(str(tmp_path), ttl=None)
+    sink.write("new-run", "final_email", "Dear Anna,")
+    sink.flush()
+    assert sorted(os.listdir(tmp_path)) == ["new-run", "old-run"]
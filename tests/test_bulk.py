@@ -0,0 +1,87 @@
+import asyncio
+
+import pytest
+from langchain_core.runnables import RunnableLambda
+
+from bulk import BulkStats, process_emails
+
+
+async def _answer(state):
+    return {"trace_id": "t", "email_category": "product_enquiry", "final_email": "Re: " + state["initial_email"]}
+
+
+def _process(emails):
+    stats = BulkStats()
+
+    async def collect():
+        return [result async for result in process_emails(emails, app=RunnableLambda(_answer), stats=stats)]
+
+    return sorted(asyncio.run(collect()), key=lambda result: result["id"]), stats
+
+
+def test_every_email_gets_a_result():
+    results, stats = _process([{"id": 1, "initial_email": "Hi"}, {"id": 2, "initial_email": "Hello"}])
+    assert [result["final_email"] for result in results] == ["Re: Hi", "Re: Hello"]
+    assert all(result["error"] is None and result["estimated_requests"] > 0 for result in results)
+    assert stats.report()["errors"] == 0
+
+
+def test_malformed_lines_get_error_rows():
+    results, stats = _process([{"id": 1, "initial_email": "Hi"}, {"id": 2}, {"id": 3, "initial_email": None}])
+    assert results[0]["error"] is None
+    assert "initial_email" in results[1]["error"] and "initial_email" in results[2]["error"]
+    assert results[1]["final_email"] is None
+    assert stats.report()["errors"] == 2
+
+
+def test_app_errors_become_error_rows():
+    async def fail(state):
+        raise RuntimeError("groq is down")
+
+    async def collect():
+        return [result async for result in process_emails([{"initial_email": "Hi"}], app=RunnableLambda(fail))]
+
+    [result] = asyncio.run(collect())
+    assert result["id"] == 0 and "groq is down" in result["error"]
+
+
+def test_concurrency_below_one_is_rejected():
+    async def collect():
+        return [result async for result in process_emails([{"initial_email": "Hi"}], app=RunnableLambda(_answer),
+                                                           concurrency=0)]
+
+    with pytest.raises(ValueError, match="concurrency"):
+        asyncio.run(collect())
+
+
+def test_bulk_endpoint_rejects_concurrency_below_one():
+    from fastapi.testclient import TestClient
+
+    import main
+
+    response = TestClient(main.app).post("/bulk?concurrency=0", content=b'{"initial_email": "Hi"}\n')
+    assert response.status_code == 422
+
+
+def test_closing_the_results_cancels_the_runs_in_flight():
+    cancelled = []
+
+    async def answer(state):
+        if state["initial_email"] == "fast":
+            return await _answer(state)
+        try:
+            await asyncio.sleep(30)
+        except asyncio.CancelledError:
+            cancelled.append(state["initial_email"])
+            raise
+
+    async def first_result():
+        emails = [{"initial_email": "fast"}, {"initial_email": "slow 1"}, {"initial_email": "slow 2"}]
+        results = process_emails(emails, app=RunnableLambda(answer), concurrency=3)
+        result = await results.__anext__()
+        await results.aclose()
+        await asyncio.sleep(0)
+        return result
+
+    assert asyncio.run(first_result())["final_email"] == "Re: fast"
+    assert sorted(cancelled) == ["slow 1", "slow 2"]
@@ -0,0 +1,92 @@
+import threading
+import zlib
+
+import numpy as np
+import pytest
+
+import category_classifier
+from category_classifier import CATEGORIES, SEED_EXEMPLARS, ExemplarClassifier
+
+
+def _hashed_encoder(dimensions=64):
+    """Bag of hashed words, a stand-in for the embedding model."""
+    def encode(texts):
+        vectors = np.zeros((len(texts), dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in text.lower().split():
+                vectors[row, zlib.crc32(word.encode()) % dimensions] += 1
+        return vectors
+    return encode
+
+
+def _classifier(tmp_path, monkeypatch, **kwargs):
+    monkeypatch.setattr(category_classifier, "load_encoder", lambda model_name: _hashed_encoder())
+    classifier = ExemplarClassifier(path=str(tmp_path / "exemplars.npz"), **kwargs)
+    classifier.load()
+    return classifier
+
+
+def test_embed_does_not_wait_for_the_model(tmp_path, monkeypatch):
+    monkeypatch.setattr(category_classifier, "load_encoder", lambda model_name: _hashed_encoder())
+    classifier = ExemplarClassifier(path=str(tmp_path / "exemplars.npz"))
+    monkeypatch.setattr(classifier, "start_loading", lambda: None)
+    assert classifier.embed("How much is a ticket?") is None
+
+
+def test_learned_exemplars_are_saved_in_batches(tmp_path, monkeypatch):
+    classifier = _classifier(tmp_path, monkeypatch, save_every=3)
+    texts = ["plumber needed in leeds", "weather in paris tomorrow", "best pizza near the station"]
+    for text in texts[:2]:
+        classifier.learn(classifier.embed(text), "off_topic")
+    assert len(classifier._exemplars[1]) == len(SEED_EXEMPLARS)
+    assert not (tmp_path / "exemplars.npz").exists()
+
+    classifier.learn(classifier.embed(texts[2]), "off_topic")
+    assert len(classifier._exemplars[1]) == len(SEED_EXEMPLARS) + 3
+    for thread in threading.enumerate():
+        if thread.name == "category-exemplars-save":
+            thread.join()
+    saved = np.load(tmp_path / "exemplars.npz")
+    assert len(saved["labels"]) == len(SEED_EXEMPLARS) + 3
+    assert CATEGORIES[saved["labels"][-1]] == "off_topic"
+
+
+def test_flush_saves_pending_exemplars(tmp_path, monkeypatch):
+    classifier = _classifier(tmp_path, monkeypatch, save_every=100)
+    classifier.learn(classifier.embed("please unsubscribe me now"), "off_topic")
+    classifier.flush()
+    assert len(np.load(tmp_path / "exemplars.npz")["labels"]) == len(SEED_EXEMPLARS) + 1
+
+
+def test_classify_votes_with_the_nearest_exemplars(tmp_path, monkeypatch):
+    classifier = _classifier(tmp_path, monkeypatch, k=1, threshold=0.0)
+    vectors, labels = classifier._exemplars
+    assert classifier.classify(vectors[3]) == (CATEGORIES[labels[3]], 1.0)
+    assert classifier.classify(None) == (None, 0.0)
+
+
+class _RecordingClassifier:
+    def __init__(self):
+        self.learned = []
+
+    def embed(self, text):
+        return np.ones(4, dtype=np.float32)
+
+    def classify(self, vector):
+        return None, 0.0
+
+    def learn(self, vector, label):
+        self.learned.append(label)
+
+
+def test_only_answers_naming_a_category_are_learned(monkeypatch):
+    graph = pytest.importorskip("graph")
+    from langchain_core.runnables import RunnableLambda
+
+    classifier = _RecordingClassifier()
+    monkeypatch.setattr(graph, "get_category_classifier", lambda: classifier)
+    state = {"initial_email": "Hi, what are your prices?", "num_steps": 0, "run_id": "run"}
+    for answer, category in (("I am not sure what this is.", "off_topic"), ("price_enquiry", "price_enquiry")):
+        monkeypatch.setattr(graph, "email_category_generator", RunnableLambda(lambda inputs, answer=answer: answer))
+        assert graph.categorize_email(state)["email_category"] == category
+    assert classifier.learned == ["price_enquiry"]
@@ -0,0 +1,60 @@
+import asyncio
+from typing import TypedDict
+
+from langgraph.graph import END, StateGraph
+
+from checkpoints import (
+    acompact_thread,
+    arun_status,
+    expire,
+    open_checkpointer,
+    open_sync_checkpointer,
+    stats,
+    thread_config,
+)
+
+
+class State(TypedDict):
+    text: str
+
+
+def build(checkpointer):
+    workflow = StateGraph(State)
+    workflow.add_node("first", lambda state: {"text": state["text"] + " first"})
+    workflow.add_node("second", lambda state: {"text": state["text"] + " second"})
+    workflow.set_entry_point("first")
+    workflow.add_edge("first", "second")
+    workflow.add_edge("second", END)
+    return workflow.compile(checkpointer=checkpointer)
+
+
+def run(path, thread_id, compact=False):
+    async def main():
+        app = build(open_checkpointer(path))
+        await app.ainvoke({"text": "start"}, thread_config(thread_id))
+        if compact:
+            await acompact_thread(app.checkpointer, thread_id)
+        status = await arun_status(app, thread_id)
+        await app.checkpointer.conn.close()
+        return status
+    return asyncio.run(main())
+
+
+def test_compaction_keeps_the_last_checkpoint_and_the_completed_nodes(tmp_path):
+    path = str(tmp_path / "checkpoints.sqlite3")
+    status = run(path, "thread", compact=True)
+
+    assert status["status"] == "completed"
+    assert status["completed_nodes"] == ["first", "second"]
+    assert status["values"] == {"text": "start first second"}
+    assert stats(open_sync_checkpointer(path))["checkpoints"] == 1
+
+
+def test_expire_deletes_idle_threads(tmp_path):
+    path = str(tmp_path / "checkpoints.sqlite3")
+    run(path, "thread")
+    saver = open_sync_checkpointer(path)
+
+    assert expire(saver, ttl=3600) == 0
+    assert expire(saver, ttl=-1) == 1
+    assert stats(saver)["threads"] == 0
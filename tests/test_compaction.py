@@ -0,0 +1,55 @@
+from compaction import clean_email, compact_research, truncate_tokens
+from tokens import count_tokens
+
+REPLY = """Hi,
+
+Can I bring my dog to the park?
+
+Thanks,
+Paul
+--
+Paul Smith | Example Ltd
+
+On Mon, 3 Jun 2024 at 10:00, Sarah <sarah@example.com> wrote:
+> Dear Paul,
+> The park opens at 9am.
+"""
+
+
+def test_clean_email_strips_quotes_and_signature():
+    assert clean_email(REPLY) == "Hi,\n\nCan I bring my dog to the park?\n\nThanks,\nPaul"
+
+
+def test_clean_email_strips_html():
+    html = ("<html><head><style>p {color: red}</style></head><body><p>Hi,</p><p>Are you open on Sunday?</p>"
+            "<blockquote>Dear Paul, we are open.</blockquote></body></html>")
+    assert clean_email(html) == "Hi,\nAre you open on Sunday?"
+    # an address in angle brackets is not markup
+    assert clean_email("Please reply to <paul@example.com>.") == "Please reply to <paul@example.com>."
+
+
+def test_truncate_tokens_keeps_text_within_the_budget():
+    text = "The park opens at 9am. " * 200
+    assert truncate_tokens("Short email.", 50) == "Short email."
+    truncated = truncate_tokens(text, 50)
+    assert text.startswith(truncated) and 0 < count_tokens(truncated) <= 50
+
+
+def test_compact_research_drops_repeated_sentences():
+    research_info = ["Opening hours?\n\nThe park opens at 9am. It closes at 6pm.\n\n\n",
+                     "Dogs?\n\nThe park opens at 9am! Dogs are welcome on a lead.\n\n\n"]
+    assert compact_research(research_info, 1000) == [
+        "Opening hours?\n\nThe park opens at 9am. It closes at 6pm.\n\n\n",
+        "Dogs?\n\nDogs are welcome on a lead.\n\n\n"]
+
+
+def test_compact_research_keeps_questions_and_stays_within_the_budget():
+    long_sentence = "The park has " + ", ".join(f"ride {i}" for i in range(100)) + "."
+    research_info = ["Rides?\n\n" + long_sentence + " Tickets cost 20 pounds.\n\n\n",
+                     "Parking?\n\nParking is free.\n\n\n"]
+    budget = 30
+    compacted = compact_research(research_info, budget)
+    # the oversized sentence is left out, the shorter ones after it still fit
+    assert compacted == ["Rides?\n\nTickets cost 20 pounds.\n\n\n", "Parking?\n\nParking is free.\n\n\n"]
+    assert sum(count_tokens(blob) for blob in compacted) <= budget
+    assert compact_research(None, budget) == []
@@ -0,0 +1,32 @@
+import pytest
+
+from dedup import personalize, sender_name
+
+ANSWER = "Dear Anna,\nThe park opens at 9am.\n\nBest regards,\nSarah\nResident Manager"
+
+
+def test_personalize_rewrites_only_the_greeting():
+    assert personalize(ANSWER, "Anna", "Paul") == (
+        "Dear Paul,\nThe park opens at 9am.\n\nBest regards,\nSarah\nResident Manager")
+    assert personalize(ANSWER, "Anna", None).startswith("Hello,\nThe park")
+
+
+def test_personalize_refuses_when_the_old_name_is_in_the_body():
+    # the sender had the name the answer is signed with
+    answer = ANSWER.replace("Anna", "Sarah")
+    assert personalize(answer, "Sarah", "Paul") is None
+    assert personalize("Hi Anna,\nAnna, your tickets are ready.", "Anna", "Paul") is None
+    assert personalize(answer, "Sarah", "Sarah") == answer
+
+
+@pytest.mark.parametrize("text, name", [
+    ("Can I bring my dog?\n\nThanks,\nPaul", "Paul"),
+    ("Kind regards, Paul Smith", "Paul Smith"),
+    ("Hi, my name is Anna and I have a question.", "Anna"),
+    ("We are 4 adults.\nPaul", "Paul"),
+    ("I want to book for my family. Westworld", None),
+    ("What time does the park open?", None),
+    ("Best regards", None),
+])
+def test_sender_name(text, name):
+    assert sender_name(text) == name
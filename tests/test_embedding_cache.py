@@ -0,0 +1,38 @@
+import asyncio
+
+from langchain_core.embeddings import Embeddings
+
+from embedding_cache import CachedEmbeddings
+
+
+class LengthEmbeddings(Embeddings):
+    def __init__(self):
+        self.calls = 0
+
+    def embed_documents(self, texts):
+        self.calls += 1
+        return [[float(len(text))] * 8 for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+def _disk_bytes(cache):
+    return cache._db.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()[0]
+
+
+def test_disk_tier_stays_within_limit(tmp_path):
+    cache = CachedEmbeddings(LengthEmbeddings(), "test", str(tmp_path), memory_items=2, max_disk_bytes=32 * 10)
+    for i in range(30):
+        cache.embed_documents([f"text {i}"])
+    assert _disk_bytes(cache) <= 32 * 10
+    assert cache._disk_bytes == _disk_bytes(cache)
+
+
+def test_disk_hits_are_served_without_the_model(tmp_path):
+    model = LengthEmbeddings()
+    CachedEmbeddings(model, "test", str(tmp_path)).embed_documents(["a", "bb"])
+    cache = CachedEmbeddings(model, "test", str(tmp_path))
+    assert asyncio.run(cache.aembed_documents(["bb", "a"])) == [[2.0] * 8, [1.0] * 8]
+    assert model.calls == 1
+    assert cache.stats()["disk_hits"] == 2
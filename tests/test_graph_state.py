@@ -0,0 +1,89 @@
+import pytest
+
+graph = pytest.importorskip("graph")
+
+# what clients sent before the nodes added fields of their own
+BASELINE_INPUT = {
+    "initial_email": "What can I do at the park?",
+    "email_category": "",
+    "draft_email": "",
+    "final_email": "",
+    "research_info": [],
+    "info_needed": False,
+    "num_steps": 0,
+    "draft_email_feedback": {},
+    "rag_questions": [],
+}
+
+
+def test_input_schema_requires_only_the_baseline_fields():
+    schema = graph.get_graph_app().get_input_schema().model_json_schema()
+    assert set(schema["required"]) == set(BASELINE_INPUT)
+    assert {"clean_email", "run_id", "trace_id", "prompt_tokens", "duplicate_of"} <= set(schema["properties"])
+
+
+def test_invoke_accepts_the_baseline_payload(rag_db_copy):
+    from fastapi.testclient import TestClient
+
+    import main
+
+    with TestClient(main.app) as client:
+        response = client.post("/invoke", json={"input": BASELINE_INPUT})
+    assert response.status_code == 200, response.text
+    output = response.json()["output"]
+    assert output["final_email"]
+    # the large fields come back inline, not as run store references
+    assert isinstance(output["research_info"], list) and isinstance(output["rag_questions"], list)
+
+
+def test_speculative_analysis_keeps_the_run_config_and_trace_id():
+    from langchain_core.callbacks import BaseCallbackHandler
+    from langchain_core.runnables import RunnableLambda
+
+    seen = {}
+
+    class Recorder(BaseCallbackHandler):
+        def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, **kwargs):
+            if kwargs.get("name") == "draft_analysis_chain":
+                seen["parent"] = parent_run_id
+                seen["trace_id"] = graph.trace_id_var.get()
+
+    state = dict(BASELINE_INPUT, draft_email="Dear Paul, the park opens at 9.", research_info=["q\n\na"],
+                 email_category="product_enquiry", run_id="run", trace_id="trace-1")
+
+    def review(state):
+        graph.trace_id_var.set(state["trace_id"])
+        return graph.review_draft_email(state)
+
+    update = RunnableLambda(review).invoke(state, {"callbacks": [Recorder()]})
+    assert update["rewrite_decision"] in ("rewrite", "no_rewrite")
+    assert seen["parent"] is not None
+    assert seen["trace_id"] == "trace-1"
+
+
+def test_prepare_email_keeps_the_email_the_client_sent():
+    email = "Hi,\nAre you open on Sunday?\n--\nPaul Smith\n\nOn Mon, Sarah wrote:\n> We open at 9am."
+    update = graph.prepare_email({"initial_email": email})
+    assert update["clean_email"] == "Hi,\nAre you open on Sunday?"
+    assert "initial_email" not in update
+
+    state = {"initial_email": email, **update}
+    assert graph._categorize_inputs(state) == {"initial_email": "Hi,\nAre you open on Sunday?"}
+    assert graph.prepared_email({"initial_email": email}) == email
+
+
+def test_client_run_ids_get_a_server_generated_suffix():
+    run_id = graph.prepare_email({"initial_email": "Hi", "run_id": "mine"})["run_id"]
+    assert run_id.startswith("mine-") and len(run_id) == len("mine-") + 32
+    assert run_id != graph.prepare_email({"initial_email": "Hi", "run_id": "mine"})["run_id"]
+    # a run_id that is not a safe directory name is dropped
+    assert len(graph.prepare_email({"initial_email": "Hi", "run_id": "../victim"})["run_id"]) == 32
+
+
+def test_importing_graph_leaves_logging_to_the_entry_points():
+    import subprocess
+    import sys
+
+    code = "import logging, graph; print(len(logging.getLogger().handlers))"
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == "0"
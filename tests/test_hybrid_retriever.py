@@ -0,0 +1,142 @@
+import numpy as np
+from langchain_core.documents import Document
+
+from hybrid_retriever import BM25Index, HybridRetriever
+
+CHUNKS = {
+    "hours": "The park opens at 9am and closes at 6pm every day.",
+    "tickets": "Adult tickets cost $45.00 and child tickets cost $30.00.",
+    "dogs": "Dogs are welcome in the park on a lead.",
+    "rides": "The Thunder Loop roller coaster is the fastest ride in the park.",
+}
+
+
+def build(chunks=CHUNKS):
+    index = BM25Index()
+    index.upsert(list(chunks), list(chunks.values()), [{"source": doc_id} for doc_id in chunks])
+    return index
+
+
+def scores_by_id(index, query):
+    scores, _ = index.scores(query)
+    return {doc_id: float(scores[row]) for doc_id, row in index.rows.items()}
+
+
+def hits(index, query, k=4):
+    return [index.ids[row] for row, _ in index.search(query, k)]
+
+
+def assert_same_scores(index, expected, queries=("tickets cost", "park opens", "thunder loop dogs")):
+    for query in queries:
+        got, want = scores_by_id(index, query), scores_by_id(expected, query)
+        assert got.keys() == want.keys()
+        assert np.allclose([got[doc_id] for doc_id in want], list(want.values()))
+
+
+def test_upsert_replaces_the_chunk_indexed_under_the_same_id():
+    index = build()
+    index.upsert(["dogs"], ["Cats are not allowed in the park."])
+    assert len(index) == 4
+    assert hits(index, "dogs lead") == []
+    assert hits(index, "cats") == ["dogs"]
+    assert_same_scores(index, build({**CHUNKS, "dogs": "Cats are not allowed in the park."}))
+
+
+def test_deleted_chunks_are_not_returned_and_their_rows_are_reused():
+    index = build()
+    index.delete(["tickets", "unknown"])
+    assert len(index) == 3
+    assert hits(index, "tickets cost") == []
+    assert "tickets" not in hits(index, "park")
+    assert_same_scores(index, build({doc_id: text for doc_id, text in CHUNKS.items() if doc_id != "tickets"}))
+
+    index.upsert(["parking"], ["Parking costs $10.00 a day."])
+    assert len(index.ids) == 4
+    assert hits(index, "parking") == ["parking"]
+
+
+def test_save_and_load_round_trip(tmp_path):
+    index = build()
+    index.delete(["hours"])
+    index.upsert(["parking"], ["Parking costs $10.00 a day."], [{"source": "parking"}])
+    index.save(str(tmp_path))
+
+    loaded = BM25Index.load(str(tmp_path))
+    assert sorted(loaded.rows) == ["dogs", "parking", "rides", "tickets"]
+    assert loaded.document(loaded.rows["parking"]).metadata == {"source": "parking"}
+    assert_same_scores(loaded, index)
+    assert hits(loaded, "park opens") == hits(index, "park opens")
+
+
+def test_reloaded_index_takes_upserts_and_deletes(tmp_path):
+    build().save(str(tmp_path))
+    index = BM25Index.load(str(tmp_path))
+    index.upsert(["parking", "rides"], ["Parking costs $10.00 a day.", "The carousel is open to all ages."])
+    index.delete(["hours"])
+    expected = {**CHUNKS, "parking": "Parking costs $10.00 a day.", "rides": "The carousel is open to all ages."}
+    del expected["hours"]
+    assert_same_scores(index, build(expected), queries=("parking costs", "thunder loop carousel", "park opens"))
+
+    index.save(str(tmp_path))
+    assert_same_scores(BM25Index.load(str(tmp_path)), index, queries=("parking costs", "carousel"))
+
+
+def test_sync_reindexes_only_changed_and_removed_chunks():
+    class Collection:
+        def __init__(self, chunks):
+            self.chunks = chunks
+
+        def get(self, include):
+            return {"ids": list(self.chunks), "documents": list(self.chunks.values()),
+                    "metadatas": [{"source": doc_id} for doc_id in self.chunks]}
+
+    index = build()
+    assert index.sync(Collection(CHUNKS)) == (0, 0)
+    changed = {**CHUNKS, "dogs": "Dogs must stay outside.", "parking": "Parking is free."}
+    del changed["rides"]
+    assert index.sync(Collection(changed)) == (2, 1)
+    assert_same_scores(index, build(changed))
+
+
+class FakeEmbeddings:
+    def __init__(self):
+        self.calls = []
+
+    def embed_documents(self, texts):
+        self.calls.append(texts)
+        return [[0.0] for _ in texts]
+
+
+def retriever(index, vector_hits, lexical_weight=0.5, k=2):
+    def vector_search(embedded, fetch_k):
+        return [vector_hits for _ in embedded]
+    return HybridRetriever(index=index, embeddings=FakeEmbeddings(), vector_search=vector_search,
+                           k=k, fetch_k=4, lexical_weight=lexical_weight)
+
+
+def test_fusion_weighs_the_scaled_lexical_and_vector_scores():
+    index = build()
+    # "dogs" only has a vector match, and a better one than the lexical best
+    vector_hits = [("dogs", Document(page_content=CHUNKS["dogs"]), 0.9), ("tickets", index.document(1), 0.3)]
+    results = retriever(index, vector_hits).retrieve_many(["child tickets price"])[0]
+    # tickets: 0.5 * 1 + 0.5 * 0.3 / 0.9; dogs: 0.5 * 0.9 / 0.9
+    assert [doc_id for doc_id, _ in results] == ["tickets", "dogs"]
+
+    results = retriever(index, vector_hits, lexical_weight=0.2).retrieve_many(["child tickets price"])[0]
+    assert [doc_id for doc_id, _ in results] == ["dogs", "tickets"]
+
+
+def test_questions_fully_covered_by_lexical_hits_are_not_embedded():
+    index = build()
+    hybrid = retriever(index, [], k=1)
+    results = hybrid.retrieve_many(["thunder loop", "what is the weather like"])
+    assert hybrid.embeddings.calls == [["what is the weather like"]]
+    assert [doc_id for doc_id, _ in results[0]] == ["rides"]
+    assert results[1] == []
+
+
+def test_deleted_chunks_are_not_fused():
+    index = build()
+    index.delete(["tickets"])
+    results = retriever(index, [("hours", index.document(0), 0.5)]).retrieve_many(["tickets cost"])[0]
+    assert [doc_id for doc_id, _ in results] == ["hours"]
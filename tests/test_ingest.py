@@ -0,0 +1,116 @@
+import json
+import os
+
+import chromadb
+import pytest
+
+from fakes import FakeEmbeddings
+from ingest import content_hash, ingest
+
+
+class CountingEmbeddings(FakeEmbeddings):
+    def __init__(self):
+        super().__init__(size=8)
+        self.embedded = []
+
+    def embed_documents(self, texts):
+        self.embedded.extend(texts)
+        return super().embed_documents(texts)
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    docs = tmp_path / "docs"
+    docs.mkdir()
+    (docs / "hours.txt").write_text("The park opens at 9am.\n\nIt closes at 6pm.")
+    (docs / "tickets.md").write_text("# Tickets\n\nAdult tickets cost $45.")
+    (docs / "rides.html").write_text("<html><head><title>x</title></head><body><p>The Thunder Loop is fast.</p></body></html>")
+    return docs
+
+
+@pytest.fixture
+def collection(tmp_path):
+    client = chromadb.PersistentClient(path=str(tmp_path / "chroma"))
+    return client.get_or_create_collection("test")
+
+
+def run(corpus, collection, tmp_path, **kwargs):
+    embeddings = CountingEmbeddings()
+    stats = ingest([str(corpus)], collection, embeddings, str(tmp_path / "manifest.json"),
+                   chunk_size=30, chunk_overlap=0, batch_size=2, **kwargs)
+    return stats.report(), embeddings.embedded
+
+
+def documents(collection):
+    return sorted(collection.get(include=["documents"])["documents"])
+
+
+def test_first_run_embeds_every_chunk_and_writes_the_manifest(corpus, collection, tmp_path):
+    report, embedded = run(corpus, collection, tmp_path)
+    assert report["files"] == 3 and report["files_unchanged"] == 0
+    assert report["chunks_embedded"] == report["chunks"] == collection.count() == len(embedded)
+    assert report["embedding_requests"] == -(-len(embedded) // 2)
+    assert "The Thunder Loop is fast." in documents(collection)
+
+    manifest = json.loads((tmp_path / "manifest.json").read_text())
+    chunk = collection.get(ids=[content_hash("The Thunder Loop is fast.")], include=["metadatas"])
+    assert chunk["metadatas"][0]["source"] == str(corpus / "rides.html")
+    assert sorted(manifest["sources"]) == sorted(str(path) for path in corpus.iterdir())
+
+
+def test_nothing_is_embedded_or_written_when_nothing_changed(corpus, collection, tmp_path):
+    run(corpus, collection, tmp_path)
+    before = documents(collection)
+    manifest = (tmp_path / "manifest.json").read_text()
+
+    report, embedded = run(corpus, collection, tmp_path)
+    assert embedded == [] and report["files_unchanged"] == 3
+    assert report["chunks_embedded"] == report["chunks_deleted"] == report["embedding_requests"] == 0
+    assert documents(collection) == before
+
+    # a touched file with the same text is recognized by its hash
+    os.utime(corpus / "hours.txt", (1, 1))
+    report, embedded = run(corpus, collection, tmp_path)
+    assert embedded == [] and report["files_unchanged"] == 3
+    assert json.loads((tmp_path / "manifest.json").read_text())["sources"][str(corpus / "hours.txt")]["mtime"] == 1
+    assert json.loads(manifest)["sources"][str(corpus / "tickets.md")] == \
+        json.loads((tmp_path / "manifest.json").read_text())["sources"][str(corpus / "tickets.md")]
+
+
+def test_changed_files_only_embed_their_new_chunks(corpus, collection, tmp_path):
+    run(corpus, collection, tmp_path)
+    (corpus / "hours.txt").write_text("The park opens at 9am.\n\nIt closes at 8pm.")
+
+    report, embedded = run(corpus, collection, tmp_path)
+    assert embedded == ["It closes at 8pm."]
+    assert report["files_unchanged"] == 2 and report["chunks_deleted"] == 1
+    assert "It closes at 6pm." not in documents(collection)
+    assert "The park opens at 9am." in documents(collection)
+
+
+def test_removed_files_have_their_chunks_deleted(corpus, collection, tmp_path):
+    run(corpus, collection, tmp_path)
+    count = collection.count()
+    (corpus / "rides.html").unlink()
+
+    report, embedded = run(corpus, collection, tmp_path)
+    assert embedded == [] and report["files"] == 2 and report["chunks_deleted"] == 1
+    assert collection.count() == count - 1
+    assert "The Thunder Loop is fast." not in documents(collection)
+
+
+def test_chunks_not_ingested_by_the_tool_are_kept_unless_pruned(corpus, collection, tmp_path):
+    collection.add(ids=["csv-1"], embeddings=[[0.0] * 8], documents=["Imported from the CSV."])
+    run(corpus, collection, tmp_path)
+    assert "Imported from the CSV." in documents(collection)
+
+    report, _ = run(corpus, collection, tmp_path, prune=True)
+    assert report["chunks_deleted"] == 1
+    assert "Imported from the CSV." not in documents(collection)
+
+
+def test_dry_run_reports_without_writing(corpus, collection, tmp_path):
+    report, embedded = run(corpus, collection, tmp_path, dry_run=True)
+    assert report["chunks_embedded"] == report["chunks"] > 0
+    assert embedded == [] and collection.count() == 0
+    assert not (tmp_path / "manifest.json").exists()
@@ -0,0 +1,87 @@
+import asyncio
+import threading
+
+from langchain.prompts import PromptTemplate
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import RunnableLambda
+
+from llm_cache import InMemoryCacheBackend, LLMCache, SQLiteCacheBackend
+from resilience import RepairingJsonOutputParser
+
+PROMPT = PromptTemplate(template="Route {email}", input_variables=["email"])
+PARSER = RepairingJsonOutputParser(key="router_decision", choices=["rewrite", "no_rewrite"], default="rewrite")
+
+
+def _cached_router(answers):
+    calls = []
+
+    def answer(inputs):
+        calls.append(inputs)
+        return AIMessage(content=answers[len(calls) - 1])
+
+    chain = LLMCache(InMemoryCacheBackend()).wrap("rewrite_router", PROMPT, RunnableLambda(answer) | PARSER)
+    return chain, calls
+
+
+def test_parsed_results_are_cached():
+    chain, calls = _cached_router(['{"router_decision": "no_rewrite"}'])
+    assert chain.invoke({"email": "hi"}) == {"router_decision": "no_rewrite"}
+    assert chain.invoke({"email": "hi"}) == {"router_decision": "no_rewrite"}
+    assert len(calls) == 1
+
+
+def test_parser_default_is_not_cached():
+    chain, calls = _cached_router(["I cannot decide", '{"router_decision": "no_rewrite"}'])
+    assert chain.invoke({"email": "hi"}) == {"router_decision": "rewrite"}
+    assert chain.invoke({"email": "hi"}) == {"router_decision": "no_rewrite"}
+    assert len(calls) == 2
+
+
+def test_cacheable_check():
+    calls = []
+    chain = LLMCache(InMemoryCacheBackend()).wrap("categorizer", PROMPT,
+                                                  RunnableLambda(lambda inputs: calls.append(inputs) or "unsure"),
+                                                  cacheable=lambda result: result != "unsure")
+    chain.invoke({"email": "hi"})
+    chain.invoke({"email": "hi"})
+    assert len(calls) == 2
+
+
+def test_results_of_other_model_settings_are_not_served(tmp_path):
+    path = str(tmp_path / "llm_cache.sqlite3")
+    calls = []
+    chain = RunnableLambda(lambda inputs: calls.append(inputs) or f"answer {len(calls)}")
+    small = {"model": "llama3-8b-8192", "temperature": 0}
+    large = {"model": "llama3-70b-8192", "temperature": 0}
+
+    assert LLMCache(SQLiteCacheBackend(path)).wrap("router", PROMPT, chain, model=small).invoke({"email": "hi"}) \
+        == "answer 1"
+    # a restart with another model in the registry
+    assert LLMCache(SQLiteCacheBackend(path)).wrap("router", PROMPT, chain, model=large).invoke({"email": "hi"}) \
+        == "answer 2"
+    assert LLMCache(SQLiteCacheBackend(path)).wrap("router", PROMPT, chain, model=large).invoke({"email": "hi"}) \
+        == "answer 2"
+    assert len(calls) == 2
+
+
+def test_sqlite_backend_is_used_off_the_event_loop(tmp_path):
+    threads = []
+
+    class RecordingBackend(SQLiteCacheBackend):
+        def get(self, key):
+            threads.append(threading.get_ident())
+            return super().get(key)
+
+        def set(self, key, value, ttl=None):
+            threads.append(threading.get_ident())
+            super().set(key, value, ttl)
+
+    chain = LLMCache(RecordingBackend(str(tmp_path / "llm_cache.sqlite3"))).wrap(
+        "router", PROMPT, RunnableLambda(lambda inputs: "answer"))
+
+    async def run():
+        return await chain.ainvoke({"email": "hi"}), await chain.ainvoke({"email": "hi"}), threading.get_ident()
+
+    first, second, loop_thread = asyncio.run(run())
+    assert first == second == "answer"
+    assert len(threads) == 3 and loop_thread not in threads
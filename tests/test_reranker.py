@@ -0,0 +1,43 @@
+import threading
+
+import numpy as np
+from langchain_core.documents import Document
+
+import reranker
+from reranker import Reranker, reranker_from_env
+
+
+def test_reranking_is_off_by_default(monkeypatch):
+    monkeypatch.delenv("RERANK", raising=False)
+    assert reranker_from_env() is None
+    monkeypatch.setenv("RERANK", "1")
+    assert isinstance(reranker_from_env(), Reranker)
+
+
+def test_available_does_not_wait_for_the_model(monkeypatch):
+    release = threading.Event()
+
+    def slow_load(model_name, batch_size):
+        release.wait(5)
+        return lambda pairs: np.array([len(text) / 100 for _, text in pairs], dtype=np.float32)
+
+    monkeypatch.setattr(reranker, "load_cross_encoder", slow_load)
+    model = Reranker(threshold=0.0)
+    assert not model.available
+    assert not model.available  # still loading, a single loader thread
+
+    release.set()
+    model._loader.join(5)
+    assert model.available
+    hits = [("a", Document(page_content="short")), ("b", Document(page_content="a longer chunk"))]
+    assert [doc_id for doc_id, _ in model.rerank_many(["q"], [hits])[0]] == ["b", "a"]
+
+
+def test_chunks_over_the_budget_are_skipped_and_low_scores_end_the_list(monkeypatch):
+    scores = {"best": 0.9, "long": 0.8, "short": 0.7, "weak": 0.05, "weak short": 0.04}
+    monkeypatch.setattr(reranker, "load_cross_encoder",
+                        lambda model_name, batch_size: lambda pairs: np.array([scores[text] for _, text in pairs]))
+    monkeypatch.setattr(reranker, "count_tokens", lambda text: 100 if text == "long" else 10)
+    model = Reranker(threshold=0.1, token_budget=50)
+    hits = [(text, Document(page_content=text)) for text in scores]
+    assert [doc_id for doc_id, _ in model.rerank_many(["q"], [hits])[0]] == ["best", "short"]
@@ -0,0 +1,57 @@
+import pytest
+from langchain_core.exceptions import OutputParserException
+
+from resilience import DefaultedOutput, RepairingJsonOutputParser, repair_json
+
+CHOICES = ["rewrite", "no_rewrite"]
+
+
+@pytest.mark.parametrize("text, expected, kind", [
+    ('Here it is:\n```json\n{"email_category": "price_enquiry"}\n```', {"email_category": "price_enquiry"}, "extract"),
+    ('{"questions": ["When do you open?", "Is there parking?",],}',
+     {"questions": ["When do you open?", "Is there parking?"]}, "trailing_comma"),
+    ('{"email_draft": "Dear Paul,\nSee you soon."}', {"email_draft": "Dear Paul,\nSee you soon."}, "newlines"),
+    ("{'router_decision': 'research_info'}", {"router_decision": "research_info"}, "python_literal"),
+    ('{"final_email": "Dear Paul, the park', {"final_email": "Dear Paul, the park"}, "truncated"),
+    ("No JSON here.", None, None),
+])
+def test_repair_json(text, expected, kind):
+    assert repair_json(text) == (expected, kind)
+
+
+def test_valid_json_is_parsed_as_is():
+    parser = RepairingJsonOutputParser(key="email_category")
+    parsed = parser.parse('{"email_category": "price_enquiry"}')
+    assert parsed == {"email_category": "price_enquiry"} and not isinstance(parsed, DefaultedOutput)
+
+
+def test_a_lone_value_under_another_key_is_renamed():
+    parser = RepairingJsonOutputParser(key="email_category")
+    assert parser.parse('{"category": "price_enquiry"}') == {"email_category": "price_enquiry"}
+
+
+def test_choices_are_normalized():
+    parser = RepairingJsonOutputParser(key="router_decision", choices=CHOICES)
+    assert parser.parse('{"router_decision": "No Rewrite"}') == {"router_decision": "no_rewrite"}
+    assert parser.parse("I would go with no_rewrite.") == {"router_decision": "no_rewrite"}
+
+
+def test_plain_text_is_taken_as_the_value():
+    parser = RepairingJsonOutputParser(key="final_email", plain_text=True)
+    assert parser.parse("Dear Paul,\nSee you soon.") == {"final_email": "Dear Paul,\nSee you soon."}
+
+
+def test_unrecoverable_output_falls_back_to_the_default():
+    parser = RepairingJsonOutputParser(key="router_decision", choices=CHOICES, default="rewrite")
+    parsed = parser.parse("I cannot decide.")
+    assert parsed == {"router_decision": "rewrite"}
+    # marked so llm_cache does not replay it
+    assert isinstance(parsed, DefaultedOutput) and not parsed.cacheable
+
+
+def test_unrecoverable_output_raises_without_a_default():
+    parser = RepairingJsonOutputParser(key="router_decision", choices=CHOICES)
+    with pytest.raises(OutputParserException):
+        parser.parse("I cannot decide.")
+    with pytest.raises(OutputParserException):
+        RepairingJsonOutputParser().parse("No JSON here.")
@@ -0,0 +1,155 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+from langchain_core.runnables import Runnable
+
+import resilience
+from resilience import CircuitBreaker, CircuitOpenError, ResilientLLM, RetryPolicy
+
+
+class ProviderError(Exception):
+    """An HTTP error of the provider, with the status code and headers the SDKs attach."""
+
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+        self.response = SimpleNamespace(status_code=status_code, headers=headers or {})
+
+
+class ScriptedLLM(Runnable):
+    """Fails or answers each call as scripted; the last outcome repeats."""
+
+    def __init__(self, *outcomes, delays=()):
+        self.outcomes = list(outcomes)
+        self.delays = list(delays)
+        self.calls = 0
+
+    def _next(self):
+        index = min(self.calls, len(self.outcomes) - 1)
+        delay = self.delays[self.calls] if self.calls < len(self.delays) else 0.0
+        self.calls += 1
+        return self.outcomes[index], delay
+
+    def invoke(self, input, config=None, **kwargs):
+        outcome, _ = self._next()
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        outcome, delay = self._next()
+        await asyncio.sleep(delay)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+class Clock:
+    """Stands in for time.monotonic and time.sleep, so backoff and cooldowns take no time."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(resilience.time, "monotonic", clock.monotonic)
+    monkeypatch.setattr(resilience.time, "sleep", clock.sleep)
+    # the largest backoff each retry allows
+    monkeypatch.setattr(resilience.random, "uniform", lambda low, high: high)
+    return clock
+
+
+def _resilient(llm, attempts=4, deadline=90.0, failures=5, cooldown=30.0):
+    policy = RetryPolicy(timeout=10, deadline=deadline, attempts=attempts, backoff_base=0.5, backoff_max=8)
+    return ResilientLLM(llm, "test_chain", policy, CircuitBreaker(failures=failures, cooldown=cooldown))
+
+
+def test_retryable_errors_are_retried_with_exponential_backoff(clock):
+    llm = ScriptedLLM(ProviderError(503), TimeoutError(), ProviderError(429), "answer")
+    assert _resilient(llm).invoke("prompt") == "answer"
+    assert llm.calls == 4
+    assert clock.sleeps == [0.5, 1.0, 2.0]
+
+
+def test_retry_after_is_respected(clock, monkeypatch):
+    monkeypatch.setattr(resilience.random, "uniform", lambda low, high: low)
+    llm = ScriptedLLM(ProviderError(429, {"retry-after": "5"}), "answer")
+    assert _resilient(llm).invoke("prompt") == "answer"
+    assert clock.sleeps == [5.0]
+
+
+def test_client_errors_are_not_retried(clock):
+    llm = ScriptedLLM(ProviderError(400), "answer")
+    with pytest.raises(ProviderError):
+        _resilient(llm).invoke("prompt")
+    assert llm.calls == 1 and clock.sleeps == []
+
+
+def test_retries_stop_at_the_attempt_limit_and_the_deadline(clock):
+    llm = ScriptedLLM(ProviderError(503))
+    with pytest.raises(ProviderError):
+        _resilient(llm, attempts=3).invoke("prompt")
+    assert llm.calls == 3
+
+    llm = ScriptedLLM(ProviderError(503))
+    with pytest.raises(ProviderError):
+        # the third backoff (2s) would end after the deadline
+        _resilient(llm, deadline=2.0).invoke("prompt")
+    assert llm.calls == 3
+
+
+def test_breaker_opens_then_lets_one_trial_through_after_the_cooldown(clock):
+    failing = ScriptedLLM(ProviderError(503))
+    resilient = _resilient(failing, attempts=1, failures=2, cooldown=30)
+    for _ in range(2):
+        with pytest.raises(ProviderError):
+            resilient.invoke("prompt")
+    assert resilient.breaker.state == "open"
+
+    with pytest.raises(CircuitOpenError):
+        resilient.invoke("prompt")
+    assert failing.calls == 2
+
+    # a failed trial opens the breaker again for another cooldown
+    clock.now += 30
+    assert resilient.breaker.state == "half_open"
+    with pytest.raises(ProviderError):
+        resilient.invoke("prompt")
+    assert failing.calls == 3 and resilient.breaker.state == "open"
+
+    clock.now += 30
+    resilient.llm = ScriptedLLM("answer")
+    assert resilient.invoke("prompt") == "answer"
+    assert resilient.breaker.state == "closed"
+
+
+def test_slow_attempts_are_hedged_and_the_first_answer_wins():
+    llm = ScriptedLLM("slow answer", "hedged answer", delays=[5.0, 0.0])
+    policy = RetryPolicy(timeout=10, deadline=20, hedge_percentile=90, hedge_min_samples=5)
+    resilient = ResilientLLM(llm, "test_chain", policy, CircuitBreaker())
+    for _ in range(5):
+        resilient.latencies.add(0.01)
+
+    start = time.perf_counter()
+    assert asyncio.run(resilient.ainvoke("prompt")) == "hedged answer"
+    assert llm.calls == 2 and time.perf_counter() - start < 1.0
+
+
+def test_no_hedging_without_enough_latency_samples():
+    llm = ScriptedLLM("answer", delays=[0.05])
+    policy = RetryPolicy(timeout=10, deadline=20, hedge_percentile=90, hedge_min_samples=5)
+    resilient = ResilientLLM(llm, "test_chain", policy, CircuitBreaker())
+    assert asyncio.run(resilient.ainvoke("prompt")) == "answer"
+    assert llm.calls == 1
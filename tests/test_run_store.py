@@ -0,0 +1,83 @@
+import asyncio
+
+import pytest
+
+import run_store
+from run_store import MemoryRunStore, ProjectedGraph, SQLiteRunStore, aproject, project
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(run_store.time, "time", clock)
+    monkeypatch.setattr(run_store.time, "monotonic", clock)
+    return clock
+
+
+def test_memory_store_keeps_a_run_in_progress_whatever_the_number_of_runs(clock):
+    store = MemoryRunStore(ttl=60)
+    ref = store.put("slow", "research_info", ["answer"])
+    for i in range(5000):
+        store.put(f"run{i}", "research_info", [i])
+    assert store.get(ref) == ["answer"]
+
+
+def test_memory_store_expires_idle_runs_on_put(clock):
+    store = MemoryRunStore(ttl=60)
+    ref = store.put("old", "research_info", ["answer"])
+    clock.now += 61
+    store.put("new", "research_info", ["other"])
+    with pytest.raises(KeyError):
+        store.get(ref)
+
+
+def test_sqlite_store_expires_values_on_put(tmp_path, clock):
+    store = SQLiteRunStore(str(tmp_path / "run_store.sqlite3"), ttl=60, expire_every=30)
+    old = store.put("old", "research_info", ["answer"])
+    clock.now += 20
+    store.put("new", "rag_questions", ["q"])
+    assert store.get(old) == ["answer"]
+
+    clock.now += 50
+    kept = store.put("newer", "rag_questions", ["q"])
+    with pytest.raises(KeyError):
+        store.get(old)
+    assert store.get(kept) == ["q"]
+
+
+def test_aproject_resolves_references(tmp_path):
+    store = SQLiteRunStore(str(tmp_path / "run_store.sqlite3"))
+    state = {"run_id": "run", "final_email": "Dear Paul,", "research_info": store.put("run", "research_info", ["answer"])}
+    assert asyncio.run(aproject(store, state, None)) == {
+        "run_id": "run", "final_email": "Dear Paul,", "research_info": ["answer"]}
+    assert asyncio.run(aproject(store, state, ["final_email"])) == {"final_email": "Dear Paul,"}
+
+
+def test_project_ignores_references_to_other_runs():
+    store = MemoryRunStore()
+    victim = store.put("victim", "research_info", ["private answer"])
+    state = {"run_id": "attacker", "research_info": victim, "initial_email": victim}
+    assert project(store, state, None) == {"run_id": "attacker", "research_info": None, "initial_email": victim}
+    # a node update without a run_id is projected against the run of the stream
+    assert project(store, {"research_info": victim}, None, run_id="attacker") == {"research_info": None}
+    assert project(store, {"research_info": victim}, None) == {"research_info": None}
+
+
+def test_projected_stream_resolves_the_references_of_its_own_run():
+    store = MemoryRunStore()
+
+    class Graph:
+        def stream(self, input, config=None, **kwargs):
+            yield {"categorize_email": {"run_id": "run", "email_category": "booking"}}
+            yield {"research_info_search": {"research_info": store.put("run", "research_info", ["answer"])}}
+
+    chunks = list(ProjectedGraph(Graph(), store).stream({}))
+    assert chunks[1] == {"research_info_search": {"research_info": ["answer"]}}
@@ -0,0 +1,46 @@
+import os
+
+import numpy as np
+
+from vector_index import CURRENT_FILE, NumpyIndex, export_collection
+
+
+class FakeCollection:
+    def __init__(self, texts, dimensions=4):
+        rng = np.random.default_rng(len(texts))
+        self.data = {"ids": [f"id{i}" for i in range(len(texts))],
+                     "embeddings": rng.normal(size=(len(texts), dimensions)).tolist(),
+                     "documents": texts, "metadatas": [{"n": i} for i in range(len(texts))]}
+
+    def get(self, include):
+        return self.data
+
+
+def test_export_publishes_a_complete_snapshot(tmp_path):
+    export_collection(FakeCollection(["one", "two", "three"]), str(tmp_path))
+    index = NumpyIndex(str(tmp_path))
+    assert len(index) == 3
+    rows, _ = index.search(np.asarray(FakeCollection(["one", "two", "three"]).data["embeddings"][1]), 1)
+    assert index.document(rows[0][0]).page_content == "two"
+
+
+def test_reexport_switches_versions_and_keeps_the_previous_one(tmp_path):
+    export_collection(FakeCollection(["one", "two"]), str(tmp_path))
+    old = NumpyIndex(str(tmp_path))
+    first = open(tmp_path / CURRENT_FILE).read()
+    export_collection(FakeCollection(["a", "b", "c", "d"]), str(tmp_path))
+    export_collection(FakeCollection(["x", "y", "z"]), str(tmp_path))
+
+    assert len(NumpyIndex(str(tmp_path))) == 3
+    versions = sorted(name for name in os.listdir(tmp_path) if os.path.isdir(tmp_path / name))
+    assert len(versions) == 2 and first not in versions
+    # an index opened before the switch still reads its own snapshot
+    assert old.document(1).page_content == "two"
+
+
+def test_export_of_an_empty_collection_writes_an_empty_index(tmp_path):
+    assert export_collection(FakeCollection([]), str(tmp_path)) == 0
+    index = NumpyIndex(str(tmp_path))
+    assert len(index) == 0 and index.manifest["dimensions"] == 0
+    rows, scores = index.search(np.ones(4), 3)
+    assert rows.shape == scores.shape == (1, 0)
@@ -0,0 +1,33 @@
+import logging
+from functools import lru_cache
+
+import tiktoken
+
+log = logging.getLogger(__name__)
+
+# Groq does not publish the llama3 tokenizer through tiktoken; cl100k_base
+# counts within a few percent of it on English email text, which is close
+# enough for budgeting and rate limiting.
+ENCODING_NAME = "cl100k_base"
+# used when the encoding cannot be downloaded, e.g. on offline machines
+CHARS_PER_TOKEN = 4
+
+
+@lru_cache(maxsize=1)
+def get_encoding():
+    """Returns the tiktoken encoding, or None when it cannot be loaded."""
+    try:
+        return tiktoken.get_encoding(ENCODING_NAME)
+    except Exception as e:
+        log.warning("---TIKTOKEN UNAVAILABLE, ESTIMATING TOKENS FROM LENGTH--- %r", e)
+        return None
+
+
+def count_tokens(text):
+    """Returns the estimated number of tokens in text."""
+    if not text:
+        return 0
+    encoding = get_encoding()
+    if encoding is None:
+        return -(-len(str(text)) // CHARS_PER_TOKEN)
+    return len(encoding.encode(str(text), disallowed_special=()))
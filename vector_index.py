@@ -0,0 +1,295 @@
+"""Read-only NumPy snapshot of the RAG_DB Chroma collection.
+
+The export writes a directory every worker process can memory-map, so the
+operating system keeps one copy of the vectors in the page cache instead of
+one HNSW segment per worker:
+
+    vectors.npy      unit-normalized embeddings, float32 or float16
+    documents.bin    the chunk texts, UTF-8, back to back
+    offsets.npy      start offset of every chunk in documents.bin, plus the end
+    metadata.json    ids, metadatas and the manifest (model, dtype, count)
+
+Each export writes these files into a new version directory and then points
+the CURRENT file at it with one rename, so readers see either the old or the
+new snapshot, never a mix. The previous version is kept for readers still
+opening it; older ones are deleted.
+
+    python vector_index.py export vector_index --dtype float16
+    python vector_index.py bench vector_index --queries 500
+
+Set VECTOR_INDEX=vector_index to have graph.py retrieve from the snapshot.
+The snapshot does not follow later changes to RAG_DB; export it again after
+ingesting.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import shutil
+import time
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+VECTORS_FILE = "vectors.npy"
+DOCUMENTS_FILE = "documents.bin"
+OFFSETS_FILE = "offsets.npy"
+METADATA_FILE = "metadata.json"
+# names the version directory of the current snapshot
+CURRENT_FILE = "CURRENT"
+# rows converted to float32 at a time when searching a float16 matrix
+SEARCH_BLOCK_ROWS = 65536
+
+
+def export_collection(collection, out_dir, dtype="float32", embedding_model=None):
+    """Writes the ids, embeddings, documents and metadatas of a Chroma collection to out_dir.
+
+    Args:
+        collection: The chromadb collection, e.g. graph.get_vectorstore()._collection.
+        out_dir: The directory to write the snapshot to; existing files are replaced.
+        dtype: "float32", or "float16" to halve the size of the vectors.
+        embedding_model: The name of the model the vectors come from, kept in the manifest.
+    """
+    data = collection.get(include=["embeddings", "documents", "metadatas"])
+    if len(data["ids"]):
+        vectors = np.asarray(data["embeddings"], dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    else:
+        # an empty collection gives an empty index, which every search answers with no chunks
+        vectors = np.zeros((0, 0), dtype=np.float32)
+
+    encoded = [(document or "").encode("utf-8") for document in data["documents"]]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(document) for document in encoded])
+
+    os.makedirs(out_dir, exist_ok=True)
+    previous = _current_version(out_dir)
+    version = f"v{time.time_ns()}"
+    version_dir = os.path.join(out_dir, version)
+    os.makedirs(version_dir)
+    files = {}
+    files[VECTORS_FILE] = lambda f: np.save(f, vectors.astype(dtype))
+    files[OFFSETS_FILE] = lambda f: np.save(f, offsets)
+    files[DOCUMENTS_FILE] = lambda f: f.write(b"".join(encoded))
+    files[METADATA_FILE] = lambda f: f.write(json.dumps({
+        "count": len(encoded),
+        "dimensions": int(vectors.shape[1]) if len(encoded) else 0,
+        "dtype": dtype,
+        "embedding_model": embedding_model,
+        "exported_at": time.time(),
+        "ids": data["ids"],
+        "metadatas": data["metadatas"],
+    }).encode("utf-8"))
+    for name, write in files.items():
+        with open(os.path.join(version_dir, name), "wb") as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+
+    # switching CURRENT is the one step that publishes the new snapshot
+    tmp_path = os.path.join(out_dir, CURRENT_FILE + ".tmp")
+    with open(tmp_path, "w") as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(out_dir, CURRENT_FILE))
+
+    for name in os.listdir(out_dir):
+        path = os.path.join(out_dir, name)
+        if name.startswith("v") and name not in (version, previous) and os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+    # files of the unversioned layout of older exports
+    for name in (VECTORS_FILE, DOCUMENTS_FILE, OFFSETS_FILE, METADATA_FILE):
+        if os.path.exists(os.path.join(out_dir, name)):
+            os.remove(os.path.join(out_dir, name))
+    return len(encoded)
+
+
+def _current_version(path):
+    try:
+        with open(os.path.join(path, CURRENT_FILE)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def snapshot_dir(path):
+    """Returns the directory holding the current snapshot of an export directory."""
+    version = _current_version(path)
+    return os.path.join(path, version) if version else path
+
+
+class NumpyIndex:
+    """Memory-mapped snapshot written by export_collection, searched by cosine similarity."""
+
+    def __init__(self, path):
+        self.path = path
+        path = snapshot_dir(path)
+        self.vectors = np.load(os.path.join(path, VECTORS_FILE), mmap_mode="r")
+        self.offsets = np.load(os.path.join(path, OFFSETS_FILE), mmap_mode="r")
+        self._documents = np.memmap(os.path.join(path, DOCUMENTS_FILE), dtype=np.uint8, mode="r") \
+            if self.offsets[-1] else np.zeros(0, dtype=np.uint8)
+        with open(os.path.join(path, METADATA_FILE)) as f:
+            meta = json.load(f)
+        self.manifest = {key: value for key, value in meta.items() if key not in ("ids", "metadatas")}
+        self.ids = meta["ids"]
+        self.metadatas = meta["metadatas"]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, query_vectors, k):
+        """Returns the (rows, scores) of the k most similar chunks for every query vector.
+
+        Args:
+            query_vectors: An array-like of shape (queries, dimensions).
+            k: The number of chunks to return per query.
+        """
+        queries = np.asarray(query_vectors, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries[None, :]
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        k = min(k, len(self))
+        if not k:
+            return np.zeros((len(queries), 0), dtype=np.int64), np.zeros((len(queries), 0), dtype=np.float32)
+
+        if self.vectors.dtype == np.float32:
+            scores = queries @ self.vectors.T
+        else:
+            scores = np.empty((len(queries), len(self)), dtype=np.float32)
+            for start in range(0, len(self), SEARCH_BLOCK_ROWS):
+                block = np.asarray(self.vectors[start:start + SEARCH_BLOCK_ROWS], dtype=np.float32)
+                scores[:, start:start + len(block)] = queries @ block.T
+
+        rows = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, rows, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        return np.take_along_axis(rows, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+    def document(self, row):
+        """Returns the chunk stored at row as a Document."""
+        text = bytes(self._documents[self.offsets[row]:self.offsets[row + 1]]).decode("utf-8")
+        return Document(page_content=text, metadata=self.metadatas[row] or {})
+
+    def ids_and_documents(self, rows):
+        return [(self.ids[row], self.document(row)) for row in rows]
+
+
+class NumpyRetriever(BaseRetriever):
+    """Drop-in replacement for the Chroma retriever, searching a NumpyIndex."""
+
+    index: NumpyIndex
+    embeddings: object
+    k: int = 4
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        return self._documents(self.embeddings.embed_query(query))
+
+    async def _aget_relevant_documents(self, query, *, run_manager=None):
+        embedding = await self.embeddings.aembed_query(query)
+        return await asyncio.to_thread(self._documents, embedding)
+
+    def _documents(self, embedding):
+        rows, _ = self.index.search([embedding], self.k)
+        return [self.index.document(row) for row in rows[0]]
+
+
+def _rss():
+    """Returns (total, private) resident memory of this process in MB, from /proc when available."""
+    try:
+        with open("/proc/self/status") as f:
+            status = dict(line.split(":", 1) for line in f if ":" in line)
+        total = int(status["VmRSS"].split()[0]) / 1024
+        return round(total, 1), round(int(status.get("RssAnon", "0 kB").split()[0]) / 1024, 1)
+    except (OSError, KeyError, ValueError):
+        import resource
+        return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1), None
+
+
+def _bench_worker(backend, index_dir, queries, k, results):
+    # runs in a fresh process, so the RSS numbers only cover this backend; graph.py
+    # is imported first so only opening the store and searching it is counted
+    if backend == "chroma":
+        import graph
+    before, before_private = _rss()
+    start = time.perf_counter()
+    if backend == "chroma":
+        collection = graph.get_vectorstore()._collection
+        search = lambda batch: collection.query(query_embeddings=batch.tolist(), n_results=k, include=["documents"])
+    else:
+        index = NumpyIndex(index_dir)
+        search = lambda batch: [index.ids_and_documents(rows) for rows in index.search(batch, k)[0]]
+    search(queries[:1])
+    load_seconds = time.perf_counter() - start
+
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        search(query[None, :])
+        latencies.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    search(queries)
+    batch_seconds = time.perf_counter() - start
+
+    after, after_private = _rss()
+    latencies = np.array(latencies) * 1000
+    results.put({
+        "backend": backend,
+        "load_seconds": round(load_seconds, 4),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+        "p95_ms": round(float(np.percentile(latencies, 95)), 3),
+        "batch_of_%d_ms" % len(queries): round(batch_seconds * 1000, 3),
+        "rss_mb": after,
+        "rss_added_mb": round(after - before, 1),
+        "private_rss_added_mb": None if after_private is None else round(after_private - before_private, 1),
+    })
+
+
+def benchmark(index_dir, queries=200, k=3):
+    """Compares single-query and batched top-k latency and memory of Chroma and the NumPy index.
+
+    The queries are stored vectors with a little noise added, so no embeddings
+    API is called. Each backend runs in its own process. A float16 index
+    halves the memory of float32 but spends extra time converting blocks
+    while searching.
+    """
+    vectors = np.load(os.path.join(snapshot_dir(index_dir), VECTORS_FILE), mmap_mode="r")
+    rng = np.random.default_rng(0)
+    picks = np.asarray(vectors[rng.integers(0, len(vectors), queries)], dtype=np.float32)
+    picks += rng.normal(0, 0.01, picks.shape).astype(np.float32)
+
+    context = multiprocessing.get_context("spawn")
+    reports = []
+    for backend in ("chroma", "numpy"):
+        results = context.Queue()
+        process = context.Process(target=_bench_worker, args=(backend, index_dir, picks, k, results))
+        process.start()
+        reports.append(results.get())
+        process.join()
+    return reports
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export RAG_DB to a memory-mapped NumPy index and benchmark it.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="snapshot the Chroma collection of graph.py")
+    export_parser.add_argument("out_dir", help="directory to write the index to")
+    export_parser.add_argument("--dtype", choices=["float32", "float16"], default="float32")
+    bench_parser = commands.add_parser("bench", help="compare latency and RSS against Chroma")
+    bench_parser.add_argument("index_dir")
+    bench_parser.add_argument("--queries", type=int, default=200)
+    bench_parser.add_argument("-k", type=int, default=3)
+    args = parser.parse_args()
+    from metrics import configure_logging
+    configure_logging()
+
+    if args.command == "export":
+        import graph
+        count = export_collection(graph.get_vectorstore()._collection, args.out_dir, args.dtype,
+                                  embedding_model=graph.EMBEDDING_MODEL)
+        print(f"exported {count} chunks to {args.out_dir}")
+    else:
+        for report in benchmark(args.index_dir, args.queries, args.k):
+            print(json.dumps(report))